@@ -164,6 +164,9 @@ data = dict(
                         share_params=True,
                         multiscale_mode='value',
                         keep_ratio=True),
+                    # SeqNormalize + SeqPad can be replaced by
+                    # dict(type='SeqDeferredNormalizePad', size_divisor=32, **img_norm_cfg)
+                    # to keep frames uint8 in the workers and normalize / pad batched on the GPU.
                     dict(type='SeqNormalize', **img_norm_cfg),
                     dict(
                         type='SeqPad',
@@ -26,6 +26,22 @@ METRIC_MAPS = {
     "num_fragmentations": "FM",
 }
 
+# Per accumulator quantities from which compute_many derives METRIC_MAPS.
+PARTIAL_METRICS = (
+    "num_objects",
+    "num_predictions",
+    "num_detections",
+    "num_false_positives",
+    "num_misses",
+    "num_switches",
+    "motp",
+    "mostly_tracked",
+    "partially_tracked",
+    "mostly_lost",
+    "num_fragmentations",
+    "idtp",
+)
+
 
 def bbox_distances(bboxes1, bboxes2, iou_thr=0.5):
     """Calculate the IoU distances of two sets of boxes."""
@@ -73,6 +89,317 @@ def acc_single_video(
     return accumulators
 
 
+def paired_bbox_overlaps(bboxes1, bboxes2, mode="iou", eps=1e-6):
+    """Calculate the overlap of each box in bboxes1 with the box at the same
+    index in bboxes2, with the float32 arithmetic of ``bbox_overlaps``."""
+    bboxes1 = bboxes1.astype(np.float32)
+    bboxes2 = bboxes2.astype(np.float32)
+    area1 = (bboxes1[:, 2] - bboxes1[:, 0]) * (bboxes1[:, 3] - bboxes1[:, 1])
+    w = np.minimum(bboxes1[:, 2], bboxes2[:, 2]) - np.maximum(
+        bboxes1[:, 0], bboxes2[:, 0]
+    )
+    h = np.minimum(bboxes1[:, 3], bboxes2[:, 3]) - np.maximum(
+        bboxes1[:, 1], bboxes2[:, 1]
+    )
+    overlap = np.maximum(w, 0) * np.maximum(h, 0)
+    if mode == "iou":
+        area2 = (bboxes2[:, 2] - bboxes2[:, 0]) * (bboxes2[:, 3] - bboxes2[:, 1])
+        union = area1 + area2 - overlap
+    else:
+        union = area1
+    return overlap / np.maximum(union, eps)
+
+
+def _block_pairs(keys1, keys2):
+    """Row-major index pairs of the equal keys of two sorted key arrays."""
+    start = np.searchsorted(keys2, keys1, side="left")
+    counts = np.searchsorted(keys2, keys1, side="right") - start
+    rows = np.repeat(np.arange(len(keys1)), counts)
+    offsets = np.repeat(start - (np.cumsum(counts) - counts), counts)
+    return rows, np.arange(len(rows)) + offsets
+
+
+def _has_duplicates(keys, ids):
+    order = np.lexsort((ids, keys))
+    return bool(((np.diff(keys[order]) == 0) & (np.diff(ids[order]) == 0)).any())
+
+
+def _dense_ids(keys, ids):
+    """Index every distinct (key, id) pair."""
+    _, inverse = np.unique(np.stack([keys, ids], axis=1), axis=0, return_inverse=True)
+    return inverse.reshape(-1)
+
+
+def _assign(rows, cols, dists, gt_keys, pred_keys):
+    """Select the pairs ``linear_sum_assignment`` matches in each block.
+
+    ``rows``, ``cols`` and ``dists`` are the finite entries of the distance
+    matrices of the blocks in row-major order. Pairs that share neither their
+    gt nor their pred with another pair are matched directly, the solver only
+    runs on the blocks where the assignment is not forced.
+    """
+    if len(rows) == 0:
+        return np.zeros(0, dtype=bool)
+    row_inds, col_inds = rows - rows.min(), cols - cols.min()
+    matched = (np.bincount(row_inds)[row_inds] == 1) & (
+        np.bincount(col_inds)[col_inds] == 1
+    )
+    if matched.all():
+        return matched
+    keys = gt_keys[rows]
+    for key in np.unique(keys[~matched]):
+        e0, e1 = np.searchsorted(keys, [key, key + 1])
+        g0, g1 = np.searchsorted(gt_keys, [key, key + 1])
+        p0, p1 = np.searchsorted(pred_keys, [key, key + 1])
+        dist = np.full((g1 - g0, p1 - p0), np.nan, dtype=dists.dtype)
+        dist[rows[e0:e1] - g0, cols[e0:e1] - p0] = dists[e0:e1]
+        edges = np.full(dist.shape, -1)
+        edges[rows[e0:e1] - g0, cols[e0:e1] - p0] = np.arange(e0, e1)
+        row, col = linear_sum_assignment(dist)
+        matched[e0:e1] = False
+        matched[edges[row, col][np.isfinite(dist[row, col])]] = True
+    return matched
+
+
+def _flatten_video(results, gts, num_classes, ignore_by_classes):
+    """Concatenate the gts, preds and ignored regions of all frames.
+
+    Rows are keyed by ``frame * num_classes + label`` and sorted by key, so
+    each key holds one of the ``dist`` matrices of ``acc_single_video`` with
+    its rows and columns in the same order.
+    """
+    gt_keys, gt_ids, gt_bboxes = [], [], []
+    pred_keys, pred_ids, pred_bboxes = [], [], []
+    ignore_keys, ignore_bboxes = [], []
+    for frame_id, (result, gt) in enumerate(zip(results, gts)):
+        labels = gt["labels"]
+        valid_inds = (gt["instance_ids"] > -1) & (labels >= 0) & (labels < num_classes)
+        gt_keys.append(frame_id * num_classes + labels[valid_inds])
+        gt_ids.append(gt["instance_ids"][valid_inds])
+        gt_bboxes.append(gt["bboxes"][valid_inds, :4])
+        labels = np.repeat(np.arange(num_classes), [len(r) for r in result])
+        result = np.concatenate(result, axis=0)
+        pred_keys.append(frame_id * num_classes + labels)
+        pred_ids.append(result[:, 0])
+        pred_bboxes.append(result[:, 1:-1])
+        if ignore_by_classes:
+            labels = gt["labels_ignore"]
+            valid_inds = (labels >= 0) & (labels < num_classes)
+            ignore_keys.append(frame_id * num_classes + labels[valid_inds])
+            ignore_bboxes.append(gt["bboxes_ignore"][valid_inds, :4])
+        else:
+            ignore_keys.append(np.full(len(gt["bboxes_ignore"]), frame_id))
+            ignore_bboxes.append(gt["bboxes_ignore"][:, :4])
+
+    gt_keys = np.concatenate(gt_keys).astype(np.int64)
+    order = np.argsort(gt_keys, kind="stable")
+    ignore_keys = np.concatenate(ignore_keys).astype(np.int64)
+    ignore_order = np.argsort(ignore_keys, kind="stable")
+    return (
+        gt_keys[order],
+        np.concatenate(gt_ids).astype(int)[order],
+        np.concatenate(gt_bboxes)[order],
+        np.concatenate(pred_keys).astype(np.int64),
+        np.concatenate(pred_ids).astype(int),
+        np.concatenate(pred_bboxes),
+        ignore_keys[ignore_order],
+        np.concatenate(ignore_bboxes)[ignore_order],
+    )
+
+
+def acc_single_video_vectorized(
+    results, gts, iou_thr=0.5, ignore_iof_thr=0.5, ignore_by_classes=False
+):
+    """Accumulate results in a single video with array operations.
+
+    Replays the matching of ``acc_single_video`` on the concatenated boxes of
+    all frames and classes: the IoU distances of every frame are computed in
+    one batch, matches are carried over and ID switches detected on arrays
+    of per (class, id) states, and the assignment solver only runs where the
+    matching is not forced. Videos with an id repeated within a frame are
+    left to motmetrics, which resolves them row by row.
+
+    Returns:
+        tuple[ndarray]: The ``PARTIAL_METRICS`` motmetrics computes for the
+            accumulator of each class, of shape (num_classes,
+            len(PARTIAL_METRICS)), and whether each accumulator has events.
+    """
+    num_classes = len(results[0])
+    (
+        gt_keys,
+        gt_ids,
+        gt_bboxes,
+        pred_keys,
+        pred_ids,
+        pred_bboxes,
+        ignore_keys,
+        ignore_bboxes,
+    ) = _flatten_video(results, gts, num_classes, ignore_by_classes)
+    if _has_duplicates(gt_keys, gt_ids) or _has_duplicates(pred_keys, pred_ids):
+        accs = acc_single_video(
+            results, gts, iou_thr, ignore_iof_thr, ignore_by_classes
+        )
+        mh = mm.metrics.create()
+        partials = np.zeros((num_classes, len(PARTIAL_METRICS)))
+        active = np.array([len(acc._events["Type"]) > 0 for acc in accs])
+        for i in np.flatnonzero(active):
+            summary = mh.compute(
+                accs[i], metrics=PARTIAL_METRICS, return_dataframe=False
+            )
+            partials[i] = [summary[m] for m in PARTIAL_METRICS]
+        return partials, active
+
+    rows, cols = _block_pairs(gt_keys, pred_keys)
+    dists = 1 - paired_bbox_overlaps(gt_bboxes[rows], pred_bboxes[cols])
+    valid_inds = dists <= iou_thr
+    rows, cols, dists = rows[valid_inds], cols[valid_inds], dists[valid_inds]
+
+    if len(ignore_keys) > 0:
+        # 1. ignore by iof
+        keys = pred_keys if ignore_by_classes else pred_keys // num_classes
+        iof_rows, iof_cols = _block_pairs(keys, ignore_keys)
+        iofs = paired_bbox_overlaps(
+            pred_bboxes[iof_rows], ignore_bboxes[iof_cols], mode="iof"
+        )
+        ignores = np.zeros(len(pred_keys), dtype=bool)
+        ignores[iof_rows[iofs > ignore_iof_thr]] = True
+        if ignores.any():
+            # 2. assign gt and preds, in the frames and classes with ignores
+            fps = np.ones(len(pred_keys), dtype=bool)
+            inds = np.isin(gt_keys[rows], pred_keys[ignores])
+            assigned = _assign(rows[inds], cols[inds], dists[inds], gt_keys, pred_keys)
+            fps[cols[inds][assigned]] = False
+            # 3. filter preds
+            valid_inds = ~(fps & ignores)
+            pred_keys, pred_ids = pred_keys[valid_inds], pred_ids[valid_inds]
+            new_inds = np.cumsum(valid_inds) - 1
+            valid_inds = valid_inds[cols]
+            rows, cols = rows[valid_inds], new_inds[cols[valid_inds]]
+            dists = dists[valid_inds]
+    dists = dists.astype(float)
+
+    gt_labels = gt_keys % num_classes
+    pred_labels = pred_keys % num_classes
+    obj_ids = _dense_ids(gt_labels, gt_ids)
+    hyp_ids = _dense_ids(pred_labels, pred_ids)
+    num_objs = obj_ids.max() + 1 if len(obj_ids) else 0
+    num_hyps = hyp_ids.max() + 1 if len(hyp_ids) else 0
+
+    # replay the frames in order, keeping the hypothesis each object was
+    # last matched to
+    last_match = np.full(num_objs, -1)
+    gt_matched = np.zeros(len(gt_keys), dtype=bool)
+    pred_matched = np.zeros(len(pred_keys), dtype=bool)
+    matches, switches = [], []
+    frames = gt_keys[rows] // num_classes
+    bounds = np.flatnonzero(np.diff(frames)) + 1
+    for e0, e1 in zip(np.r_[0, bounds], np.r_[bounds, len(frames)]):
+        frame_rows, frame_cols = rows[e0:e1], cols[e0:e1]
+        objs, hyps = obj_ids[frame_rows], hyp_ids[frame_cols]
+        # 1. carry forward matches, the first object wins a hypothesis
+        carried = np.flatnonzero(last_match[objs] == hyps)
+        carried = carried[np.unique(hyps[carried], return_index=True)[1]]
+        gt_matched[frame_rows[carried]] = True
+        pred_matched[frame_cols[carried]] = True
+        # 2. assign the rest
+        rest = np.flatnonzero(~gt_matched[frame_rows] & ~pred_matched[frame_cols])
+        assigned = rest[
+            _assign(
+                frame_rows[rest],
+                frame_cols[rest],
+                dists[e0 + rest],
+                gt_keys,
+                pred_keys,
+            )
+        ]
+        gt_matched[frame_rows[assigned]] = True
+        pred_matched[frame_cols[assigned]] = True
+        prev = last_match[objs[assigned]]
+        matches.extend([e0 + carried, e0 + assigned])
+        switches.extend(
+            [np.zeros(len(carried), dtype=bool), (prev > -1) & (prev != hyps[assigned])]
+        )
+        last_match[objs[assigned]] = hyps[assigned]
+    matches = np.concatenate(matches) if matches else np.zeros(0, dtype=int)
+    switches = np.concatenate(switches) if switches else np.zeros(0, dtype=bool)
+
+    obj_labels = np.zeros(num_objs, dtype=int)
+    obj_labels[obj_ids] = gt_labels
+    match_labels = gt_labels[rows[matches]]
+
+    num_objects = np.bincount(gt_labels, minlength=num_classes)
+    num_predictions = np.bincount(pred_labels, minlength=num_classes)
+    num_detections = np.bincount(match_labels, minlength=num_classes)
+    num_switches = np.bincount(match_labels, weights=switches, minlength=num_classes)
+    motp = quiet_divide(
+        np.bincount(match_labels, weights=dists[matches], minlength=num_classes),
+        num_detections,
+    )
+
+    # track ratios
+    ratios = np.bincount(obj_ids[rows[matches]], minlength=num_objs) / np.bincount(
+        obj_ids, minlength=num_objs
+    )
+    mostly_tracked = np.bincount(obj_labels, ratios >= 0.8, minlength=num_classes)
+    partially_tracked = np.bincount(
+        obj_labels, (ratios >= 0.2) & (ratios < 0.8), minlength=num_classes
+    )
+    mostly_lost = np.bincount(obj_labels, ratios < 0.2, minlength=num_classes)
+
+    # fragmentations: misses after a match, before the last match of an object
+    order = np.argsort(obj_ids, kind="stable")
+    objs, missed = obj_ids[order], ~gt_matched[order]
+    last_tracked = np.full(num_objs, -1)
+    np.maximum.at(last_tracked, objs[~missed], np.flatnonzero(~missed))
+    frags = (
+        missed[1:]
+        & ~missed[:-1]
+        & (objs[1:] == objs[:-1])
+        & (np.arange(1, len(objs)) < last_tracked[objs[1:]])
+    )
+    num_fragmentations = np.bincount(obj_labels[objs[1:][frags]], minlength=num_classes)
+
+    # idtp: the weight of a maximum matching of the frames each object and
+    # hypothesis overlap in
+    pairs, overlaps = np.unique(
+        obj_ids[rows] * num_hyps + hyp_ids[cols], return_counts=True
+    )
+    pair_objs, pair_hyps = pairs // num_hyps, pairs % num_hyps
+    single = (np.bincount(pair_objs, minlength=num_objs)[pair_objs] == 1) & (
+        np.bincount(pair_hyps, minlength=num_hyps)[pair_hyps] == 1
+    )
+    idtp = np.bincount(
+        obj_labels[pair_objs[single]], overlaps[single], minlength=num_classes
+    )
+    for i in np.unique(obj_labels[pair_objs[~single]]):
+        inds = ~single & (obj_labels[pair_objs] == i)
+        objs = np.unique(pair_objs[inds], return_inverse=True)[1]
+        hyps = np.unique(pair_hyps[inds], return_inverse=True)[1]
+        weights = np.zeros((objs.max() + 1, hyps.max() + 1))
+        weights[objs, hyps] = overlaps[inds]
+        row, col = linear_sum_assignment(-weights)
+        idtp[i] += weights[row, col].sum()
+
+    partials = np.stack(
+        [
+            num_objects,
+            num_predictions,
+            num_detections,
+            num_predictions - num_detections,
+            num_objects - num_detections,
+            num_switches,
+            motp,
+            mostly_tracked,
+            partially_tracked,
+            mostly_lost,
+            num_fragmentations,
+            idtp,
+        ],
+        axis=1,
+    ).astype(float)
+    return partials, num_objects + num_predictions > 0
+
+
 def aggregate_accs(accumulators, classes):
     """Aggregate results from each class."""
     # accs for each class
@@ -114,6 +441,30 @@ def eval_single_class(names, accs):
     return results
 
 
+def summarize_partials(partials):
+    """Evaluate CLEAR MOT results from the ``PARTIAL_METRICS`` of a group of
+    accumulators, the same way as ``eval_single_class``."""
+    values = dict(zip(PARTIAL_METRICS, partials.sum(axis=0)))
+    motp = partials[:, PARTIAL_METRICS.index("motp")]
+    num_dets = partials[:, PARTIAL_METRICS.index("num_detections")]
+    sum_motp = np.nansum(motp * num_dets)
+    errors = values["num_misses"] + values["num_switches"]
+    errors += values["num_false_positives"]
+    results = dict(
+        idf1=quiet_divide(
+            2 * values["idtp"], values["num_objects"] + values["num_predictions"]
+        ),
+        mota=1 - quiet_divide(errors, values["num_objects"]),
+        motp=1 - quiet_divide(sum_motp, values["num_detections"]),
+        recall=quiet_divide(values["num_detections"], values["num_objects"]),
+        precision=quiet_divide(
+            values["num_detections"],
+            values["num_false_positives"] + values["num_detections"],
+        ),
+    )
+    return [float(results[m]) if m in results else int(values[m]) for m in METRIC_MAPS]
+
+
 def eval_mot(
     results,
     annotations,
@@ -123,6 +474,7 @@ def eval_mot(
     ignore_iof_thr=0.5,
     ignore_by_classes=False,
     nproc=4,
+    vectorized=True,
 ):
     """Evaluation CLEAR MOT metrics.
 
@@ -149,6 +501,9 @@ def eval_mot(
         ignore_by_classes (bool, optional): Whether ignore the results by
             classes or not. Defaults to False.
         nproc (int, optional): Number of the processes. Defaults to 4.
+        vectorized (bool, optional): Whether to accumulate the videos with
+            ``acc_single_video_vectorized`` instead of motmetrics
+            accumulators. Defaults to True.
 
     Returns:
         dict[str, float]: Evaluation results.
@@ -165,7 +520,7 @@ def eval_mot(
 
     pool = Pool(nproc)
     accs = pool.starmap(
-        acc_single_video,
+        acc_single_video_vectorized if vectorized else acc_single_video,
         zip(
             results,
             gts,
@@ -174,10 +529,20 @@ def eval_mot(
             [ignore_by_classes for _ in range(len(gts))],
         ),
     )
-    names, accs, items = aggregate_accs(accs, classes)
     print_log("Evaluating...", logger)
     eval_results = pd.DataFrame(columns=metrics)
-    summaries = pool.starmap(eval_single_class, zip(names, accs))
+    if vectorized:
+        partials = np.stack([acc[0] for acc in accs])
+        active = np.stack([acc[1] for acc in accs])
+        items = list(classes) + ["OVERALL"]
+        summaries = [
+            summarize_partials(partials[:, i][active[:, i]])
+            for i in range(len(classes))
+        ]
+        summaries.append(summarize_partials(partials[active]))
+    else:
+        names, accs, items = aggregate_accs(accs, classes)
+        summaries = pool.starmap(eval_single_class, zip(names, accs))
     pool.close()
 
     # category and overall results
@@ -3,7 +3,26 @@ import numpy as np
 import random
 from mmdet.datasets import DATASETS, CocoDataset
 from core import eval_mot
-from .parsers import CocoVID
+from .parsers import AnnotationStore, CocoVID
+from .serialization import SerializedList
+
+
+def match_instance_ids(ins_ids, ref_ins_ids):
+    """Map every id in ``ins_ids`` to the index of its first occurrence in
+    ``ref_ins_ids`` (-1 when absent), using a sorted search instead of
+    repeated ``list.index`` calls."""
+    ins_ids = np.asarray(ins_ids, dtype=np.int64).reshape(-1)
+    ref_ins_ids = np.asarray(ref_ins_ids, dtype=np.int64).reshape(-1)
+    if ref_ins_ids.size == 0:
+        return np.full(ins_ids.shape, -1, dtype=np.int64)
+    # a stable sort keeps equal ids in their original order, so the leftmost
+    # hit of searchsorted is the first occurrence, as with list.index
+    order = np.argsort(ref_ins_ids, kind="stable")
+    sorted_ids = ref_ins_ids[order]
+    pos = np.searchsorted(sorted_ids, ins_ids, side="left")
+    pos = np.minimum(pos, sorted_ids.size - 1)
+    found = sorted_ids[pos] == ins_ids
+    return np.where(found, order[pos], -1).astype(np.int64)
 
 
 @DATASETS.register_module(force=True)
@@ -15,15 +34,73 @@ class CocoVideoDataset(CocoDataset):
         skip_nomatch_pairs=True,
         key_img_sampler=dict(interval=1),
         ref_img_sampler=dict(scope=3, num_ref_imgs=1, method="uniform"),
+        ann_store=None,
+        serialize_data_infos=True,
         *args,
         **kwargs,
     ):
+        self.ann_store = ann_store
+        self.serialize_data_infos = serialize_data_infos
         self.load_as_video = load_as_video
         self.match_gts = match_gts
         self.skip_nomatch_pairs = skip_nomatch_pairs
         self.key_img_sampler = key_img_sampler
         self.ref_img_sampler = ref_img_sampler
         super().__init__(*args, **kwargs)
+        self._build_indices()
+        if self.serialize_data_infos:
+            # keep the per-image metadata out of Python objects so that
+            # DataLoader workers do not copy it page by page on access
+            self.data_infos = SerializedList(self.data_infos)
+
+    def _build_indices(self):
+        """Hash indices over the id lists, built once the image filtering of
+        the parent dataset has settled ``img_ids``."""
+        self.cat_id_set = set(self.cat_ids)
+        self.img_id2idx = {img_id: i for i, img_id in enumerate(self.img_ids)}
+
+    def _load_ann_api(self, ann_file, api_cls):
+        """Annotation api of ``ann_file``.
+
+        When ``ann_store`` is set (a directory, or True for the json path
+        with its extension replaced by ``.store``), the json is compiled once
+        into a memory-mapped :class:`AnnotationStore` that replaces
+        ``api_cls``, so workers and ranks share the annotations instead of
+        each parsing the json.
+        """
+        if not self.ann_store:
+            return api_cls(ann_file)
+        return AnnotationStore.from_ann_file(ann_file, self.ann_store)
+
+    def _filter_imgs_by_api(self, api, min_size=32):
+        """Filter images too small or without ground truths."""
+        valid_inds = []
+        # obtain images that contain annotation
+        if isinstance(api, AnnotationStore):
+            ids_with_ann = set(api.get_img_ids_with_anns())
+        else:
+            ids_with_ann = set(_["image_id"] for _ in api.anns.values())
+        # obtain images that contain annotations of the required categories
+        ids_in_cat = set()
+        for i, class_id in enumerate(self.cat_ids):
+            ids_in_cat |= set(api.cat_img_map[class_id])
+        # merge the image id sets of the two conditions and use the merged set
+        # to filter out images if self.filter_empty_gt=True
+        ids_in_cat &= ids_with_ann
+
+        valid_img_ids = []
+        for i, img_info in enumerate(self.data_infos):
+            img_id = self.img_ids[i]
+            if self.filter_empty_gt and img_id not in ids_in_cat:
+                continue
+            if min(img_info["width"], img_info["height"]) >= min_size:
+                valid_inds.append(i)
+                valid_img_ids.append(img_id)
+        self.img_ids = valid_img_ids
+        return valid_inds
+
+    def _filter_imgs(self, min_size=32):
+        return self._filter_imgs_by_api(self.coco, min_size)
 
     def load_annotations(self, ann_file):
         """Load annotation from annotation file."""
@@ -55,7 +132,7 @@ class CocoVideoDataset(CocoDataset):
         return ids
 
     def load_video_anns(self, ann_file):
-        self.coco = CocoVID(ann_file)
+        self.coco = self._load_ann_api(ann_file, CocoVID)
         # self.cat_ids = self.coco.get_cat_ids(cat_names=self.CLASSES)
         self.cat_ids = self.get_cat_ids_by_name(catNms=self.CLASSES)
         self.cat2label = {cat_id: i for i, cat_id in enumerate(self.cat_ids)}
@@ -128,7 +205,7 @@ class CocoVideoDataset(CocoDataset):
             dict: Annotation info of specified index.
         """
         img_id = img_info["id"]
-        ann_ids = self.coco.get_ann_ids(img_ids=[img_id], cat_ids=self.cat_ids)
+        ann_ids = self.coco.get_ann_ids(img_ids=[img_id], cat_ids=self.cat_id_set)
         ann_info = self.coco.load_anns(ann_ids)
         return self._parse_ann_info_ori(img_info, ann_info)
     
@@ -142,7 +219,7 @@ class CocoVideoDataset(CocoDataset):
             dict: Annotation info of specified index.
         """
         img_id = img_info["id"]
-        ann_ids = self.lvis.get_ann_ids(img_ids=[img_id], cat_ids=self.cat_ids)
+        ann_ids = self.lvis.get_ann_ids(img_ids=[img_id], cat_ids=self.cat_id_set)
         ann_info = self.lvis.load_anns(ann_ids)
         return self._parse_ann_info(img_info, ann_info)
 
@@ -150,7 +227,7 @@ class CocoVideoDataset(CocoDataset):
         ann_info = self.get_ann_info(img_info)
         results = dict(img_info=img_info, ann_info=ann_info)
         if self.proposals is not None:
-            idx = self.img_ids.index(img_info["id"])
+            idx = self.img_id2idx[img_info["id"]]
             results["proposals"] = self.proposals[idx]
         return results
 
@@ -164,14 +241,10 @@ class CocoVideoDataset(CocoDataset):
 
     def _match_gts(self, ann, ref_ann):
         if "instance_ids" in ann:
-            ins_ids = list(ann["instance_ids"])
-            ref_ins_ids = list(ref_ann["instance_ids"])
-            match_indices = np.array(
-                [ref_ins_ids.index(i) if i in ref_ins_ids else -1 for i in ins_ids]
-            )
-            ref_match_indices = np.array(
-                [ins_ids.index(i) if i in ins_ids else -1 for i in ref_ins_ids]
-            )
+            ins_ids = ann["instance_ids"]
+            ref_ins_ids = ref_ann["instance_ids"]
+            match_indices = match_instance_ids(ins_ids, ref_ins_ids)
+            ref_match_indices = match_instance_ids(ref_ins_ids, ins_ids)
         else:
             match_indices = np.arange(ann["bboxes"].shape[0], dtype=np.int64)
             ref_match_indices = match_indices.copy()
@@ -231,7 +304,7 @@ class CocoVideoDataset(CocoDataset):
                 continue
             if ann["area"] <= 0 or w < 1 or h < 1:
                 continue
-            if ann["category_id"] not in self.cat_ids:
+            if ann["category_id"] not in self.cat2label:
                 continue
 
             bbox = [x1, y1, x1 + w, y1 + h]
@@ -308,7 +381,7 @@ class CocoVideoDataset(CocoDataset):
                 continue
             if ann["area"] <= 0 or w < 1 or h < 1:
                 continue
-            if ann["category_id"] not in self.cat_ids:
+            if ann["category_id"] not in self.cat2label:
                 continue
             bbox = [x1, y1, x1 + w, y1 + h]
             if ann.get("iscrowd", False):
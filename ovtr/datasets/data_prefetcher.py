@@ -4,8 +4,10 @@
 # Licensed under the Apache License, Version 2.0 [see LICENSE for details]
 # ------------------------------------------------------------------------
 
+import threading
 import torch
 from functools import partial
+from queue import Queue, Full
 from detectron2.structures import Instances
 
 def to_cuda(samples, targets, device):
@@ -107,3 +109,156 @@ class data_prefetcher():
                 targets = None
 
         return samples, targets
+
+
+def _map_batch(data, func):
+    """Apply ``func`` to every tensor / Instances leaf of a collated batch,
+    leaving other leaves (file names, infos, ...) untouched."""
+    if is_tensor_or_instances(data):
+        return func(data)
+    if isinstance(data, dict):
+        return {k: _map_batch(v, func) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_map_batch(v, func) for v in data]
+    return data
+
+
+def _batch_tensors(data):
+    tensors = []
+
+    def collect(x):
+        if isinstance(x, Instances):
+            tensors.extend(v for v in x.get_fields().values() if isinstance(v, torch.Tensor))
+        else:
+            tensors.append(x)
+        return x
+    _map_batch(data, collect)
+    return tensors
+
+
+def _pin(data):
+    if isinstance(data, Instances):
+        ret = Instances(data.image_size)
+        for k, v in data.get_fields().items():
+            if isinstance(v, torch.Tensor) and not v.is_pinned():
+                v = v.pin_memory()
+            ret.set(k, v)
+        return ret
+    return data if data.is_pinned() else data.pin_memory()
+
+
+def _to_device(data, device):
+    return data.to(device, non_blocking=True)
+
+
+class mot_data_prefetcher():
+    """Iterates over a loader of ``mot_collate_fn`` batches one batch ahead.
+
+    On CUDA the next batch is pinned, copied on a side stream and passed
+    through ``batch_transform`` (e.g. the batched normalize / pad of
+    SeqDeferredNormalizePad) while the current one is being consumed. On
+    other devices a background thread does the same on the host, so the
+    batches yielded are identical to ``data_dict_to_cuda`` + ``batch_transform``
+    applied in the loop.
+
+    A loader without workers runs the dataset (and its random augmentations)
+    in the process that iterates it. Its batches are then fetched in the
+    calling thread, right when a plain loop would fetch them, so that the
+    python / numpy / torch RNGs are drawn in the same order and the RNG states
+    saved at a step still resume the epoch exactly. Loading only overlaps
+    the training step with ``num_workers > 0``.
+    """
+    def __init__(self, loader, device, batch_transform=None, num_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.batch_transform = batch_transform
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, data_dict):
+        if self.device.type == 'cuda':
+            data_dict = _map_batch(data_dict, _pin)
+        data_dict = _map_batch(data_dict, partial(_to_device, device=self.device))
+        if self.batch_transform is not None:
+            data_dict['imgs'] = self.batch_transform(data_dict['imgs'])
+        return data_dict
+
+    def __iter__(self):
+        # created here, in the calling thread, so that the loader draws its
+        # worker seeds from the RNG at the same point as a plain loop would
+        loader = iter(self.loader)
+        if getattr(self.loader, 'num_workers', 0) == 0:
+            return self._iter_inline(loader)
+        if self.device.type == 'cuda':
+            return self._iter_stream(loader)
+        return self._iter_thread(loader)
+
+    def _iter_inline(self, loader):
+        for data_dict in loader:
+            yield self._prepare(data_dict)
+
+    def _iter_stream(self, loader):
+        stream = torch.cuda.Stream(device=self.device)
+
+        def preload():
+            try:
+                data_dict = next(loader)
+            except StopIteration:
+                return None
+            # the side stream must not overwrite memory the main stream still reads
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+                return self._prepare(data_dict)
+
+        next_data = preload()
+        while next_data is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            data_dict = next_data
+            for t in _batch_tensors(data_dict):
+                if t.is_cuda:
+                    t.record_stream(torch.cuda.current_stream(self.device))
+            next_data = preload()
+            yield data_dict
+
+    def _iter_thread(self, loader):
+        queue = Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def worker():
+            try:
+                for data_dict in loader:
+                    item = self._prepare(data_dict)
+                    while not stop.is_set():
+                        try:
+                            queue.put(item, timeout=0.1)
+                            break
+                        except Full:
+                            continue
+                    if stop.is_set():
+                        return
+                item = end
+            except Exception as e:  # re-raised in the consuming thread
+                item = e
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    continue
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
@@ -11,7 +11,6 @@ from collections import defaultdict
 import collections
 import copy
 import math
-from operator import itemgetter
 from pathlib import Path
 import random
 import cv2
@@ -347,7 +346,7 @@ class LVIS_seqs_Dataset(TaoDataset):
         ann_info = self.get_lvis_ann_info(img_info)
         results = dict(img_info=img_info, ann_info=ann_info)
         if self.proposals is not None:
-            idx = self.img_ids.index(img_info["id"])
+            idx = self.img_id2idx[img_info["id"]]
             results["proposals"] = self.proposals[idx]
         return results
 
@@ -416,8 +415,10 @@ class LVIS_seqs_Dataset(TaoDataset):
         repeat_indices = []
         for dataset_idx, repeat_factor in enumerate(repeat_factors):
             repeat_indices.extend([dataset_idx] * math.floor(repeat_factor))
-        self.repeat_indices = repeat_indices
-        self.ids = list(itemgetter(*repeat_indices)(self.img_ids))
+        # numpy arrays rather than lists of ints, which DataLoader workers
+        # would otherwise copy on access
+        self.repeat_indices = np.array(repeat_indices, dtype=np.int64)
+        self.ids = np.asarray(self.img_ids, dtype=np.int64)[self.repeat_indices]
 
     def __len__(self):
         if self.ids is None:
@@ -561,7 +562,7 @@ class LVIS_seqs_Dataset_val(TaoDataset):
         ann_info = self.get_ann_info(img_info)
         results = dict(img_info=img_info, ann_info=ann_info)
         if self.proposals is not None:
-            idx = self.img_ids.index(img_info["id"])
+            idx = self.img_id2idx[img_info["id"]]
             results["proposals"] = self.proposals[idx]
         return results
 
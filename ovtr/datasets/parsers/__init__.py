@@ -1,4 +1,5 @@
+from .ann_store import AnnotationStore
 from .coco_api import COCO, COCOeval
 from .coco_video_parser import CocoVID
 
-__all__ = ["COCO", "COCOeval", "CocoVID"]
+__all__ = ["AnnotationStore", "COCO", "COCOeval", "CocoVID"]
@@ -0,0 +1,454 @@
+"""Compiled, memory-mapped annotation store.
+
+Parsing the multi-hundred-MB LVIS/TAO json files gives every DataLoader
+worker and every DDP rank its own copy of the annotation dicts. The store
+compiles such a file once into flat ``.npy`` arrays (boxes, category, image,
+video, instance ids and CSR offsets) that are opened with ``mmap_mode="r"``,
+so all processes share the same read-only pages. It implements the subset of
+the COCO / LVIS / CocoVID api used by the OVTR datasets and decodes the
+annotation and image dicts on access.
+
+Only the fields read by the datasets are kept: boxes, area, category,
+instance id and the ``iscrowd`` / ``ignore`` / ``clear`` flags for
+annotations; id, size, video, frame and file names for images. Masks are not
+stored.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch.distributed as dist
+
+STORE_VERSION = 1
+
+# bits of the per-annotation ``flags`` array
+_ISCROWD = 1
+_IGNORE = 2
+_CLEAR = 4
+_HAS_INSTANCE_ID = 8
+
+_IMG_STR_FIELDS = ("file_name", "coco_url")
+
+
+def _encode_strings(values):
+    """Pack a list of strings (``None`` for missing) into a byte blob, its
+    offsets and a presence mask."""
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    present = np.ones(len(values), dtype=bool)
+    chunks = []
+    for i, value in enumerate(values):
+        if value is None:
+            present[i] = False
+            value = ""
+        data = value.encode("utf-8")
+        chunks.append(data)
+        offsets[i + 1] = offsets[i] + len(data)
+    blob = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+    return blob, offsets, present
+
+
+def _csr(keys, num_keys):
+    """Stable order of ``keys`` and the offsets of each key's run."""
+    order = np.argsort(keys, kind="stable")
+    counts = np.bincount(keys, minlength=num_keys)
+    offsets = np.zeros(num_keys + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return order, offsets
+
+
+class _CsrMap(object):
+    """Read-only ``id -> list`` mapping over CSR arrays, standing in for the
+    ``cat_img_map`` / ``vidToImgs`` dicts of the json apis."""
+
+    def __init__(self, keys, offsets, values):
+        self._keys = keys
+        self._key_order = np.argsort(keys, kind="stable")
+        self._offsets = offsets
+        self._values = values
+
+    def _row(self, key):
+        pos = np.searchsorted(self._keys, key, sorter=self._key_order)
+        if pos >= len(self._keys) or self._keys[self._key_order[pos]] != key:
+            raise KeyError(key)
+        return self._key_order[pos]
+
+    def __contains__(self, key):
+        try:
+            self._row(key)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return self._values[start:end].tolist()
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class AnnotationStore(object):
+    """Annotations of a COCO/LVIS/TAO style json file backed by memory-mapped
+    numpy arrays.
+
+    Use :meth:`compile` once (or :meth:`from_ann_file`, which compiles on
+    demand) and open the resulting directory in every process.
+
+    Args:
+        store_dir (str): Directory written by :meth:`compile`.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != STORE_VERSION:
+            raise ValueError(
+                f"annotation store {store_dir} has version "
+                f"{self.meta.get('version')}, expected {STORE_VERSION}"
+            )
+        arrays = {}
+        for name in self.meta["arrays"]:
+            arrays[name] = np.load(
+                os.path.join(store_dir, name + ".npy"), mmap_mode="r"
+            )
+        self.arrays = arrays
+
+        # categories are tiny, keep them as the json apis do
+        self.dataset = dict(categories=self.meta["categories"])
+        self.cats = {cat["id"]: cat for cat in self.meta["categories"]}
+
+        self._img_order = np.argsort(arrays["img_id"], kind="stable")
+        self._ann_order = np.argsort(arrays["ann_id"], kind="stable")
+        self.cat_img_map = _CsrMap(
+            arrays["cat_id"], arrays["cat_img_offsets"], arrays["cat_img_ids"]
+        )
+        self.vid_img_map = _CsrMap(
+            arrays["vid_id"], arrays["vid_img_offsets"], arrays["vid_img_ids"]
+        )
+
+    @staticmethod
+    def compile(ann_file, store_dir):
+        """Parse ``ann_file`` once and write the flat arrays to ``store_dir``.
+
+        The arrays are written to a temporary directory that is renamed into
+        place, so readers never observe a half-written store, and a valid store
+        that another process finished in the meantime is kept rather than
+        replaced. Replacing a stale store is not safe against processes that
+        are opening it, so compile each store from a single process;
+        :meth:`from_ann_file` does so in distributed runs.
+        """
+        with open(ann_file) as f:
+            dataset = json.load(f)
+        images = dataset.get("images", [])
+        anns = dataset.get("annotations", [])
+        cats = dataset.get("categories", [])
+        videos = dataset.get("videos", [])
+
+        arrays = {}
+        img_id = np.array([img["id"] for img in images], dtype=np.int64)
+        arrays["img_id"] = img_id
+        arrays["img_width"] = np.array(
+            [img.get("width", -1) for img in images], dtype=np.int64
+        )
+        arrays["img_height"] = np.array(
+            [img.get("height", -1) for img in images], dtype=np.int64
+        )
+        arrays["img_video_id"] = np.array(
+            [img.get("video_id", -1) for img in images], dtype=np.int64
+        )
+        arrays["img_frame_id"] = np.array(
+            [img.get("frame_id", -1) for img in images], dtype=np.int64
+        )
+        for field in _IMG_STR_FIELDS:
+            blob, offsets, present = _encode_strings(
+                [img.get(field) for img in images]
+            )
+            arrays[f"img_{field}_blob"] = blob
+            arrays[f"img_{field}_offsets"] = offsets
+            arrays[f"img_{field}_present"] = present
+
+        # annotations grouped by image row, keeping json order within an image
+        img_row = {i: row for row, i in enumerate(img_id.tolist())}
+        ann_img_row = np.array(
+            [img_row[ann["image_id"]] for ann in anns], dtype=np.int64
+        )
+        order, img_ann_offsets = _csr(ann_img_row, len(images))
+        anns = [anns[i] for i in order.tolist()]
+        arrays["img_ann_offsets"] = img_ann_offsets
+        arrays["ann_id"] = np.array([ann["id"] for ann in anns], dtype=np.int64)
+        arrays["ann_image_id"] = img_id[ann_img_row[order]]
+        arrays["ann_category_id"] = np.array(
+            [ann["category_id"] for ann in anns], dtype=np.int64
+        )
+        arrays["ann_bbox"] = np.array(
+            [ann["bbox"] for ann in anns], dtype=np.float64
+        ).reshape(-1, 4)
+        arrays["ann_area"] = np.array(
+            [ann.get("area", 0) for ann in anns], dtype=np.float64
+        )
+        arrays["ann_instance_id"] = np.array(
+            [ann.get("instance_id", -1) for ann in anns], dtype=np.int64
+        )
+        flags = np.zeros(len(anns), dtype=np.uint8)
+        for i, ann in enumerate(anns):
+            flags[i] = (
+                (_ISCROWD if ann.get("iscrowd", False) else 0)
+                | (_IGNORE if ann.get("ignore", False) else 0)
+                | (_CLEAR if ann.get("clear", False) else 0)
+                | (_HAS_INSTANCE_ID if "instance_id" in ann else 0)
+            )
+        arrays["ann_flags"] = flags
+
+        # unique image ids of every category, in categories order
+        cat_id = np.array([cat["id"] for cat in cats], dtype=np.int64)
+        arrays["cat_id"] = cat_id
+        cat_row = {c: row for row, c in enumerate(cat_id.tolist())}
+        ann_cat_row = np.array(
+            [cat_row.get(c, -1) for c in arrays["ann_category_id"].tolist()],
+            dtype=np.int64,
+        )
+        pairs = np.unique(
+            np.stack([ann_cat_row, arrays["ann_image_id"]], axis=1), axis=0
+        )
+        pairs = pairs[pairs[:, 0] >= 0]
+        _, arrays["cat_img_offsets"] = _csr(pairs[:, 0], len(cats))
+        arrays["cat_img_ids"] = pairs[:, 1].copy()
+
+        # image ids of every video, ordered by frame
+        vid_id = np.array([vid["id"] for vid in videos], dtype=np.int64)
+        arrays["vid_id"] = vid_id
+        vid_row = {v: row for row, v in enumerate(vid_id.tolist())}
+        img_vid_row = np.array(
+            [vid_row.get(v, -1) for v in arrays["img_video_id"].tolist()],
+            dtype=np.int64,
+        )
+        keep = np.nonzero(img_vid_row >= 0)[0]
+        frame_order = keep[
+            np.lexsort((arrays["img_frame_id"][keep], img_vid_row[keep]))
+        ]
+        _, arrays["vid_img_offsets"] = _csr(img_vid_row[keep], len(videos))
+        arrays["vid_img_ids"] = img_id[frame_order]
+
+        stat = os.stat(ann_file)
+        meta = dict(
+            version=STORE_VERSION,
+            ann_file=os.path.abspath(ann_file),
+            ann_file_size=stat.st_size,
+            ann_file_mtime=stat.st_mtime,
+            categories=cats,
+            arrays=sorted(arrays),
+        )
+
+        parent = os.path.dirname(os.path.abspath(store_dir))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".ann_store_")
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), array)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        if os.path.isdir(store_dir) and not AnnotationStore.is_valid(
+            store_dir, ann_file
+        ):
+            # move the stale store aside in one rename before dropping it
+            stale_dir = tempfile.mkdtemp(dir=parent, prefix=".ann_store_stale_")
+            os.rename(store_dir, os.path.join(stale_dir, "store"))
+            shutil.rmtree(stale_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # another process renamed its store into place first, keep it
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not AnnotationStore.is_valid(store_dir, ann_file):
+                raise
+        return store_dir
+
+    @classmethod
+    def from_ann_file(cls, ann_file, store_dir=None):
+        """Open the store compiled from ``ann_file``, compiling it first if it
+        is missing or older than the json file.
+
+        In distributed runs rank 0 compiles the store while the other ranks
+        wait at a barrier. The local rank 0 of every other node then compiles
+        it once more if ``store_dir`` is on node-local storage.
+
+        Args:
+            ann_file (str): Path of the json annotation file.
+            store_dir (str | None): Directory of the store. Defaults to the
+                json path with its extension replaced by ``.store``, e.g.
+                ``data/lvis_clear_75_60.store`` for
+                ``data/lvis_clear_75_60.json``.
+        """
+        if store_dir is None or store_dir is True:
+            store_dir = os.path.splitext(ann_file)[0] + ".store"
+        if dist.is_available() and dist.is_initialized():
+            rank = dist.get_rank()
+            if rank == 0:
+                cls._compile_if_invalid(ann_file, store_dir)
+            dist.barrier()
+            if rank != 0 and int(os.environ.get("LOCAL_RANK", 0)) == 0:
+                cls._compile_if_invalid(ann_file, store_dir)
+            dist.barrier()
+        else:
+            cls._compile_if_invalid(ann_file, store_dir)
+        return cls(store_dir)
+
+    @classmethod
+    def _compile_if_invalid(cls, ann_file, store_dir):
+        if not cls.is_valid(store_dir, ann_file):
+            print(f"compiling annotation store {store_dir} ...")
+            cls.compile(ann_file, store_dir)
+
+    @staticmethod
+    def is_valid(store_dir, ann_file=None):
+        meta_file = os.path.join(store_dir, "meta.json")
+        if not os.path.isfile(meta_file):
+            return False
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            return False
+        if ann_file is not None and os.path.isfile(ann_file):
+            stat = os.stat(ann_file)
+            if (meta["ann_file_size"], meta["ann_file_mtime"]) != (
+                stat.st_size,
+                stat.st_mtime,
+            ):
+                return False
+        return True
+
+    def _rows(self, ids, keys, order):
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if len(keys) == 0:
+            if len(ids):
+                raise KeyError(ids[0].item())
+            return ids
+        pos = np.searchsorted(keys, ids, sorter=order)
+        pos = np.minimum(pos, len(keys) - 1)
+        rows = order[pos]
+        missing = keys[rows] != ids
+        if missing.any():
+            raise KeyError(ids[missing][0].item())
+        return rows
+
+    def _img_rows(self, img_ids):
+        return self._rows(img_ids, self.arrays["img_id"], self._img_order)
+
+    def _ann_rows(self, ann_ids):
+        return self._rows(ann_ids, self.arrays["ann_id"], self._ann_order)
+
+    def _img_str(self, field, row):
+        arrays = self.arrays
+        if not arrays[f"img_{field}_present"][row]:
+            return None
+        offsets = arrays[f"img_{field}_offsets"]
+        blob = arrays[f"img_{field}_blob"][offsets[row] : offsets[row + 1]]
+        return blob.tobytes().decode("utf-8")
+
+    def get_cat_ids(self, cat_names=None):
+        """Category ids in json order, optionally filtered by name."""
+        if not cat_names:
+            return [cat["id"] for cat in self.meta["categories"]]
+        cat_names = set(cat_names)
+        return [
+            cat["id"] for cat in self.meta["categories"] if cat["name"] in cat_names
+        ]
+
+    def get_img_ids(self):
+        return self.arrays["img_id"].tolist()
+
+    def get_img_ids_with_anns(self):
+        """Ids of the images that have at least one annotation."""
+        counts = np.diff(self.arrays["img_ann_offsets"])
+        return self.arrays["img_id"][counts > 0].tolist()
+
+    def get_vid_ids(self):
+        return self.arrays["vid_id"].tolist()
+
+    def get_img_ids_from_vid(self, vid_id):
+        return self.vid_img_map[vid_id]
+
+    def get_ann_ids(self, img_ids=None, cat_ids=None):
+        """Annotation ids of ``img_ids`` in json order, optionally filtered by
+        category. As in the COCO api, ``cat_ids`` does not also require
+        ``0 < area`` the way LVIS ``get_ann_ids`` does; the datasets drop such
+        annotations when parsing them."""
+        arrays = self.arrays
+        if img_ids is None:
+            rows = np.arange(len(arrays["ann_id"]))
+        else:
+            offsets = arrays["img_ann_offsets"]
+            img_rows = self._img_rows(list(img_ids))
+            rows = np.concatenate(
+                [np.arange(offsets[r], offsets[r + 1]) for r in img_rows]
+                + [np.zeros(0, dtype=np.int64)]
+            )
+        if cat_ids:
+            cat_ids = np.fromiter(cat_ids, dtype=np.int64)
+            rows = rows[np.isin(arrays["ann_category_id"][rows], cat_ids)]
+        return arrays["ann_id"][rows].tolist()
+
+    def load_anns(self, ids):
+        arrays = self.arrays
+        rows = self._ann_rows(ids)
+        ann_id = arrays["ann_id"][rows].tolist()
+        image_id = arrays["ann_image_id"][rows].tolist()
+        category_id = arrays["ann_category_id"][rows].tolist()
+        bbox = arrays["ann_bbox"][rows].tolist()
+        area = arrays["ann_area"][rows].tolist()
+        instance_id = arrays["ann_instance_id"][rows].tolist()
+        flags = arrays["ann_flags"][rows].tolist()
+        anns = []
+        for i in range(len(ann_id)):
+            ann = dict(
+                id=ann_id[i],
+                image_id=image_id[i],
+                category_id=category_id[i],
+                bbox=bbox[i],
+                area=area[i],
+                iscrowd=int(bool(flags[i] & _ISCROWD)),
+                ignore=bool(flags[i] & _IGNORE),
+                clear=bool(flags[i] & _CLEAR),
+            )
+            if flags[i] & _HAS_INSTANCE_ID:
+                ann["instance_id"] = instance_id[i]
+            anns.append(ann)
+        return anns
+
+    def load_imgs(self, ids):
+        arrays = self.arrays
+        imgs = []
+        for row in self._img_rows(ids).tolist():
+            img = dict(
+                id=int(arrays["img_id"][row]),
+                width=int(arrays["img_width"][row]),
+                height=int(arrays["img_height"][row]),
+            )
+            for key in ("video_id", "frame_id"):
+                value = int(arrays[f"img_{key}"][row])
+                if value >= 0:
+                    img[key] = value
+            for field in _IMG_STR_FIELDS:
+                value = self._img_str(field, row)
+                if value is not None:
+                    img[field] = value
+            imgs.append(img)
+        return imgs
+
+    # camelCase alias used by ``ref_img_sampling``
+    loadImgs = load_imgs
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser("Compile a json annotation file")
+    parser.add_argument("ann_file")
+    parser.add_argument("store_dir", nargs="?", default=None)
+    cli_args = parser.parse_args()
+    store = AnnotationStore.from_ann_file(cli_args.ann_file, cli_args.store_dir)
+    print(f"{store.store_dir}: {len(store.arrays['img_id'])} images, "
+          f"{len(store.arrays['ann_id'])} annotations")
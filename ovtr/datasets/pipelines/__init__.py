@@ -1,7 +1,8 @@
 from .formatting import SeqCollect, SeqDefaultFormatBundle, VideoCollect
 from .h5backend import HDF5Backend
 from .loading import LoadMultiImagesFromFile, SeqLoadAnnotations
-from .transforms import (SeqNormalize, SeqPad, SeqPhotoMetricDistortion,
+from .transforms import (ClipNormalizePad, SeqDeferredNormalizePad,
+                         SeqNormalize, SeqPad, SeqPhotoMetricDistortion,
                          SeqRandomCrop, SeqRandomFlip, SeqResize)
 
 __all__ = [
@@ -11,6 +12,8 @@ __all__ = [
     "SeqNormalize",
     "SeqRandomFlip",
     "SeqPad",
+    "SeqDeferredNormalizePad",
+    "ClipNormalizePad",
     "SeqDefaultFormatBundle",
     "SeqCollect",
     "VideoCollect",
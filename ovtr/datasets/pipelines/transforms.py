@@ -190,6 +190,116 @@ class SeqPad(Pad):
         return outs
 
 
+@PIPELINES.register_module()
+class SeqDeferredNormalizePad(object):
+    """Replacement for ``SeqNormalize`` + ``SeqPad`` that leaves the frames as
+    uint8 and only records ``img_norm_cfg`` and ``pad_shape``.
+
+    ``SeqDefaultFormatBundle`` then yields uint8 CHW tensors, so the workers
+    skip the per-frame float conversion and the frames travel to the device
+    at a quarter of the size. :class:`ClipNormalizePad` applies the deferred
+    normalize and pad to all frames of a batch at once.
+
+    Args:
+        mean (sequence): Mean values of 3 channels.
+        std (sequence): Std values of 3 channels.
+        to_rgb (bool): Whether to convert the image from BGR to RGB.
+        size_divisor (int, optional): The divisor of padded size.
+        pad_val (float, optional): Padding value, applied after
+            normalization as ``SeqPad`` does. Default: 0.
+    """
+
+    def __init__(self, mean, std, to_rgb=True, size_divisor=None, pad_val=0):
+        self.mean = np.array(mean, dtype=np.float32)
+        self.std = np.array(std, dtype=np.float32)
+        self.to_rgb = to_rgb
+        self.size_divisor = size_divisor
+        self.pad_val = pad_val
+
+    def __call__(self, results):
+        for _results in results:
+            h, w = _results["img"].shape[:2]
+            if self.size_divisor is not None:
+                h = int(np.ceil(h / self.size_divisor)) * self.size_divisor
+                w = int(np.ceil(w / self.size_divisor)) * self.size_divisor
+            _results["img_norm_cfg"] = dict(
+                mean=self.mean, std=self.std, to_rgb=self.to_rgb
+            )
+            _results["pad_shape"] = (h, w) + _results["img"].shape[2:]
+            _results["pad_fixed_size"] = None
+            _results["pad_size_divisor"] = self.size_divisor
+        return results
+
+    def batch_transform(self):
+        """The :class:`ClipNormalizePad` completing this transform."""
+        return ClipNormalizePad(
+            self.mean, self.std, self.to_rgb, self.size_divisor, self.pad_val
+        )
+
+    def __repr__(self):
+        repr_str = self.__class__.__name__
+        repr_str += f"(mean={self.mean}, std={self.std}, to_rgb={self.to_rgb}, "
+        repr_str += f"size_divisor={self.size_divisor}, pad_val={self.pad_val})"
+        return repr_str
+
+
+class ClipNormalizePad(object):
+    """Normalize and pad the uint8 frames left by ``SeqDeferredNormalizePad``.
+
+    Frames of equal size are stacked and processed in one call, on whatever
+    device they live on (normally after the host-to-device copy). The result
+    matches ``SeqNormalize`` followed by ``SeqPad`` up to float rounding.
+    """
+
+    def __init__(self, mean, std, to_rgb=True, size_divisor=None, pad_val=0):
+        self.mean = torch.as_tensor(np.asarray(mean, dtype=np.float32))
+        # mmcv.imnormalize multiplies by the reciprocal of std
+        self.stdinv = torch.as_tensor(
+            1 / np.asarray(std, dtype=np.float64)
+        ).float()
+        self.to_rgb = to_rgb
+        self.size_divisor = size_divisor
+        self.pad_val = pad_val
+
+    def _normalize_pad(self, imgs):
+        imgs = imgs.float()
+        if self.to_rgb:
+            imgs = imgs.flip(1)
+        mean = self.mean.to(imgs.device).view(1, -1, 1, 1)
+        stdinv = self.stdinv.to(imgs.device).view(1, -1, 1, 1)
+        imgs = (imgs - mean) * stdinv
+        if self.size_divisor is not None:
+            h, w = imgs.shape[-2:]
+            pad_h = int(math.ceil(h / self.size_divisor)) * self.size_divisor - h
+            pad_w = int(math.ceil(w / self.size_divisor)) * self.size_divisor - w
+            if pad_h or pad_w:
+                imgs = torch.nn.functional.pad(
+                    imgs, (0, pad_w, 0, pad_h), value=self.pad_val
+                )
+        return imgs
+
+    def __call__(self, imgs):
+        """
+        Args:
+            imgs (list[Tensor] | list[list[Tensor]]): uint8 (3, H, W) frames,
+                optionally nested per clip as produced by ``mot_collate_fn``.
+
+        Returns:
+            The same structure with float32 normalized and padded frames.
+        """
+        if len(imgs) > 0 and isinstance(imgs[0], (list, tuple)):
+            return [self(clip) for clip in imgs]
+        groups = dict()
+        for i, img in enumerate(imgs):
+            groups.setdefault(tuple(img.shape), []).append(i)
+        outs = [None] * len(imgs)
+        for inds in groups.values():
+            batch = self._normalize_pad(torch.stack([imgs[i] for i in inds]))
+            for i, img in zip(inds, batch):
+                outs[i] = img
+        return outs
+
+
 @PIPELINES.register_module()
 class SeqRandomCrop(object):
     def __init__(
@@ -8,9 +8,12 @@
 
 import os
 import math
+from collections import defaultdict
+
+import numpy as np
 import torch
 import torch.distributed as dist
-from torch.utils.data.sampler import Sampler
+from torch.utils.data.sampler import BatchSampler, Sampler
 
 
 class DistributedSampler(Sampler):
@@ -137,3 +140,96 @@ class NodeDistributedSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+def get_aspect_ratio_group_ids(dataset):
+    """Aspect ratio group (1 for landscape, 0 for portrait) of every index the
+    samplers draw from ``dataset``.
+
+    Uses the ``flag`` computed by the mmdet dataset from the original image
+    size and follows ``repeat_indices`` when the dataset over-samples images.
+    """
+    flag = getattr(dataset, 'flag', None)
+    if flag is None:
+        return np.zeros(len(dataset), dtype=np.int64)
+    flag = np.asarray(flag, dtype=np.int64)
+    repeat_indices = getattr(dataset, 'repeat_indices', None)
+    if repeat_indices is not None:
+        flag = flag[np.asarray(repeat_indices, dtype=np.int64)]
+    assert len(flag) == len(dataset)
+    return flag
+
+
+class AspectRatioGroupedBatchSampler(BatchSampler):
+    """Batch sampler that only puts indices of the same aspect ratio group
+    into a batch, so that ``nested_tensor_from_tensor_list`` pads portrait and
+    landscape images to a common size less often.
+
+    It wraps any index sampler (``RandomSampler``, ``DistributedSampler``,
+    ``NodeDistributedSampler``) and keeps its order within each group, so the
+    per-rank split and the epoch seeding of the wrapped sampler are preserved.
+    Indices left over in partially filled groups at the end of the epoch are
+    batched together, which keeps ``len`` equal to that of ``BatchSampler`` on
+    every rank.
+    Arguments:
+        sampler: Base sampler yielding dataset indices.
+        group_ids: Group id of every dataset index, see
+            :func:`get_aspect_ratio_group_ids`.
+        batch_size: Size of mini-batch.
+        drop_last: Drop the last incomplete batch.
+    """
+
+    def __init__(self, sampler, group_ids, batch_size, drop_last=True):
+        super().__init__(sampler, batch_size, drop_last)
+        self.group_ids = np.asarray(group_ids)
+
+    def __iter__(self):
+        buckets = defaultdict(list)
+        for idx in self.sampler:
+            bucket = buckets[self.group_ids[idx]]
+            bucket.append(idx)
+            if len(bucket) == self.batch_size:
+                yield bucket[:]
+                del bucket[:]
+        leftover = [idx for bucket in buckets.values() for idx in bucket]
+        for i in range(0, len(leftover), self.batch_size):
+            batch = leftover[i:i + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                yield batch
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
+class ResumableBatchSampler(BatchSampler):
+    """Wraps a batch sampler so that an epoch can be resumed mid-way.
+
+    The wrapped sampler must produce the same batches for a given epoch
+    (``DistributedSampler`` / ``NodeDistributedSampler`` seed on the epoch).
+    Setting ``start_iter`` skips the batches already trained on; it only
+    applies to the next pass, later epochs start from the first batch again.
+    Arguments:
+        batch_sampler: Batch sampler to wrap.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.start_iter = 0
+
+    def __iter__(self):
+        try:
+            for i, batch in enumerate(self.batch_sampler):
+                if i >= self.start_iter:
+                    yield batch
+        finally:
+            self.start_iter = 0
+
+    def __len__(self):
+        return len(self.batch_sampler) - self.start_iter
+
+    def set_epoch(self, epoch):
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+        elif hasattr(self.batch_sampler.sampler, 'set_epoch'):
+            self.batch_sampler.sampler.set_epoch(epoch)
@@ -0,0 +1,57 @@
+import operator
+import pickle
+
+import numpy as np
+
+
+class SerializedList(object):
+    """Read-only list of picklable objects kept in one numpy byte buffer.
+
+    DataLoader workers share the dataset with the main process through fork.
+    Reading an element of a plain list of dicts updates refcounts on its
+    pages, so every worker gradually copies the whole list and RSS grows over
+    an epoch. Here the elements live pickled in a single uint8 array plus an
+    int64 offset array, which hold no Python objects; each access decodes a
+    fresh copy of the element.
+
+    Args:
+        items (Iterable): Objects to store.
+    """
+
+    def __init__(self, items):
+        blobs = [
+            np.frombuffer(
+                pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8
+            )
+            for item in items
+        ]
+        self._ends = np.cumsum([len(b) for b in blobs], dtype=np.int64)
+        if blobs:
+            self._buffer = np.concatenate(blobs)
+        else:
+            self._buffer = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        idx = operator.index(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("SerializedList index out of range")
+        start = 0 if idx == 0 else int(self._ends[idx - 1])
+        end = int(self._ends[idx])
+        return pickle.loads(memoryview(self._buffer[start:end]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(len={len(self)}, "
+            f"nbytes={self._buffer.nbytes})"
+        )
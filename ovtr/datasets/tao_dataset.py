@@ -1,8 +1,8 @@
 import mmcv
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
-import pickle
 import tempfile
 import tqdm
 from lvis import LVIS, LVISEval, LVISResults
@@ -13,7 +13,7 @@ from .coco_video_dataset import CocoVideoDataset
 from .parsers import COCO, CocoVID
 
 
-def majority_vote(prediction):
+def majority_vote(prediction, progress=True):
 
     tid_res_mapping = {}
     for res in prediction:
@@ -29,7 +29,7 @@ def majority_vote(prediction):
 
     # change the majority
     class_by_majority_count_res = []
-    for tid, group in tqdm.tqdm(groued_df_pred_res):
+    for tid, group in tqdm.tqdm(groued_df_pred_res, disable=not progress):
         cid = group["category_id"].mode()[0]
         group["category_id"] = cid
         dict_list = group.to_dict("records")
@@ -60,7 +60,7 @@ class TaoDataset(CocoVideoDataset):
             list[dict]: Annotation info from COCO api.
         """
 
-        self.coco = COCO(ann_file)
+        self.coco = self._load_ann_api(ann_file, COCO)
         self.cat_ids = self.coco.get_cat_ids(cat_names=self.CLASSES)
         self.cat2label = {cat_id: i for i, cat_id in enumerate(self.cat_ids)}
         self.img_ids = self.coco.get_img_ids()
@@ -80,7 +80,7 @@ class TaoDataset(CocoVideoDataset):
         return data_infos
     
     def load_lvis_track_anns(self, ann_file):
-        self.lvis = LVIS(ann_file)
+        self.lvis = self._load_ann_api(ann_file, LVIS)
         self.cat_ids = self.lvis.get_cat_ids()
         self.cat2label = {cat_id: i for i, cat_id in enumerate(self.cat_ids)}
 
@@ -123,30 +123,10 @@ class TaoDataset(CocoVideoDataset):
     
     def _filter_imgs(self, min_size=32):
         """Filter images too small or without ground truths."""
-        valid_inds = []
-        # obtain images that contain annotation
-        ids_with_ann = set(_['image_id'] for _ in self.lvis.anns.values())
-        # obtain images that contain annotations of the required categories
-        ids_in_cat = set()
-        for i, class_id in enumerate(self.cat_ids):
-            ids_in_cat |= set(self.lvis.cat_img_map[class_id])
-        # merge the image id sets of the two conditions and use the merged set
-        # to filter out images if self.filter_empty_gt=True
-        ids_in_cat &= ids_with_ann
-
-        valid_img_ids = []
-        for i, img_info in enumerate(self.data_infos):
-            img_id = self.img_ids[i]
-            if self.filter_empty_gt and img_id not in ids_in_cat:
-                continue
-            if min(img_info['width'], img_info['height']) >= min_size:
-                valid_inds.append(i)
-                valid_img_ids.append(img_id)
-        self.img_ids = valid_img_ids
-        return valid_inds
+        return self._filter_imgs_by_api(self.lvis, min_size)
 
     def load_tao_anns(self, ann_file):
-        self.coco = CocoVID(ann_file)
+        self.coco = self._load_ann_api(ann_file, CocoVID)
         self.cat_ids = self.coco.get_cat_ids(cat_names=self.CLASSES)
         self.cat2label = {cat_id: i for i, cat_id in enumerate(self.cat_ids)}
 
@@ -188,30 +168,42 @@ class TaoDataset(CocoVideoDataset):
         max_track_id = 0
         print("Start format track json")
         for _img_infos, _results in tqdm.tqdm(zip(img_infos, results)):
-            track_ids = []
-            for img_info, result in zip(_img_infos, _results):
-                img_id = img_info["id"]
-                for label in range(len(result)):
-                    bboxes = result[label]
-                    for i in range(bboxes.shape[0]):
-                        data = dict()
-                        data["image_id"] = img_id
-                        data["bbox"] = self.xyxy2xywh(bboxes[i, 1:])
-                        data["score"] = float(bboxes[i][-1])
-                        if len(result) != len(self.cat_ids):
-                            data["category_id"] = label + 1
-                        else:
-                            data["category_id"] = self.cat_ids[label]
-                        data["video_id"] = img_info["video_id"]
-                        data["track_id"] = max_track_id + int(bboxes[i][0])
-                        track_ids.append(int(bboxes[i][0]))
-                        json_results.append(data)
-            track_ids = list(set(track_ids))
-            if track_ids:
-                max_track_id += max(track_ids) + 1
+            video_results, max_track_id = self._video_track2json(
+                _img_infos, _results, max_track_id)
+            json_results.extend(video_results)
 
         return json_results
 
+    def _video_track2json(self, img_infos, results, max_track_id):
+        """Convert the tracking results of one video to TAO json style.
+
+        Track ids are offset by max_track_id, returns the json results and the
+        offset for the next video.
+        """
+        json_results = []
+        track_ids = []
+        for img_info, result in zip(img_infos, results):
+            img_id = img_info["id"]
+            for label in range(len(result)):
+                bboxes = result[label]
+                for i in range(bboxes.shape[0]):
+                    data = dict()
+                    data["image_id"] = img_id
+                    data["bbox"] = self.xyxy2xywh(bboxes[i, 1:])
+                    data["score"] = float(bboxes[i][-1])
+                    if len(result) != len(self.cat_ids):
+                        data["category_id"] = label + 1
+                    else:
+                        data["category_id"] = self.cat_ids[label]
+                    data["video_id"] = img_info["video_id"]
+                    data["track_id"] = max_track_id + int(bboxes[i][0])
+                    track_ids.append(int(bboxes[i][0]))
+                    json_results.append(data)
+        track_ids = list(set(track_ids))
+        if track_ids:
+            max_track_id += max(track_ids) + 1
+        return json_results, max_track_id
+
     def _det2json(self, results):
         """Convert detection results to COCO json style."""
         json_results = []
@@ -284,6 +276,7 @@ class TaoDataset(CocoVideoDataset):
         logger=None,
         resfile_path=None,
         use_tao_metric=False,
+        gt_cache_folder=None,
     ):
 
         if isinstance(metric, list):
@@ -322,47 +315,13 @@ class TaoDataset(CocoVideoDataset):
         if "track" in metrics and not use_tao_metric:
             import teta
 
-            # Command line interface:
-            default_eval_config = teta.config.get_default_eval_config()
-            # print only combined since TrackMAP is undefined for per sequence breakdowns
-            default_eval_config["PRINT_ONLY_COMBINED"] = True
-            default_eval_config["DISPLAY_LESS_PROGRESS"] = True
-            default_eval_config["OUTPUT_TEM_RAW_DATA"] = True
-            default_eval_config["NUM_PARALLEL_CORES"] = 8
-            default_dataset_config = teta.config.get_default_dataset_config()
-            default_dataset_config["TRACKERS_TO_EVAL"] = ["OVTR"]
-            default_dataset_config["GT_FOLDER"] = self.ann_file
-            default_dataset_config["OUTPUT_FOLDER"] = resfile_path
-            default_dataset_config["TRACKER_SUB_FOLDER"] = os.path.join(
-                resfile_path, "tao_track.json"
-            )
-
+            default_eval_config, default_dataset_config = self._teta_configs(
+                resfile_path, os.path.join(resfile_path, "tao_track.json"), gt_cache_folder)
             evaluator = teta.Evaluator(default_eval_config)
             dataset_list = [teta.datasets.TAO(default_dataset_config)]
             print("Overall classes performance")
-            evaluator.evaluate(dataset_list, [teta.metrics.TETA()])
-
-            eval_results_path = os.path.join(
-                resfile_path, "OVTR", "teta_summary_results.pth"
-            )
-            eval_res = pickle.load(open(eval_results_path, "rb"))
-
-            base_class_synset = set(
-                [
-                    c["name"]
-                    for c in self.coco.dataset["categories"]
-                    if c["frequency"] != "r"
-                ]
-            )
-            novel_class_synset = set(
-                [
-                    c["name"]
-                    for c in self.coco.dataset["categories"]
-                    if c["frequency"] == "r"
-                ]
-            )
-
-            compute_teta_on_ovsetup(eval_res, base_class_synset, novel_class_synset)
+            output_res, _ = evaluator.evaluate(dataset_list, [teta.metrics.TETA()])
+            self._teta_ovsetup(output_res[dataset_list[0].get_name()]["OVTR"])
 
         if "bbox" in metrics:
             print_log("Evaluating detection results...", logger)
@@ -396,17 +355,126 @@ class TaoDataset(CocoVideoDataset):
         return eval_results
 
 
-def compute_teta_on_ovsetup(teta_res, base_class_names, novel_class_names):
-    if "COMBINED_SEQ" in teta_res:
-        teta_res = teta_res["COMBINED_SEQ"]
+    def _teta_configs(self, resfile_path, tracker_file, gt_cache_folder=None):
+        """Configs of the TETA evaluation of the tracker json at tracker_file.
+
+        The compiled GT is cached in gt_cache_folder, not cached if None.
+        """
+        import teta
+
+        # Command line interface:
+        default_eval_config = teta.config.get_default_eval_config()
+        # print only combined since TrackMAP is undefined for per sequence breakdowns
+        default_eval_config["PRINT_ONLY_COMBINED"] = True
+        default_eval_config["DISPLAY_LESS_PROGRESS"] = True
+        default_eval_config["OUTPUT_TEM_RAW_DATA"] = True
+        default_eval_config["NUM_PARALLEL_CORES"] = 8
+        default_dataset_config = teta.config.get_default_dataset_config()
+        default_dataset_config["TRACKERS_TO_EVAL"] = ["OVTR"]
+        default_dataset_config["GT_FOLDER"] = self.ann_file
+        default_dataset_config["OUTPUT_FOLDER"] = resfile_path
+        default_dataset_config["TRACKER_SUB_FOLDER"] = tracker_file
+        default_dataset_config["GT_CACHE_FOLDER"] = gt_cache_folder
+        return default_eval_config, default_dataset_config
+
+    def _teta_ovsetup(self, teta_summary):
+        """Print the TETA of the base and novel classes."""
+        base_class_synset = set(
+            [
+                c["name"]
+                for c in self.coco.dataset["categories"]
+                if c["frequency"] != "r"
+            ]
+        )
+        novel_class_synset = set(
+            [
+                c["name"]
+                for c in self.coco.dataset["categories"]
+                if c["frequency"] == "r"
+            ]
+        )
+
+        return compute_teta_on_ovsetup(
+            teta_summary, base_class_synset, novel_class_synset)
+
+
+class OnlineTETA(object):
+    """TETA evaluation of a TaoDataset run along with the inference.
+
+    The tracking results of each video are converted to TAO json style and
+    evaluated as soon as the video is done, in the TETA worker pool, while
+    the next videos are inferred. ``evaluate`` gives the same metrics as
+    ``TaoDataset.evaluate`` with ``metric="track"``, without reloading the
+    json of the whole dataset, and writes the same tao_track.json.
 
-    frequent_teta = []
-    rare_teta = []
-    for key in teta_res:
-        if key in base_class_names:
-            frequent_teta.append(np.array(teta_res[key]["TETA"][50]).astype(float))
-        elif key in novel_class_names:
-            rare_teta.append(np.array(teta_res[key]["TETA"][50]).astype(float))
+    It is created after the model is moved to CUDA, so the TETA workers are
+    started with forkserver (spawn where it is not available) instead of
+    being forked from this process.
+
+    Args:
+        dataset (TaoDataset): Dataset that is inferred, in its order.
+        resfile_path (str): Folder the TETA results are written to.
+        tcc (bool): Apply the track class majority vote, as format_results.
+        gt_cache_folder (str, optional): Folder the compiled TAO GT is cached
+            in, not cached if None.
+    """
+
+    def __init__(self, dataset, resfile_path, tcc=True, gt_cache_folder=None):
+        import teta
+
+        self.dataset = dataset
+        self.resfile_path = resfile_path
+        self.tcc = tcc
+        self.max_track_id = 0
+        self.track_results = []
+        os.makedirs(resfile_path, exist_ok=True)
+        eval_config, dataset_config = dataset._teta_configs(resfile_path, None, gt_cache_folder)
+        self.teta_dataset = teta.datasets.TAO(dataset_config)
+        self.seqid2seq = {v: k for k, v in self.teta_dataset.seq_name2seqid.items()}
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            start_method = "forkserver"
+        else:
+            start_method = "spawn"
+        self.evaluator = teta.OnlineEvaluator(
+            self.teta_dataset, [teta.metrics.TETA()], config=eval_config,
+            start_method=start_method)
+
+    def add_video(self, start, results):
+        """Add the track results of the video whose first frame is data_infos[start]."""
+        img_infos = self.dataset.data_infos[start:start + len(results)]
+        video_results, self.max_track_id = self.dataset._video_track2json(
+            img_infos, results, self.max_track_id)
+        if self.tcc and video_results:
+            video_results = majority_vote(video_results, progress=False)
+        seq = self.seqid2seq[img_infos[0]["video_id"]]
+        # copied for tao_track.json, without USE_PARALLEL the evaluator
+        # modifies the annotations it is given (area, merged categories)
+        self.track_results.extend(dict(ann) for ann in video_results)
+        self.evaluator.add_sequence(seq, video_results)
+
+    def evaluate(self):
+        # the track ids are unique over the videos, as in format_results
+        mmcv.dump(self.track_results, os.path.join(self.resfile_path, "tao_track.json"))
+        print("Overall classes performance")
+        output_res, _ = self.evaluator.finalize()
+        self.dataset._teta_ovsetup(output_res[self.teta_dataset.get_name()]["OVTR"])
+        return dict()
+
+
+def compute_teta_on_ovsetup(teta_summary, base_class_names, novel_class_names):
+    """Print and return the mean TETA50 summary of the base and novel classes.
+
+    teta_summary is the summary of teta.metrics.TETA.summary_results, as
+    returned by the evaluator and saved to teta_summary_results.npz.
+    """
+    seq = list(teta_summary["seqs"]).index("COMBINED_SEQ")
+    thr = list(teta_summary["thresholds"]).index(50)
+    teta_res = teta_summary["values"][seq, :, thr]
+    classes = teta_summary["classes"]
+    is_base = np.isin(classes, list(base_class_names))
+    is_novel = np.isin(classes, list(novel_class_names)) & ~is_base
+    frequent_teta = list(teta_res[is_base])
+    rare_teta = list(teta_res[is_novel])
 
     print("Base and Novel classes performance")
 
@@ -15,15 +15,17 @@ import cv2
 import os
 import sys
 import math
+from contextlib import nullcontext
 from typing import Iterable
 from util.list_LVIS import CLASSES
 import torch
+from torch.nn.parallel import DistributedDataParallel
 import util.misc as utils
 from util import box_ops
 from pathlib import Path
 from util.events import get_event_storage, TensorboardXWriter
 from util.plot_utils import draw_boxes, draw_ref_pts, image_hwc2chw
-from datasets.data_prefetcher import data_prefetcher, data_dict_to_cuda
+from datasets.data_prefetcher import data_prefetcher, mot_data_prefetcher
 
 
 def visualize(track_instances, filename):
@@ -52,56 +54,151 @@ def visualize(track_instances, filename):
             cv2.putText(img, str(obj_idxes.item()) + CLASSES[label] + "{:.2f}".format(score.item()), (c1[0], c1[1] + 3), 0, 0.5, [225, 255, 255], thickness=1, lineType=cv2.LINE_AA)
         cv2.imwrite(os.path.join(root, './data_vis_out', name), img)
 
+def clip_windows(num_frames: int, truncate_bptt: int = 0):
+    """Splits the frames of a clip into the windows of truncated backprop
+    through time, ``[(start, end), ...]``; a single window when
+    ``truncate_bptt`` is 0 or not shorter than the clip."""
+    if truncate_bptt <= 0 or truncate_bptt >= num_frames:
+        return [(0, num_frames)]
+    return [(start, min(start + truncate_bptt, num_frames)) for start in range(0, num_frames, truncate_bptt)]
+
+
 def train_one_epoch_mot(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
-                    device: torch.device, epoch: int, max_norm: float = 0, writer=None, amp: bool = False):
+                    device: torch.device, epoch: int, max_norm: float = 0, writer=None, amp: bool = False,
+                    batch_transform=None, scaler=None, amp_dtype: torch.dtype = torch.float16,
+                    start_step: int = 0, step_callback=None, accum_steps: int = 1, truncate_bptt: int = 0):
     model.train()
     criterion.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
-    metric_logger.add_meter('grad_norm', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
 
     storage = get_event_storage()
-    step = 0
+    # batches of this epoch already trained on before a mid-epoch resume
+    step = start_step
+
+    use_scaler = scaler is not None and scaler.is_enabled()
+    is_ddp = isinstance(model, DistributedDataParallel)
+    # with accum_steps > 1, or a clip split into truncate_bptt windows, the
+    # losses are summed over the samples and the gradients are normalized once
+    # at the update, by the total number of samples, as if the clips and
+    # windows were a single batch
+    num_steps = start_step + len(data_loader)
+    accum_num_samples = 0
+    normalize_at_update = False
+    optimizer.zero_grad()
 
-    for data_dict in metric_logger.log_every(data_loader, print_freq, header):
+    # the next clip is copied to the device (and normalized / padded by the
+    # deferred batch_transform) while the current one is trained on
+    prefetcher = mot_data_prefetcher(data_loader, device, batch_transform=batch_transform)
+    for data_dict in metric_logger.log_every(prefetcher, print_freq, header):
         filename = data_dict.pop('filename') # for visualization
-        data_dict = data_dict_to_cuda(data_dict, device)
-        outputs = model(data_dict)
+        is_update = (step + 1) % accum_steps == 0 or step + 1 == num_steps
+        # each window is run and backpropagated on its own, the detached track
+        # states are carried to the next one, so only the activations of one
+        # window are kept at a time
+        windows = clip_windows(len(data_dict['imgs']), truncate_bptt)
+        normalize = accum_steps == 1 and len(windows) == 1
+        weight_dict = criterion.weight_dict
+        loss_dict_reduced = {}
+        loss_is_finite = True
+        state = None
+        for window_index, (frame_start, frame_end) in enumerate(windows):
+            is_sync = is_update and window_index == len(windows) - 1
+            sync_context = model.no_sync() if is_ddp and not is_sync else nullcontext()
 
-        track_instances = outputs.pop('track_instances')
-        # visualize(track_instances, filename)
+            with sync_context:
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp):
+                    if len(windows) == 1:
+                        outputs = model(data_dict)
+                    else:
+                        outputs = model(data_dict, frame_range=(frame_start, frame_end), state=state)
+                        state = outputs.pop('state')
 
-        loss_dict = criterion(outputs)
-        weight_dict = criterion.weight_dict
-        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+                    track_instances = outputs.pop('track_instances')
+                    # visualize(track_instances, filename)
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss_dict_reduced_scaled = {k: v * weight_dict[k]
-                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
+                    loss_dict = criterion(outputs, normalize=normalize)
+                if writer is not None and window_index == 0:
+                    # the predictions of the first frame, without their graph
+                    vis_outputs = {k: outputs[k][0].detach() for k in ('pred_boxes', 'pred_logits')}
+                losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+                if is_ddp and is_sync and not model.find_unused_parameters:
+                    if len(windows) == 1:
+                        # only the branches the model declares as conditional, any
+                        # other unused parameter still raises DDP's error
+                        zero_loss_parameters = model.module.conditional_parameters()
+                    else:
+                        # the gradients of the earlier windows are only reduced by
+                        # this backward, it has to reach the parameters they used
+                        zero_loss_parameters = [p for p in model.parameters() if p.requires_grad]
+                    losses = losses + utils.parameters_zero_loss(zero_loss_parameters)
 
-        loss_value = losses_reduced_scaled.item()
+                # reduce losses over all GPUs for logging purposes
+                window_loss_dict_reduced = utils.reduce_dict({k: v.detach() for k, v in loss_dict.items()})
+                window_loss_value = float(sum(v * weight_dict[k] for k, v in window_loss_dict_reduced.items()
+                                              if k in weight_dict))
+                if not math.isfinite(window_loss_value):
+                    loss_is_finite = False
+                    if not use_scaler:
+                        print("Loss is {}, stopping training".format(window_loss_value))
+                        print(window_loss_dict_reduced)
+                        sys.exit(1)
+                    # an fp16 overflow: the backward still runs so that the scaler
+                    # finds the inf gradients, skips this update and lowers its scale
+                    print("Loss is {} at step {}, skipping the update".format(window_loss_value, step))
+                    print(window_loss_dict_reduced)
+                # the losses of the frames of each window have keys of their own
+                loss_dict_reduced.update(window_loss_dict_reduced)
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
+                if use_scaler:
+                    scaler.scale(losses).backward()
+                else:
+                    losses.backward()
+            # nothing may keep the graph of the window alive
+            del outputs, track_instances, loss_dict, losses
 
-        optimizer.zero_grad()
-        losses.backward()
-        if max_norm > 0:
-            grad_total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-        else:
-            grad_total_norm = utils.get_total_grad_norm(model.parameters(), max_norm) 
-        optimizer.step()
+        if not normalize:
+            accum_num_samples = accum_num_samples + criterion.num_samples
+            normalize_at_update = True
+            # normalized per clip for logging only
+            num_boxes = criterion.get_num_boxes(criterion.num_samples)
+            loss_dict_reduced = {k: v / num_boxes for k, v in loss_dict_reduced.items()}
+        loss_dict_reduced_scaled = {k: v * weight_dict[k]
+                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
+        loss_value = sum(loss_dict_reduced_scaled.values()).item()
 
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled)
+        if loss_is_finite:
+            metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
-        metric_logger.update(grad_norm=grad_total_norm)
+
+        if is_update:
+            if use_scaler:
+                # clip and log the true gradients, not the scaled ones
+                scaler.unscale_(optimizer)
+            if normalize_at_update:
+                num_boxes = criterion.get_num_boxes(accum_num_samples)
+                for p in model.parameters():
+                    if p.grad is not None:
+                        p.grad.div_(num_boxes)
+                accum_num_samples = 0
+                normalize_at_update = False
+            if max_norm > 0:
+                grad_total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+            else:
+                grad_total_norm = utils.get_total_grad_norm(model.parameters(), max_norm) 
+            if use_scaler:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
+            # added on the first update, the steps before it have no gradient norm to log
+            if 'grad_norm' not in metric_logger.meters:
+                metric_logger.add_meter('grad_norm', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
+            metric_logger.update(grad_norm=grad_total_norm)
 
         # gather the stats from all processes
         if writer is not None:
@@ -112,8 +209,8 @@ def train_one_epoch_mot(model: torch.nn.Module, criterion: torch.nn.Module,
                 gt_boxes[:, ::2] *= w
                 gt_boxes[:, 1::2] *= h
                 vis_img = draw_boxes(img, gt_boxes, color=(0, 1, 0))
-                dt_boxes = outputs['pred_boxes'][0].detach().clone()
-                dt_scores = outputs['pred_logits'][0].detach().clone().sigmoid().max(dim=-1)[0]
+                dt_boxes = vis_outputs['pred_boxes'].clone()
+                dt_scores = vis_outputs['pred_logits'].clone().sigmoid().max(dim=-1)[0]
                 keep = dt_scores > 0.4
                 dt_boxes = dt_boxes[keep]
                 dt_scores = dt_scores[keep]
@@ -124,13 +221,16 @@ def train_one_epoch_mot(model: torch.nn.Module, criterion: torch.nn.Module,
                 vis_img = draw_boxes(vis_img, dt_boxes, color=(0, 0, 1), texts=[str(score.item()) for score in dt_scores])
                 vis_img = image_hwc2chw(vis_img)
                 storage.put_image('image_with_gt', vis_img)
-            storage.put_scalar("loss", loss_value)
-            for loss_name, loss_value in loss_dict_reduced_scaled.items():
-                storage.put_scalar(loss_name, loss_value.item())
+            if loss_is_finite:
+                storage.put_scalar("loss", loss_value)
+                for loss_name, loss_value in loss_dict_reduced_scaled.items():
+                    storage.put_scalar(loss_name, loss_value.item())
             writer.write()
         if storage is not None:
             storage.step()
         step += 1
+        if step_callback is not None and is_update:
+            step_callback(step)
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
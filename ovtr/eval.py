@@ -37,7 +37,8 @@ from detectron2.structures import Instances
 from datasets import build_dataset
 import datasets.samplers as samplers
 import util.misc as utils
-from datasets.data_prefetcher import data_dict_to_cuda
+from datasets.data_prefetcher import mot_data_prefetcher
+from datasets.tao_dataset import OnlineTETA
 from util.list_LVIS import CLASSES, novel_list_ori, COLORS
 from mmcv.runner import get_dist_info
 np.random.seed(2024)
@@ -377,34 +378,52 @@ def eval(args, cfg):
     tracker.result_path_track = os.path.abspath(tracker.result_path_track)
     os.makedirs((tracker.result_path_track), exist_ok = True)
     track_instances = None
+    resfile_path = tracker.result_path_track
+
+    kwargs = {} if args.eval_options is None else args.eval_options
+    eval_kwargs = cfg.get('evaluation', {}).copy()
+    # hard-code way to remove EvalHook args
+    for key in ['interval', 'tmpdir', 'start', 'gpu_collect']:
+        eval_kwargs.pop(key, None)
+    eval_kwargs.update(dict(metric=args.eval, **kwargs))
+    eval_kwargs.resfile_path = resfile_path
+    eval_kwargs.gt_cache_folder = args.teta_gt_cache
+
+    online_teta = None
+    if args.online_teta:
+        assert not args.distributed, "online TETA needs all the videos on one process"
+        assert list(args.eval) == ['track'], "online TETA only evaluates the track metric"
+        # each video is evaluated as soon as its last frame is inferred
+        online_teta = OnlineTETA(dataset_val, eval_kwargs.resfile_path, gt_cache_folder=args.teta_gt_cache)
+    video_start = 0
 
     with torch.no_grad():
-        for i, data_dict in enumerate(tqdm(data_loader_val)):   
+        prefetcher = mot_data_prefetcher(data_loader_val, model.text_embeddings.device)
+        for i, data_dict in enumerate(tqdm(prefetcher)):   
             info = data_dict.pop('info')[0]
             file_path = data_dict.pop('file_path')[0]
-            data_dict = data_dict_to_cuda(data_dict, device=model.text_embeddings.device)
+            if online_teta is not None and info[0] == 0 and i > 0:
+                online_teta.add_video(video_start, tracker.results['track_results'][video_start:i])
+                video_start = i
             track_instances = tracker.detect(vis=args.vis, data=data_dict, track_instances=track_instances, info=info, 
                                              prob_threshold=args.score_thresh, score_threshold=args.score_thresh, filter_score_thresh=args.filter_score_thresh, 
                                              miss_tolerance=args.miss_tolerance, maximum_quantity=args.maximum_quantity, area_threshold=1, ious_thresh=args.ious_thresh,
                                              file_path=file_path)
 
-    resfile_path = tracker.result_path_track
     print('Inference completed')
 
     print('Start TETA')
+    if online_teta is not None:
+        if video_start < len(tracker.results['track_results']):
+            online_teta.add_video(video_start, tracker.results['track_results'][video_start:])
+        print(online_teta.evaluate())
+        return
+
     content_track = tracker.results['track_results']
     outputs={"track_results":content_track, "bbox_results":None}
     
     rank, _ = get_dist_info()
     if rank == 0:
-        kwargs = {} if args.eval_options is None else args.eval_options
-        
-        eval_kwargs = cfg.get('evaluation', {}).copy()
-        # hard-code way to remove EvalHook args
-        for key in ['interval', 'tmpdir', 'start', 'gpu_collect']:
-            eval_kwargs.pop(key, None)
-        eval_kwargs.update(dict(metric=args.eval, **kwargs))
-        eval_kwargs.resfile_path = resfile_path
         print(dataset_val.evaluate(outputs, **eval_kwargs))
 
 
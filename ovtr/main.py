@@ -19,6 +19,7 @@ from torch.utils.data import DataLoader
 
 from util.events import EventStorage, TensorboardXWriter
 from util.tool import load_model
+from util.async_checkpoint import AsyncCheckpointer
 import util.misc as utils
 import datasets.samplers as samplers
 from datasets import build_dataset
@@ -36,6 +37,8 @@ def get_args_parser():
     parser.add_argument('--lr_linear_proj_names', default=['reference_points', 'sampling_offsets',], type=str, nargs='+')
     parser.add_argument('--lr_linear_proj_mult', default=0.1, type=float)
     parser.add_argument('--batch_size', default=2, type=int)
+    parser.add_argument('--aspect_ratio_grouping', action='store_true',
+                        help='batch portrait and landscape images separately to reduce padding')
     parser.add_argument('--weight_decay', default=1e-4, type=float)
     parser.add_argument('--epochs', default=50, type=int)
     parser.add_argument("--lr_drop", type=int, nargs='*')
@@ -46,7 +49,18 @@ def get_args_parser():
     parser.add_argument('--clip_gradients_type', default='full_model', type=str)
     
     parser.add_argument("--save_period", default=1, type=int)
+    parser.add_argument('--checkpoint_steps', default=0, type=int,
+                        help='also save a resumable checkpoint every N iterations, 0 to disable')
+    parser.add_argument('--keep_last_checkpoints', default=0, type=int,
+                        help='number of per-epoch checkpoints to keep, 0 to keep all of them')
+    parser.add_argument('--accum_steps', default=1, type=int,
+                        help='number of clips whose gradients are accumulated per optimizer step')
     parser.add_argument('--sgd', action='store_true')
+    parser.add_argument('--find_unused_parameters', default=False, action='store_true',
+                        help='let DDP search the autograd graph for unused parameters every iteration')
+    parser.add_argument("--amp", default=False, action="store_true")
+    parser.add_argument('--amp_dtype', default='float16', choices=['float16', 'bfloat16'],
+                        help='autocast dtype, use bfloat16 to train with --amp on cpu')
 
     # Variants of Deformable DETR
     parser.add_argument('--with_box_refine', default=False, action='store_true')
@@ -96,7 +110,11 @@ def get_args_parser():
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=42, type=int)
-    parser.add_argument('--resume', default=None, help='resume from checkpoint')
+    parser.add_argument('--resume', default=None,
+                        help='resume from checkpoint: the step checkpoints of --checkpoint_steps continue the '
+                             'interrupted run, other checkpoints only provide the weights (see --resume_state)')
+    parser.add_argument('--resume_state', default=False, action='store_true',
+                        help='also restore the optimizer, lr scheduler, grad scaler and epoch of an epoch checkpoint')
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
     # parser.add_argument('--eval', action='store_true')
@@ -133,6 +151,9 @@ def get_args_parser():
 
     parser.add_argument('--sampler_steps', type=int, nargs='*')
     parser.add_argument('--sampler_lengths', type=int, nargs='*')
+    parser.add_argument('--truncate_bptt', default=0, type=int,
+                        help='backpropagate each window of K frames of a clip on its own, the track queries carried to '
+                             'the next window are detached; 0 to backpropagate through the whole clip')
     parser.add_argument('--exp_name', default='submit', type=str)
     parser.add_argument('--occlusion_class', action='store_true',
                         help="whether regard occluded track as an unique class in track classification.")
@@ -157,6 +178,12 @@ def get_args_parser():
     parser.add_argument('--eval', default=['track'], type=str, nargs='+')
     parser.add_argument('--eval_options', type=json.loads, default='{"resfile_path": "results/ovtrack_teta_results/"}')
     parser.add_argument('--result_path_track', default=None, type=str)
+    parser.add_argument('--online_teta', default=False, action='store_true',
+                        help='evaluate TETA on each video as soon as it is inferred, tao_track.json is written '
+                             'once all the videos are done')
+    parser.add_argument('--teta_gt_cache', default=None, type=str,
+                        help='folder the TAO GT compiled by TETA is cached in (e.g. results/teta_gt_cache), '
+                             'the GT json is compiled on every evaluation if not given')
     return parser
 
 
@@ -165,6 +192,9 @@ def main(args):
     utils.init_distributed_mode(args)
     print("git:\n  {}\n".format(utils.get_sha()))
 
+    assert args.accum_steps >= 1, "accum_steps must be positive"
+    assert args.checkpoint_steps % args.accum_steps == 0, \
+        "checkpoint_steps must be a multiple of accum_steps, step checkpoints are only taken after an update"
     if args.frozen_weights is not None:
         assert args.masks, "Frozen training is meant for segmentation only"
     print(args)
@@ -186,6 +216,23 @@ def main(args):
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('number of params:', n_parameters)
 
+    resume_checkpoint = None
+    if args.resume:
+        if args.resume.startswith('https'):
+            resume_checkpoint = torch.hub.load_state_dict_from_url(
+                args.resume, map_location='cpu', check_hash=True)
+        else:
+            resume_checkpoint = torch.load(args.resume, map_location='cpu')
+    # a step checkpoint continues the interrupted run, any other checkpoint is
+    # a warm start (e.g. the second stage of the training scripts) unless
+    # --resume_state is given
+    resume_from_step = resume_checkpoint is not None and 'step' in resume_checkpoint
+    resume_state = resume_checkpoint is not None and (resume_from_step or args.resume_state)
+    if resume_state and not all(k in resume_checkpoint for k in ('optimizer', 'lr_scheduler', 'epoch')):
+        print('Warning: {} has no training state, only the weights are restored.'.format(args.resume))
+        resume_from_step = resume_state = False
+    warm_start = resume_checkpoint is not None and not resume_state
+
     dataset_train = build_dataset(image_set='train', args=args, cfg=cfg.data.train)
 
     if args.distributed:
@@ -193,19 +240,35 @@ def main(args):
             sampler_train = samplers.NodeDistributedSampler(dataset_train)
         else:
             sampler_train = samplers.DistributedSampler(dataset_train)
+    elif args.checkpoint_steps > 0 or resume_from_step:
+        # seeded on the epoch, so that an epoch can be resumed mid-way
+        sampler_train = samplers.DistributedSampler(dataset_train, num_replicas=1, rank=0)
     else:
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
 
-    batch_sampler_train = torch.utils.data.BatchSampler(
-        sampler_train, args.batch_size, drop_last=True)
+    if args.aspect_ratio_grouping:
+        batch_sampler_train = samplers.AspectRatioGroupedBatchSampler(
+            sampler_train, samplers.get_aspect_ratio_group_ids(dataset_train), args.batch_size, drop_last=True)
+    else:
+        batch_sampler_train = torch.utils.data.BatchSampler(
+            sampler_train, args.batch_size, drop_last=True)
+    batch_sampler_train = samplers.ResumableBatchSampler(batch_sampler_train)
     
     datasets2collate_fn = {
         'lvis_generated_img_seqs': utils.mot_collate_fn
     }
     collate_fn = datasets2collate_fn[args.dataset_file]
+    # normalize / pad deferred by SeqDeferredNormalizePad run batched on device
+    batch_transform = None
+    for transform in getattr(dataset_train, 'pipeline_seq', []):
+        if hasattr(transform, 'batch_transform'):
+            batch_transform = transform.batch_transform()
+    # worker seeds come from a generator of their own, saved with the checkpoint
+    loader_generator = torch.Generator()
+    loader_generator.manual_seed(seed)
     data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train,
                                    collate_fn=collate_fn, num_workers=args.num_workers,
-                                   pin_memory=True)
+                                   pin_memory=True, generator=loader_generator)
 
     def match_name_keywords(n, name_keywords):
         out = False
@@ -248,7 +311,7 @@ def main(args):
             freeze_ori.append(name)
 
     # Pre adjustable weights
-    if (cfg.train_tracking_only is not None) and (cfg.initial_grad) and (args.resume is None):
+    if (cfg.train_tracking_only is not None) and (cfg.initial_grad) and not warm_start:
         for name, para in model.named_parameters():
             para.requires_grad_(False)
         for name, para in model.named_parameters():
@@ -277,8 +340,24 @@ def main(args):
     else:
         lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, args.lr_drop)
 
+    # loss scaling is only needed for float16, bfloat16 has the range of float32
+    amp_dtype = getattr(torch, args.amp_dtype)
+    scaler = torch.cuda.amp.GradScaler(
+        enabled=args.amp and amp_dtype == torch.float16 and device.type == 'cuda')
+
+    def build_ddp(module):
+        # DDP only syncs the parameters that require grad when it is built, so it
+        # is rebuilt whenever the freezing changes. The track query updater cannot
+        # be left out: it gets gradients in most iterations and must be synced
+        # then, but it is skipped for frames without active tracks. Its parameters
+        # (model.conditional_parameters()) get a zero gradient in
+        # train_one_epoch_mot instead of being searched for by
+        # find_unused_parameters; any other unused parameter is still an error.
+        return torch.nn.parallel.DistributedDataParallel(
+            module, device_ids=[args.gpu], find_unused_parameters=args.find_unused_parameters)
+
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
+        model = build_ddp(model)
         model_without_ddp = model.module
 
     if args.frozen_weights is not None:
@@ -289,19 +368,16 @@ def main(args):
         model_without_ddp = load_model(model_without_ddp, args.pretrained)
 
     output_dir = Path(args.output_dir)
-    if args.resume:
-        if args.resume.startswith('https'):
-            checkpoint = torch.hub.load_state_dict_from_url(
-                args.resume, map_location='cpu', check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
+    resume_rng_state = None
+    if resume_checkpoint is not None:
+        checkpoint = resume_checkpoint
         missing_keys, unexpected_keys = model_without_ddp.load_state_dict(checkpoint['model'], strict=False)
         unexpected_keys = [k for k in unexpected_keys if not (k.endswith('total_params') or k.endswith('total_ops'))]
         if len(missing_keys) > 0:
             print('Missing Keys: {}'.format(missing_keys))
         if len(unexpected_keys) > 0:
             print('Unexpected Keys: {}'.format(unexpected_keys))
-        if not args.eval and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
+        if resume_state:
             import copy
             p_groups = copy.deepcopy(optimizer.param_groups)
             optimizer.load_state_dict(checkpoint['optimizer'])
@@ -323,52 +399,110 @@ def main(args):
                     lr_scheduler.step_size = args.lr_drop
                 lr_scheduler.base_lrs = list(map(lambda group: group['initial_lr'], optimizer.param_groups))
             lr_scheduler.step(lr_scheduler.last_epoch)
-            args.start_epoch = checkpoint['epoch'] + 1
+            if checkpoint.get('scaler'):
+                scaler.load_state_dict(checkpoint['scaler'])
+            if resume_from_step:
+                # saved mid-epoch, continue with the next batch of that epoch
+                args.start_epoch = checkpoint['epoch']
+                batch_sampler_train.start_iter = checkpoint['step']
+                loader_generator.set_state(checkpoint['loader_generator'])
+                if len(checkpoint['rng_states']) == utils.get_world_size():
+                    resume_rng_state = checkpoint['rng_states'][utils.get_rank()]
+                else:
+                    print('Warning: world size changed, the rng states of the checkpoint are not restored.')
+            else:
+                args.start_epoch = checkpoint['epoch'] + 1
+
+    # checkpoints are written by the main process in a background thread
+    checkpointer = AsyncCheckpointer(keep_last=args.keep_last_checkpoints)
+
+    def save_checkpoint(checkpoint_paths, epoch, **extra_state):
+        if not utils.is_main_process():
+            return
+        checkpointer.save({
+            'model': model_without_ddp.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'scaler': scaler.state_dict(),
+            'epoch': epoch,
+            'args': args,
+            **extra_state,
+        }, checkpoint_paths)
 
     t_e = time.time()
     print("Training started, preparation took {:.2f} seconds.".format(t_e - t_s))
     start_time = time.time()
     train_func = train_one_epoch_mot
     dataset_train.set_epoch(args.start_epoch)
+    # the parameters frozen for the first epochs are released at
+    # global_grad_allowed_epoch_track, or right away when a run resumed later
+    unfreeze_epoch = cfg.global_grad_allowed_epoch_track
+    if resume_state:
+        unfreeze_epoch = max(unfreeze_epoch, args.start_epoch)
     with EventStorage(args.start_epoch * len(dataset_train)) as storage:
         writer = None
         if args.vis and utils.is_main_process():
             writer = TensorboardXWriter(output_dir)
         for epoch in range(args.start_epoch, args.epochs):
-            if (epoch == cfg.global_grad_allowed_epoch_track) and (cfg.initial_grad) and (args.resume is None):
-                for name, para in model.named_parameters():
-                    if args.distributed:
-                        if name[7:] in freeze_ori:
-                            continue
-                        else:
-                            para.requires_grad_(True)
+            if (epoch == unfreeze_epoch) and (cfg.initial_grad) and not warm_start:
+                for name, para in model_without_ddp.named_parameters():
+                    if name in freeze_ori:
+                        continue
                     else:
-                        if name in freeze_ori:
-                            continue
-                        else:
-                            para.requires_grad_(True)
-                for name, param in model.named_parameters():
+                        para.requires_grad_(True)
+                for name, param in model_without_ddp.named_parameters():
                     if not param.requires_grad:
                         print(f"requires_grad in epoch{epoch}: False ", name)
+                if args.distributed:
+                    del model
+                    model = build_ddp(model_without_ddp)
 
-            if args.distributed:
+            if hasattr(sampler_train, 'set_epoch'):
                 sampler_train.set_epoch(epoch)
+            start_step = batch_sampler_train.start_iter
+            loader_generator_state = loader_generator.get_state()
+            if resume_rng_state is not None:
+                utils.set_rng_state(resume_rng_state)
+                resume_rng_state = None
+
+            num_steps = len(batch_sampler_train.batch_sampler)
+
+            def save_step_checkpoint(step, epoch=epoch, loader_generator_state=loader_generator_state):
+                # the last batch is covered by the checkpoint of the epoch
+                if (args.output_dir and args.checkpoint_steps > 0 and step % args.checkpoint_steps == 0
+                        and step < num_steps):
+                    # every rank has its own rng streams, all of them are saved
+                    rng_states = utils.all_gather(utils.get_rng_state())
+                    if checkpointer.in_flight():
+                        print('Skip the checkpoint of iteration {}, the previous one is still being written.'.format(step))
+                        return
+                    save_checkpoint([output_dir / 'checkpoint.pth'], epoch, step=step,
+                                    rng_states=rng_states, loader_generator=loader_generator_state)
+
             train_stats = train_func(
-                model, criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm, writer=writer
+                model, criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm, writer=writer,
+                amp=args.amp, batch_transform=batch_transform, scaler=scaler, amp_dtype=amp_dtype,
+                start_step=start_step, step_callback=save_step_checkpoint, accum_steps=args.accum_steps,
+                truncate_bptt=args.truncate_bptt
             )
             lr_scheduler.step()
             if args.output_dir:
                 checkpoint_paths = [output_dir / 'checkpoint.pth']
                 if (epoch + 1) % args.save_period == 0:
                     checkpoint_paths.append(output_dir / f'checkpoint{epoch:04}.pth')
-                for checkpoint_path in checkpoint_paths:
-                    utils.save_on_master({
-                        'model': model_without_ddp.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                        'lr_scheduler': lr_scheduler.state_dict(),
-                        'epoch': epoch,
-                        'args': args,
-                    }, checkpoint_path)
+                # never drop the checkpoint of an epoch, wait for a pending step checkpoint
+                checkpointer.wait()
+                if args.checkpoint_steps > 0:
+                    # checkpoint.pth stays resumable: it is saved as the first
+                    # step of the next epoch, the numbered checkpoints remain
+                    # epoch checkpoints (warm starts)
+                    rng_states = utils.all_gather(utils.get_rng_state())
+                    save_checkpoint(checkpoint_paths[:1], epoch + 1, step=0, rng_states=rng_states,
+                                    loader_generator=loader_generator.get_state())
+                    checkpoint_paths = checkpoint_paths[1:]
+                if checkpoint_paths:
+                    checkpointer.wait()
+                    save_checkpoint(checkpoint_paths, epoch)
 
                 log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                              'epoch': epoch,
@@ -380,6 +514,7 @@ def main(args):
                         
             dataset_train.step_epoch()
 
+    checkpointer.wait()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
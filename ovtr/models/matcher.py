@@ -11,6 +11,10 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 from scipy.optimize import linear_sum_assignment
 from torch import nn
@@ -19,6 +23,39 @@ from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 from detectron2.structures import Instances
 
 
+def build_label_to_column(select_id, labels=None):
+    """Lookup tensor giving the column of each category id in ``select_id``
+    (the distinct category ids of the text queries), -1 for absent ids.
+
+    The target ``labels`` looked up in it, if given, must all be in
+    ``select_id``: an absent id would index the last column with -1.
+    """
+    label_to_column = torch.full((int(select_id.max()) + 1,), -1, dtype=torch.long, device=select_id.device)
+    label_to_column[select_id] = torch.arange(len(select_id), device=select_id.device)
+    if labels is not None:
+        missing = labels[~torch.isin(labels.long(), select_id.long())]
+        if len(missing) > 0:
+            raise ValueError('category ids {} of the targets have no text query in select_id'.format(
+                missing.unique().tolist()))
+    return label_to_column
+
+
+_assignment_pool = None
+
+
+def solve_assignments(cost_blocks):
+    """Solve the LSAP of every per-image cost block, on a thread pool when
+    there are several images."""
+    if len(cost_blocks) <= 1:
+        indices = [linear_sum_assignment(c) for c in cost_blocks]
+    else:
+        global _assignment_pool
+        if _assignment_pool is None:
+            _assignment_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+        indices = list(_assignment_pool.map(linear_sum_assignment, cost_blocks))
+    return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+
+
 class HungarianMatcher(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
 
@@ -45,47 +82,31 @@ class HungarianMatcher(nn.Module):
         self.cost_giou = cost_giou
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
-    def forward(self, outputs, targets, use_focal=True):
-        """ Performs the matching
-
-        Params:
-            outputs: This is a dict that contains at least these entries:
-                 "pred_logits": Tensor of dim [batch_size, num_queries, num_classes] with the classification logits
-                 "pred_boxes": Tensor of dim [batch_size, num_queries, 4] with the predicted box coordinates
-
-            targets: This is a list of targets (len(targets) = batch_size), where each target is a dict containing:
-                 "labels": Tensor of dim [num_target_boxes] (where num_target_boxes is the number of ground-truth
-                           objects in the target) containing the class labels
-                 "boxes": Tensor of dim [num_target_boxes, 4] containing the target box coordinates
-
-        Returns:
-            A list of size batch_size, containing tuples of (index_i, index_j) where:
-                - index_i is the indices of the selected predictions (in order)
-                - index_j is the indices of the corresponding selected targets (in order)
-            For each batch element, it holds:
-                len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
-        """
-
-        with torch.no_grad():
-            bs, num_queries = outputs["pred_logits"].shape[:2]
-
-            # Also concat the target labels and boxes
-            if isinstance(targets[0], Instances):
-                tgt_ids = torch.cat([gt_per_img.labels for gt_per_img in targets])
-                tgt_bbox = torch.cat([gt_per_img.boxes for gt_per_img in targets])
-            else:
-                tgt_ids = torch.cat([v["labels"] for v in targets])
-                tgt_bbox = torch.cat([v["boxes"] for v in targets])
+    def _cost_blocks(self, outputs, targets, pred_boxes, use_focal=True):
+        """Cost matrix [num_queries, num_target_boxes] of every image, moved to
+        the cpu in a single copy. Queries are only compared to the targets of
+        their own image."""
+        if isinstance(targets[0], Instances):
+            tgt_ids = [gt_per_img.labels for gt_per_img in targets]
+            tgt_bbox = [gt_per_img.boxes for gt_per_img in targets]
+        else:
+            tgt_ids = [v["labels"] for v in targets]
+            tgt_bbox = [v["boxes"] for v in targets]
 
-            select_id = outputs["select_id"]
-            tgt_ids_all = [(select_id == lid).nonzero(as_tuple=False)[0] for lid in tgt_ids]
+        # Label id conversion
+        if use_focal:
+            # a label_to_column passed in was built with the labels of the targets
+            label_to_column = outputs.get("label_to_column")
+            if label_to_column is None:
+                label_to_column = build_label_to_column(outputs["select_id"], torch.cat(tgt_ids))
 
-            # We flatten to compute the cost matrices in a batch
+        cost_blocks = []
+        for i in range(len(targets)):
             if use_focal:
-                out_prob = outputs["pred_logits"][:, :, tgt_ids_all].flatten(0, 1).sigmoid()
+                out_prob = outputs["pred_logits"][i][:, label_to_column[tgt_ids[i].long()]].sigmoid()
             else:
-                out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
-            out_bbox = outputs["pred_boxes_for_matching_pre"].flatten(0, 1)  # [batch_size * num_queries, 4]
+                out_prob = outputs["pred_logits"][i].softmax(-1)  # [num_queries, num_classes]
+            out_bbox = pred_boxes[i]  # [num_queries, 4]
 
             # Compute the classification cost.
             if use_focal:
@@ -98,26 +119,47 @@ class HungarianMatcher(nn.Module):
                 # Compute the classification cost. Contrary to the loss, we don't use the NLL,
                 # but approximate it in 1 - proba[target class].
                 # The 1 is a constant that doesn't change the matching, it can be ommitted.
-                cost_class = -out_prob[:, tgt_ids]
+                cost_class = -out_prob[:, tgt_ids[i]]
 
             # Compute the L1 cost between boxes
-            cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+            cost_bbox = torch.cdist(out_bbox, tgt_bbox[i], p=1)
 
             # Compute the giou cost betwen boxes
             cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox),
-                                             box_cxcywh_to_xyxy(tgt_bbox))
+                                             box_cxcywh_to_xyxy(tgt_bbox[i]))
 
             # Final cost matrix
             C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-            C = C.view(bs, num_queries, -1).cpu()
+            cost_blocks.append(C)
 
-            if isinstance(targets[0], Instances):
-                sizes = [len(gt_per_img.boxes) for gt_per_img in targets]
-            else:
-                sizes = [len(v["boxes"]) for v in targets]
+        shapes = [c.shape for c in cost_blocks]
+        flat = torch.cat([c.flatten() for c in cost_blocks]).cpu().numpy()
+        return [block.reshape(shape) for block, shape in
+                zip(np.split(flat, np.cumsum([c.numel() for c in cost_blocks])[:-1]), shapes)]
+
+    @torch.no_grad()
+    def forward(self, outputs, targets, use_focal=True):
+        """ Performs the matching
+
+        Params:
+            outputs: This is a dict that contains at least these entries:
+                 "pred_logits": Tensor of dim [batch_size, num_queries, num_classes] with the classification logits
+                 "pred_boxes": Tensor of dim [batch_size, num_queries, 4] with the predicted box coordinates
 
-            indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-            return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+            targets: This is a list of targets (len(targets) = batch_size), where each target is a dict containing:
+                 "labels": Tensor of dim [num_target_boxes] (where num_target_boxes is the number of ground-truth
+                           objects in the target) containing the class labels
+                 "boxes": Tensor of dim [num_target_boxes, 4] containing the target box coordinates
+
+        Returns:
+            A list of size batch_size, containing tuples of (index_i, index_j) where:
+                - index_i is the indices of the selected predictions (in order)
+                - index_j is the indices of the corresponding selected targets (in order)
+            For each batch element, it holds:
+                len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
+        """
+        cost_blocks = self._cost_blocks(outputs, targets, outputs["pred_boxes_for_matching_pre"], use_focal)
+        return solve_assignments(cost_blocks)
 
 
 class ctr_HungarianMatcher(HungarianMatcher):
@@ -126,59 +168,8 @@ class ctr_HungarianMatcher(HungarianMatcher):
     
     @torch.no_grad()
     def forward(self, outputs, targets, use_focal=True):
-        # We flatten to compute the cost matrices in a batch
-        bs, num_queries = outputs["pred_logits"].shape[:2]
-
-        # Also concat the target labels and boxes
-        if isinstance(targets[0], Instances):
-            tgt_ids = torch.cat([gt_per_img.labels for gt_per_img in targets])
-            tgt_bbox = torch.cat([gt_per_img.boxes for gt_per_img in targets])
-        else:
-            tgt_ids = torch.cat([v["labels"] for v in targets])
-            tgt_bbox = torch.cat([v["boxes"] for v in targets])
-
-        # Label id conversion
-        select_id = outputs["select_id"]
-        tgt_ids_all = [(select_id == lid).nonzero(as_tuple=False)[0] for lid in tgt_ids]
-
-        # We flatten to compute the cost matrices in a batch
-        if use_focal:
-            out_prob = outputs["pred_logits"][:, :, tgt_ids_all].flatten(0, 1).sigmoid()
-        else:
-            out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
-        out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 4]
-
-        # Compute the classification cost.
-        if use_focal:
-            alpha = 0.25
-            gamma = 2.0
-            neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
-            pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
-            cost_class = pos_cost_class - neg_cost_class
-        else:
-            # Compute the classification cost. Contrary to the loss, we don't use the NLL,
-            # but approximate it in 1 - proba[target class].
-            # The 1 is a constant that doesn't change the matching, it can be ommitted.
-            cost_class = -out_prob[:, tgt_ids]
-
-        # Compute the L1 cost between boxes
-        cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
-
-        # Compute the giou cost betwen boxes
-        cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox),
-                                            box_cxcywh_to_xyxy(tgt_bbox))
-
-        # Final cost matrix
-        C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        C = C.view(bs, num_queries, -1).cpu()
-
-        if isinstance(targets[0], Instances):
-            sizes = [len(gt_per_img.boxes) for gt_per_img in targets]
-        else:
-            sizes = [len(v["boxes"]) for v in targets]
-
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        cost_blocks = self._cost_blocks(outputs, targets, outputs["pred_boxes"], use_focal)
+        return solve_assignments(cost_blocks)
 
 
 def build_matcher(args):
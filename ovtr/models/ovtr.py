@@ -14,11 +14,12 @@ from typing import List
 import copy
 from util import box_ops, checkpoint
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list, get_world_size,
-                       is_dist_avail_and_initialized, inverse_sigmoid,)
+                       is_dist_avail_and_initialized, inverse_sigmoid, PaddedBatchBuffer,
+                       autocast_disabled, to_fp32)
 
 from detectron2.structures import Instances, Boxes, matched_boxlist_iou
 from .backbone import build_backbone
-from .matcher import build_matcher
+from .matcher import build_matcher, build_label_to_column
 from .transformer import build_transformer
 from .updater import build as build_updater
 from .deformable_detr import SetCriterion
@@ -66,6 +67,23 @@ class TrackerPostProcess(nn.Module):
         track_instances.remove('pred_boxes')
         return track_instances
 
+def match_track_obj_ids(obj_idxes, gt_obj_ids):
+    """Index of the GT instance carrying each track object id, -1 if none.
+
+    A sorted-id search on device; for an id repeated among the GT instances the
+    last one is taken.
+    """
+    matched_gt_idxes = torch.full_like(obj_idxes, -1)
+    if len(gt_obj_ids) == 0 or len(obj_idxes) == 0:
+        return matched_gt_idxes
+    sorted_ids, order = torch.sort(gt_obj_ids.long(), stable=True)
+    obj_idxes = obj_idxes.long().contiguous()
+    pos = (torch.searchsorted(sorted_ids, obj_idxes, right=True) - 1).clamp(min=0)
+    found = sorted_ids[pos] == obj_idxes
+    matched_gt_idxes[found] = order[pos[found]]
+    return matched_gt_idxes
+
+
 def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
@@ -165,6 +183,11 @@ class OVFrameMatcher(SetCriterion):
     def _step(self):
         self._current_frame_idx += 1
 
+    def reset_losses(self):
+        """Drops the losses of the frames already backpropagated (a truncated backprop
+        window), the matching state and num_samples of the clip are kept."""
+        self.losses_dict = {}
+
     def get_num_boxes(self, num_samples):
         num_boxes = torch.as_tensor(num_samples, dtype=torch.float, device=self.sample_device)
         if is_dist_avail_and_initialized():
@@ -172,6 +195,12 @@ class OVFrameMatcher(SetCriterion):
         num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
         return num_boxes
 
+    def _get_label_to_column(self, outputs, labels):
+        # the lookup shared by a frame was built with all the labels of the frame
+        if 'label_to_column' in outputs:
+            return outputs['label_to_column']
+        return build_label_to_column(outputs['select_id'], labels)
+
     def get_loss(self, loss, outputs, gt_instances, indices, num_boxes, **kwargs):
         loss_map = {
             'labels': self.loss_labels,
@@ -180,7 +209,8 @@ class OVFrameMatcher(SetCriterion):
             "align_pre": self.loss_align_pre,
         }
         assert loss in loss_map, f'do you really want to compute {loss} loss?'
-        return loss_map[loss](outputs, gt_instances, indices, num_boxes, **kwargs)
+        # losses are always computed in fp32, whatever precision the forward ran in
+        return loss_map[loss](to_fp32(outputs), gt_instances, indices, num_boxes, **kwargs)
 
     def loss_labels(self, outputs, gt_instances: List[Instances], indices, num_boxes, log=False):
         """Classification loss (NLL)
@@ -202,10 +232,9 @@ class OVFrameMatcher(SetCriterion):
         target_classes = torch.full(src_logits.shape[:2], num_class,
                                     dtype=torch.int64, device=src_logits.device)
 
-        select_id = outputs["select_id"]
         labels_ori = torch.cat([t.labels[J[J != -1]] for t, (_, J) in zip(gt_instances, indices)])
-        tgt_ids_all = torch.cat([(select_id == lid).nonzero(as_tuple=False)[0] for lid in labels_ori])
-        target_classes[idx] = tgt_ids_all
+        label_to_column = self._get_label_to_column(outputs, labels_ori)
+        target_classes[idx] = label_to_column[labels_ori.long()]
       
         if self.focal_loss:                                                                    
             gt_labels_target = F.one_hot(target_classes, num_classes=num_class + 1)[:, :,
@@ -263,14 +292,10 @@ class OVFrameMatcher(SetCriterion):
         idx = self._get_src_permutation_idx(indices)
         src_feature = outputs["pred_embed"][idx]
 
-        select_id = outputs["select_id"]
         image_feat = outputs["image_feat"]
-        target_feature = []
-        for t, (_, i) in zip(targets, indices):
-            for c in t.labels[i]:
-                index = (select_id == c).nonzero(as_tuple=False)[0]
-                target_feature.append(image_feat[index])
-        target_feature = torch.cat(target_feature, dim=0)
+        labels = torch.cat([t.labels[i] for t, (_, i) in zip(targets, indices)])
+        label_to_column = self._get_label_to_column(outputs, labels)
+        target_feature = image_feat[label_to_column[labels.long()]]
         # l1 normalize the feature
         src_feature = nn.functional.normalize(src_feature, dim=1)
         if l1_distillation:
@@ -284,35 +309,22 @@ class OVFrameMatcher(SetCriterion):
         """Preserve text features without sudden variations.
         """
         input_feat = outputs["input_feat"]
-        loss_feature_all = []
 
-        select_id = outputs["select_id"]
+        # columns of the categories present in each image, for the images with targets
         uniq_labels = [torch.unique(t.labels) for t in targets]
-        tgt_ids_all = []
-        embed_bs_index = []
-        for i, uniq_label in enumerate(uniq_labels):
-            tgt_ids = []
-            if len(uniq_label)==0:
-                continue
-            else:
-                embed_bs_index.append(i)
-                for lid in uniq_label:
-                    index = (select_id == lid).nonzero(as_tuple=False)[0]
-                    tgt_ids.append(index)
-                tgt_ids = torch.cat(tgt_ids)
-            tgt_ids_all.append(tgt_ids)
-        
-        input_feats = torch.cat([input_feat[i] for i in tgt_ids_all])
-        encoder_embeds = outputs["text_embed"][:, embed_bs_index]
-
-        for encoder_embed in encoder_embeds:
-            src_feature = torch.cat([enc_embed[tgt_id] for enc_embed, tgt_id in zip(encoder_embed,tgt_ids_all)])
-            # l2 normalize the feature
-            src_feature = nn.functional.normalize(src_feature, dim=1)
-            loss_feature = F.mse_loss(src_feature, input_feats, reduction="none")
-            loss_feature_all.append(loss_feature.sum() / num_boxes)
-        loss_feature_all = torch.stack(loss_feature_all)
-        loss_encoder_align = loss_feature_all.sum()
+        label_to_column = self._get_label_to_column(outputs, torch.cat(uniq_labels))
+        embed_bs_index = [i for i, uniq_label in enumerate(uniq_labels) if len(uniq_label) > 0]
+        tgt_ids_all = [label_to_column[uniq_labels[i].long()] for i in embed_bs_index]
+        batch_idx = torch.cat([torch.full_like(tgt_ids, i) for i, tgt_ids in zip(embed_bs_index, tgt_ids_all)])
+        tgt_ids_all = torch.cat(tgt_ids_all)
+
+        input_feats = input_feat[tgt_ids_all]
+        # gathered for all the encoder layers at once, [num_layers, num_tgt, dim]
+        src_feature = outputs["text_embed"][:, batch_idx, tgt_ids_all]
+        # l2 normalize the feature
+        src_feature = nn.functional.normalize(src_feature, dim=-1)
+        loss_feature = F.mse_loss(src_feature, input_feats[None].expand_as(src_feature), reduction="none")
+        loss_encoder_align = (loss_feature.flatten(1).sum(1) / num_boxes).sum()
         losses = {"loss_align_pre": loss_encoder_align}
         return losses
     
@@ -321,11 +333,9 @@ class OVFrameMatcher(SetCriterion):
                                k != 'aux_outputs' and k != 'enc_outputs'}
 
         def select_unmatched_indexes(matched_indexes: torch.Tensor, num_total_indexes: int) -> torch.Tensor:
-            matched_indexes_set = set(matched_indexes.detach().cpu().numpy().tolist())
-            all_indexes_set = set(list(range(num_total_indexes)))
-            unmatched_indexes_set = all_indexes_set - matched_indexes_set
-            unmatched_indexes = torch.as_tensor(list(unmatched_indexes_set), dtype=torch.long).to(matched_indexes)
-            return unmatched_indexes
+            unmatched_mask = torch.ones(num_total_indexes, dtype=torch.bool, device=matched_indexes.device)
+            unmatched_mask[matched_indexes] = False
+            return torch.arange(num_total_indexes, device=matched_indexes.device)[unmatched_mask]
 
         gt_instances_i = self.gt_instances[self._current_frame_idx]  # gt instances of i-th image.
         track_instances_last: Instances = outputs_without_aux['track_instances']
@@ -338,31 +348,28 @@ class OVFrameMatcher(SetCriterion):
         else:
             track_instances = track_instances_last
 
+        # shared by the losses of all the decoder layers of this frame
+        # and checked against all its labels, which every loss and match looks up
+        label_to_column = build_label_to_column(outputs_without_aux['select_id'], gt_instances_i.labels)
         outputs_i = {
             'pred_logits': track_instances.pred_logits.unsqueeze(0),
             'pred_boxes': track_instances.pred_boxes.unsqueeze(0),
             'pred_embed': outputs_without_aux['pred_embed'][0, keep_indices].unsqueeze(0),
             'select_id':outputs_without_aux['select_id'],
             'image_feat':outputs_without_aux['image_feat'],
+            'label_to_column': label_to_column,
         }
 
         obj_idxes = gt_instances_i.obj_ids
         device = obj_idxes.device
-        obj_idxes_list = obj_idxes.detach().cpu().numpy().tolist()
-        obj_idx_to_gt_idx = {obj_idx: gt_idx for gt_idx, obj_idx in enumerate(obj_idxes_list)}
 
         # step1. inherit and update the previous tracks.
-        num_disappear_track = 0
-        track_instances.matched_gt_idxes[:] = -1
         valid_track_mask = track_instances.obj_idxes >= 0
-        valid_track_idxes = torch.arange(len(track_instances), device=device)[valid_track_mask]
-        valid_obj_idxes = track_instances.obj_idxes[valid_track_idxes]
-        for j in range(len(valid_obj_idxes)):
-            obj_id = valid_obj_idxes[j].item()
-            if obj_id in obj_idx_to_gt_idx:
-                track_instances.matched_gt_idxes[valid_track_idxes[j]] = obj_idx_to_gt_idx[obj_id]
-            else:
-                num_disappear_track += 1
+        matched_gt_idxes = match_track_obj_ids(track_instances.obj_idxes, obj_idxes)
+        matched_gt_idxes[~valid_track_mask] = -1
+        track_instances.matched_gt_idxes[:] = matched_gt_idxes
+        # kept on device, the number of samples is only read once per clip
+        num_disappear_track = (valid_track_mask & (matched_gt_idxes == -1)).sum()
 
         full_track_idxes = torch.arange(len(track_instances), dtype=torch.long, device=device)
         matched_track_idxes = (track_instances.obj_idxes >= 0) # occu 
@@ -381,7 +388,7 @@ class OVFrameMatcher(SetCriterion):
         unmatched_gt_instances = gt_instances_i[unmatched_tgt_indexes]
 
         def match_for_single_decoder_layer(unmatched_outputs, matcher, unmatched_track_idxes):
-            new_track_indices = matcher(unmatched_outputs,
+            new_track_indices = matcher(to_fp32(unmatched_outputs),
                                              [unmatched_gt_instances])
 
             # map the matched pair indexes to original index-space.
@@ -397,6 +404,7 @@ class OVFrameMatcher(SetCriterion):
             'pred_logits': track_instances.pred_logits[unmatched_track_idxes].unsqueeze(0),
             'pred_boxes': track_instances.pred_boxes[unmatched_track_idxes].unsqueeze(0),
             'select_id':outputs_without_aux['select_id'],
+            'label_to_column': label_to_column,
         }
 
         new_matched_indices = match_for_single_decoder_layer(unmatched_outputs, self.matcher, unmatched_track_idxes)
@@ -443,14 +451,10 @@ class OVFrameMatcher(SetCriterion):
                     track_instances_layer = track_instances_last
 
                 # step1*. inherit and update the previous tracks.
-                track_instances_layer.matched_gt_idxes[:] = -1
                 valid_track_mask = track_instances_layer.obj_idxes >= 0
-                valid_track_idxes = torch.arange(len(track_instances_layer), device=device)[valid_track_mask]
-                valid_obj_idxes = track_instances_layer.obj_idxes[valid_track_idxes]
-                for j in range(len(valid_obj_idxes)):
-                    obj_id = valid_obj_idxes[j].item()
-                    if obj_id in obj_idx_to_gt_idx:
-                        track_instances_layer.matched_gt_idxes[valid_track_idxes[j]] = obj_idx_to_gt_idx[obj_id]
+                matched_gt_idxes = match_track_obj_ids(track_instances_layer.obj_idxes, obj_idxes)
+                matched_gt_idxes[~valid_track_mask] = -1
+                track_instances_layer.matched_gt_idxes[:] = matched_gt_idxes
 
                 full_track_idxes = torch.arange(len(track_instances_layer), dtype=torch.long, device=device)
                 matched_track_idxes_layer = (track_instances_layer.obj_idxes >= 0)
@@ -465,6 +469,7 @@ class OVFrameMatcher(SetCriterion):
                     'pred_logits': aux_outputs['pred_logits'][0, _keep_indices_layer][unmatched_track_idxes_layer].unsqueeze(0),
                     'pred_boxes': aux_outputs['pred_boxes'][0, _keep_indices_layer][unmatched_track_idxes_layer].unsqueeze(0),
                     'select_id': aux_outputs['select_id'],
+                    'label_to_column': label_to_column,
                 }
                 new_matched_indices_layer = match_for_single_decoder_layer(unmatched_outputs_layer, self.matcher, unmatched_track_idxes_layer)
 
@@ -478,6 +483,7 @@ class OVFrameMatcher(SetCriterion):
                     'pred_embed': aux_outputs['pred_embed'][0, _keep_indices_layer].unsqueeze(0),
                     'select_id': aux_outputs['select_id'],
                     'image_feat': aux_outputs['image_feat'],
+                    'label_to_column': label_to_column,
                 }
                 for loss in self.losses:
                     l_dict = self.get_loss(loss,
@@ -492,8 +498,12 @@ class OVFrameMatcher(SetCriterion):
         self._step()
         return track_instances
 
-    def forward(self, outputs):
+    def forward(self, outputs, normalize=True):
         losses = outputs.pop("losses_dict")
+        if not normalize:
+            # summed over the samples of the clip, self.num_samples of them; the
+            # caller normalizes, e.g. once per accumulated batch
+            return dict(losses)
         num_samples = self.get_num_boxes(self.num_samples)
         loss_avg = {}
         for loss_name, _ in losses.items():
@@ -537,6 +547,7 @@ class OVTR(nn.Module):
         hidden_dim = transformer.d_model
      
         self.max_pad_len = max_len
+        self.inference_buffer = None
         self.text_embeddings=text_embeddings.t()
         self.image_embeddings=image_embeddings.t()
         self.patch2query = nn.Linear(512, 256)
@@ -627,6 +638,14 @@ class OVTR(nn.Module):
         self.criterion = criterion
         self.train_with_artificial_img_seqs = train_with_artificial_img_seqs
 
+    def conditional_parameters(self):
+        """Trainable parameters that legitimately get no gradient in some
+        iterations: the track query updater is skipped when a frame has no
+        active tracks. DistributedDataParallel without find_unused_parameters
+        needs them to get a (zero) gradient then, see train_one_epoch_mot.
+        """
+        return [p for p in self.track_embed.parameters() if p.requires_grad]
+
     def _generate_empty_tracks(self, cls_pad_len=1203):
         track_instances = Instances((1, 1))
         num_queries = self.num_queries
@@ -699,6 +718,11 @@ class OVTR(nn.Module):
                 select_id = select_id[:max_pad_len]
         return select_id, extra_labels
     
+    @staticmethod
+    def _detach_track_instances(track_instances: Instances) -> Instances:
+        fields = {k: v.detach() if isinstance(v, torch.Tensor) else v for k, v in track_instances._fields.items()}
+        return Instances((1, 1), **fields)
+
     def _forward_single_image(self, samples, track_instances: Instances, targets=None, extra_labels=None ,is_first=True, cls_num=0):
         features, pos = self.backbone(samples)      
         src, mask = features[-1].decompose()
@@ -793,21 +817,24 @@ class OVTR(nn.Module):
         out['hs_cti'] = hs_cti[-1]
         return out
      
-    def _post_process_single_image(self, frame_res, track_instances, is_last, is_repeat=None, is_first=False, target_size=None):
+    def _post_process_single_image(self, frame_res, track_instances, is_last, is_repeat=None, is_first=False, target_size=None,
+                                   truncate=False):
         with torch.no_grad():
             track_scores = frame_res['pred_logits'][0, :].sigmoid().max(dim=-1).values
 
-        track_instances.scores = track_scores
-        track_instances.pred_logits = frame_res['pred_logits'][0]
-        track_instances.pred_boxes = frame_res['pred_boxes'][0]
-        track_instances.output_embedding_txt = frame_res['hs_cti'][0]
-        track_instances.output_embedding_img = frame_res['hs_ofa'][0]
-        track_instances.query_pos = frame_res["query_pos_track"][0]
+        # track states are carried across frames in fp32, also under autocast
+        track_instances.scores = track_scores.float()
+        track_instances.pred_logits = frame_res['pred_logits'][0].float()
+        track_instances.pred_boxes = frame_res['pred_boxes'][0].float()
+        track_instances.output_embedding_txt = frame_res['hs_cti'][0].float()
+        track_instances.output_embedding_img = frame_res['hs_ofa'][0].float()
+        track_instances.query_pos = frame_res["query_pos_track"][0].float()
 
         if self.training:
             # the track id will be assigned by the mather.
             frame_res['track_instances'] = track_instances
-            track_instances = self.criterion.match_for_single_frame(frame_res, is_first)
+            with autocast_disabled():
+                track_instances = self.criterion.match_for_single_frame(frame_res, is_first)
         else:
             if self.train_with_artificial_img_seqs:
                 track_instances, _track_discard = protect_track_preds(track_instances, num_queries=self.num_queries, miss_tolerance=self.track_base.miss_tolerance, ious_thresh=self.ious_thresh) 
@@ -819,7 +846,9 @@ class OVTR(nn.Module):
 
         tmp = {}
         tmp['init_track_instances'] = self._generate_empty_tracks(cls_pad_len=track_instances.pred_logits.shape[1])
-        tmp['track_instances'] = track_instances
+        # at the end of a truncated backprop window the track queries of the next frame are
+        # computed from the detached states, the next window does not reach back into this one
+        tmp['track_instances'] = self._detach_track_instances(track_instances) if truncate else track_instances
 
         if not is_last:
             out_track_instances = self.track_embed(tmp)
@@ -847,7 +876,11 @@ class OVTR(nn.Module):
 
     @torch.no_grad()
     def inference_single_image(self, data, track_instances=None, is_repeat=False, frame_id=None, ori_img_size=None, extra_labels=None):
-        img = nested_tensor_from_tensor_list([data['imgs'][0]])
+        # inference runs without autograd, so the padded frame can live in a
+        # buffer reused across frames
+        if self.inference_buffer is None:
+            self.inference_buffer = PaddedBatchBuffer()
+        img = nested_tensor_from_tensor_list([data['imgs'][0]], buffer=self.inference_buffer)
         if (track_instances is None) or (frame_id == 0):
             track_instances = self._generate_empty_tracks()
         if frame_id == 0:
@@ -870,25 +903,40 @@ class OVTR(nn.Module):
             ret['ref_pts'] = ref_pts
         return ret
 
-    def forward(self, data):
-        if self.training:
-            self.criterion.initialize(data['gt_instances'])
+    def forward(self, data, frame_range=None, state=None):
+        """Runs the frames of a clip, all of them or, for truncated backprop through time,
+        the window ``frame_range = (start, end)``. A window is followed by the next one with
+        ``state=outputs['state']``; its losses have to be backpropagated before, the track
+        queries carried over are detached from it.
+        """
         frames = data['imgs']
+        start, end = frame_range if frame_range is not None else (0, len(frames))
+        if self.training:
+            if start == 0:
+                self.criterion.initialize(data['gt_instances'])
+            else:
+                self.criterion.reset_losses()
         cls_num = max([len(torch.unique(gt_instance.labels)) for gt_instance in data['gt_instances']])
         outputs = {
             'pred_logits': [],
             'pred_boxes': [],
             'track_instances': []
         }
-        track_instances = self._generate_empty_tracks()
+        if state is None:
+            track_instances = self._generate_empty_tracks()
+        else:
+            track_instances = state['track_instances']
 
         keys = list(track_instances._fields.keys())
-        for frame_index, (frame, targets) in enumerate(zip(frames, data['gt_instances'])):
+        for frame_index in range(start, end):
+            frame, targets = frames[frame_index], data['gt_instances'][frame_index]
             frame.requires_grad = False
             is_last = frame_index == len(frames) - 1
             is_first = frame_index == 0
             if is_first:
                 extra_labels = None
+            elif frame_index == start:
+                extra_labels = state['extra_labels']
             else:
                 extra_labels = frame_res["extra_labels"]
             if self.use_checkpoint and frame_index < len(frames) - 3:
@@ -938,7 +986,8 @@ class OVTR(nn.Module):
             else:
                 frame = nested_tensor_from_tensor_list([frame])
                 frame_res = self._forward_single_image(frame, track_instances, targets, extra_labels, is_first, cls_num)
-            frame_res = self._post_process_single_image(frame_res, track_instances, is_last, is_first=is_first)
+            truncate = self.training and frame_index == end - 1 and not is_last
+            frame_res = self._post_process_single_image(frame_res, track_instances, is_last, is_first=is_first, truncate=truncate)
             
             track_instances = frame_res['track_instances']
             outputs['pred_logits'].append(frame_res['pred_logits'])
@@ -946,6 +995,12 @@ class OVTR(nn.Module):
             outputs['track_instances'].append(frame_res['track_instances_pre'])
 
         outputs['losses_dict'] = self.criterion.losses_dict
+        if frame_range is not None:
+            extra_labels = frame_res['extra_labels']
+            outputs['state'] = {
+                'track_instances': track_instances,
+                'extra_labels': extra_labels.detach() if isinstance(extra_labels, torch.Tensor) else extra_labels,
+            }
         return outputs
 
 
@@ -1009,6 +1064,6 @@ def build(args, cfg):
         computed_aux=cfg.computed_aux,
         score_thresh=args.score_thresh,
         filter_score_thresh=args.filter_score_thresh,
-        miss_tolerance=args.miss_tolerance
+        miss_tolerance=args.miss_tolerance,
     )
     return model, criterion
@@ -8,7 +8,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from util import box_ops
-from util.misc import inverse_sigmoid
+from util.misc import inverse_sigmoid, autocast_disabled
 from detectron2.structures import Boxes, Instances, pairwise_iou
 
 
@@ -221,23 +221,25 @@ class Category_Information_Propagator(QueryInteractionModule):
         if len(track_instances) == 0:
             return track_instances
         
-        out_embed_img = track_instances.output_embedding_img
-        query_pos = track_instances.query_pos
-        query_feat = track_instances.query_tgt
-        q = k = query_pos + out_embed_img
-        tgt = out_embed_img
-        
-        tgt2 = self.self_attn(q[:, None], k[:, None], value=tgt[:, None])[0][:, 0]
-        tgt = tgt + self.dropout1(tgt2)
-        tgt = self.norm1(tgt)
-
-        tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
-        tgt = tgt + self.dropout2(tgt2)
-        tgt = self.norm2(tgt)
-
-        query_feat2 = self.linear_feat2(self.dropout_feat1(self.activation(self.linear_feat1(tgt))))
-        query_feat = query_feat + self.dropout_feat2(query_feat2)
-        query_feat = self.norm_feat(query_feat)
+        # the propagated queries are carried over frames, keep them in fp32
+        out_embed_img = track_instances.output_embedding_img.float()
+        query_pos = track_instances.query_pos.float()
+        query_feat = track_instances.query_tgt.float()
+        with autocast_disabled():
+            q = k = query_pos + out_embed_img
+            tgt = out_embed_img
+
+            tgt2 = self.self_attn(q[:, None], k[:, None], value=tgt[:, None])[0][:, 0]
+            tgt = tgt + self.dropout1(tgt2)
+            tgt = self.norm1(tgt)
+
+            tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
+            tgt = tgt + self.dropout2(tgt2)
+            tgt = self.norm2(tgt)
+
+            query_feat2 = self.linear_feat2(self.dropout_feat1(self.activation(self.linear_feat1(tgt))))
+            query_feat = query_feat + self.dropout_feat2(query_feat2)
+            query_feat = self.norm_feat(query_feat)
         track_instances.query_tgt = query_feat
 
         track_instances.ref_pts = inverse_sigmoid(track_instances.pred_boxes[:, :4].detach().clone())
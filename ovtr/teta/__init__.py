@@ -1,2 +1,2 @@
 from . import config, datasets, metrics, utils
-from .eval import Evaluator
+from .eval import Evaluator, OnlineEvaluator
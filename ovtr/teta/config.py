@@ -87,10 +87,11 @@ def get_default_dataset_config():
         "CLASSES_TO_EVAL": None,  # Classes to eval (if None, all classes)
         "SPLIT_TO_EVAL": "training",  # Valid: 'training', 'val'
         "PRINT_CONFIG": True,  # Whether to print current config
-        "TRACKER_SUB_FOLDER": "data",  # Tracker files are in TRACKER_FOLDER/tracker_name/TRACKER_SUB_FOLDER
+        "TRACKER_SUB_FOLDER": "data",  # Tracker files are in TRACKER_FOLDER/tracker_name/TRACKER_SUB_FOLDER (None: set per sequence)
         "OUTPUT_SUB_FOLDER": "",  # Output files are saved in OUTPUT_FOLDER/tracker_name/OUTPUT_SUB_FOLDER
         "TRACKER_DISPLAY_NAMES": None,  # Names of trackers to display, if None: TRACKERS_TO_EVAL
         "MAX_DETECTIONS": 0,  # Number of maximal allowed detections per image (0 for unlimited)
+        "GT_CACHE_FOLDER": None,  # Where the compiled GT is cached (if None, the GT json is compiled on every run)
     }
     return default_config
 
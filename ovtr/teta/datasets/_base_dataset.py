@@ -4,7 +4,6 @@ import os
 import traceback
 import zipfile
 from abc import ABC, abstractmethod
-from copy import deepcopy
 
 import numpy as np
 
@@ -91,15 +90,20 @@ class _BaseDataset(ABC):
         raw_data = {**raw_tracker_data, **raw_gt_data}  # Merges dictionaries
 
         # Calculate similarities for each timestep.
-        similarity_scores = []
-        for _, (gt_dets_t, tracker_dets_t) in enumerate(
-            zip(raw_data["gt_dets"], raw_data["tk_dets"])
-        ):
-            ious = self._calculate_similarities(gt_dets_t, tracker_dets_t)
-            similarity_scores.append(ious)
-        raw_data["similarity_scores"] = similarity_scores
+        raw_data["similarity_scores"] = self._calculate_seq_similarities(
+            raw_data["gt_dets"], raw_data["tk_dets"]
+        )
         return raw_data
 
+    def _calculate_seq_similarities(self, gt_dets, tracker_dets):
+        """Calculates the similarities of every timestep of a sequence, as a list (for each timestep) of 2D NDArrays.
+        Datasets that can compute them for all timesteps at once override this.
+        """
+        return [
+            self._calculate_similarities(gt_dets_t, tracker_dets_t)
+            for gt_dets_t, tracker_dets_t in zip(gt_dets, tracker_dets)
+        ]
+
     @staticmethod
     def _load_simple_text_file(
         file,
@@ -283,13 +287,8 @@ class _BaseDataset(ABC):
         """
         if box_format in "xywh":
             # layout: (x0, y0, w, h)
-            bboxes1 = deepcopy(bboxes1)
-            bboxes2 = deepcopy(bboxes2)
-
-            bboxes1[:, 2] = bboxes1[:, 0] + bboxes1[:, 2]
-            bboxes1[:, 3] = bboxes1[:, 1] + bboxes1[:, 3]
-            bboxes2[:, 2] = bboxes2[:, 0] + bboxes2[:, 2]
-            bboxes2[:, 3] = bboxes2[:, 1] + bboxes2[:, 3]
+            bboxes1 = _BaseDataset._xywh_to_x0y0x1y1(bboxes1)
+            bboxes2 = _BaseDataset._xywh_to_x0y0x1y1(bboxes2)
         elif box_format not in "x0y0x1y1":
             raise (TrackEvalException("box_format %s is not implemented" % box_format))
 
@@ -323,6 +322,75 @@ class _BaseDataset(ABC):
             ious = intersection / union
             return ious
 
+    @staticmethod
+    def _calculate_ragged_box_ious(bboxes1, bboxes2, box_format="xywh", dense_pairs=256, max_pairs=1 << 22):
+        """Calculates the IOUs between the boxes of each timestep of a sequence in one vectorized pass.
+        bboxes1 and bboxes2 are lists (for each timestep) of arrays of boxes. Returns a list (for each timestep) of
+        the same IOUs as _calculate_box_ious(bboxes1[t], bboxes2[t], box_format).
+
+        The boxes are concatenated and every (box1, box2) pair of a timestep is gathered by its index, at most
+        max_pairs pairs at a time to bound the memory. Timesteps with at least dense_pairs pairs are cheaper to
+        broadcast on their own, they go through _calculate_box_ious.
+        """
+        sizes1 = np.array([len(b) for b in bboxes1], dtype=int)
+        sizes2 = np.array([len(b) for b in bboxes2], dtype=int)
+        offsets1 = np.concatenate([[0], np.cumsum(sizes1)])
+        offsets2 = np.concatenate([[0], np.cumsum(sizes2)])
+        flat1 = np.concatenate([np.empty((0, 4))] + [b[:, :4] for b in bboxes1 if len(b)])
+        flat2 = np.concatenate([np.empty((0, 4))] + [b[:, :4] for b in bboxes2 if len(b)])
+        if box_format in "xywh":
+            flat1 = _BaseDataset._xywh_to_x0y0x1y1(flat1)
+            flat2 = _BaseDataset._xywh_to_x0y0x1y1(flat2)
+        elif box_format not in "x0y0x1y1":
+            raise (TrackEvalException("box_format %s is not implemented" % box_format))
+        area1 = (flat1[:, 2] - flat1[:, 0]) * (flat1[:, 3] - flat1[:, 1])
+        area2 = (flat2[:, 2] - flat2[:, 0]) * (flat2[:, 3] - flat2[:, 1])
+
+        num_pairs = sizes1 * sizes2
+        dense = num_pairs >= dense_pairs
+        num_pairs[dense] = 0
+        pair_offsets = np.concatenate([[0], np.cumsum(num_pairs)])
+        ious = np.empty(pair_offsets[-1])
+        start = 0
+        while start < len(sizes1):
+            end = np.searchsorted(pair_offsets, pair_offsets[start] + max_pairs, side="right") - 1
+            end = min(max(end, start + 1), len(sizes1))
+            # the pair (i, j) of timestep t is box offsets1[t] + i and box offsets2[t] + j
+            timesteps = np.repeat(np.arange(start, end), num_pairs[start:end])
+            pairs = np.arange(pair_offsets[start], pair_offsets[end]) - pair_offsets[timesteps]
+            idx1 = offsets1[timesteps] + pairs // sizes2[timesteps]
+            idx2 = offsets2[timesteps] + pairs % sizes2[timesteps]
+
+            # layout: (x0, y0, x1, y1)
+            b1, b2 = flat1[idx1], flat2[idx2]
+            intersection = np.maximum(np.minimum(b1[:, 2], b2[:, 2]) - np.maximum(b1[:, 0], b2[:, 0]), 0) * np.maximum(
+                np.minimum(b1[:, 3], b2[:, 3]) - np.maximum(b1[:, 1], b2[:, 1]), 0
+            )
+            union = area1[idx1] + area2[idx2] - intersection
+            intersection[area1[idx1] <= 0 + np.finfo("float").eps] = 0
+            intersection[area2[idx2] <= 0 + np.finfo("float").eps] = 0
+            intersection[union <= 0 + np.finfo("float").eps] = 0
+            union[union <= 0 + np.finfo("float").eps] = 1
+            ious[pair_offsets[start]:pair_offsets[end]] = intersection / union
+            start = end
+
+        offsets1, offsets2, pair_offsets = offsets1.tolist(), offsets2.tolist(), pair_offsets.tolist()
+        return [
+            _BaseDataset._calculate_box_ious(
+                flat1[offsets1[t]:offsets1[t + 1]], flat2[offsets2[t]:offsets2[t + 1]], box_format="x0y0x1y1"
+            )
+            if is_dense
+            else ious[pair_offsets[t]:pair_offsets[t + 1]].reshape(n1, n2)
+            for t, (n1, n2, is_dense) in enumerate(zip(sizes1.tolist(), sizes2.tolist(), dense.tolist()))
+        ]
+
+    @staticmethod
+    def _xywh_to_x0y0x1y1(bboxes):
+        """Converts boxes from (x0, y0, w, h) to (x0, y0, x1, y1), without modifying bboxes."""
+        bboxes = bboxes.copy()
+        bboxes[:, 2:4] += bboxes[:, 0:2]
+        return bboxes
+
     @staticmethod
     def _calculate_euclidean_similarity(dets1, dets2, zero_distance=2.0):
         """Calculates the euclidean distance between two sets of detections, and then converts this into a similarity
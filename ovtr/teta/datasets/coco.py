@@ -463,6 +463,10 @@ class COCO(_BaseDataset):
         sim_scores = self._calculate_box_ious(gt_dets_t, tk_dets_t)
         return sim_scores
 
+    def _calculate_seq_similarities(self, gt_dets, tk_dets):
+        """Compute similarity scores of all timesteps at once."""
+        return self._calculate_ragged_box_ious(gt_dets, tk_dets)
+
     def _compute_vid_mappings(self, annotations):
         """Computes mappings from videos to corresponding tracks and images."""
         vids_to_tracks = {}
@@ -1,5 +1,6 @@
 """TAO Dataset."""
 import copy
+import hashlib
 import itertools
 import json
 import os
@@ -12,6 +13,9 @@ from ..config import get_default_dataset_config, init_config
 from ..utils import TrackEvalException
 from ._base_dataset import _BaseDataset
 
+# bump when the layout of the compiled GT changes
+GT_CACHE_VERSION = 1
+
 
 class TAO(_BaseDataset):
     """Dataset class for TAO tracking"""
@@ -33,7 +37,7 @@ class TAO(_BaseDataset):
         self.output_sub_fol = self.config["OUTPUT_SUB_FOLDER"]
 
         if self.gt_fol.endswith(".json"):
-            self.gt_data = json.load(open(self.gt_fol, "r"))
+            gt_file = self.gt_fol
         else:
             gt_dir_files = [
                 file for file in os.listdir(self.gt_fol) if file.endswith(".json")
@@ -42,12 +46,8 @@ class TAO(_BaseDataset):
                 raise TrackEvalException(
                     f"{self.gt_fol} does not contain exactly one json file."
                 )
-
-            with open(os.path.join(self.gt_fol, gt_dir_files[0])) as f:
-                self.gt_data = json.load(f)
-
-        # merge categories marked with a merged tag in TAO dataset
-        self._merge_categories(self.gt_data["annotations"] + self.gt_data["tracks"])
+            gt_file = os.path.join(self.gt_fol, gt_dir_files[0])
+        self._load_gt(gt_file)
 
         # get sequences to eval and sequence information
         self.seq_list = [
@@ -56,25 +56,10 @@ class TAO(_BaseDataset):
         self.seq_name2seqid = {
             vid["name"].replace("/", "-"): vid["id"] for vid in self.gt_data["videos"]
         }
-        # compute mappings from videos to annotation data
-        self.video2gt_track, self.video2gt_image = self._compute_vid_mappings(
-            self.gt_data["annotations"]
-        )
         # compute sequence lengths
         self.seq_lengths = {vid["id"]: 0 for vid in self.gt_data["videos"]}
         for img in self.gt_data["images"]:
             self.seq_lengths[img["video_id"]] += 1
-        self.seq2images2timestep = self._compute_image_to_timestep_mappings()
-        self.seq2cls = {
-            vid["id"]: {
-                "pos_cat_ids": list(
-                    {track["category_id"] for track in self.video2gt_track[vid["id"]]}
-                ),
-                "neg_cat_ids": vid["neg_category_ids"],
-                "not_exh_labeled_cat_ids": vid["not_exhaustive_category_ids"],
-            }
-            for vid in self.gt_data["videos"]
-        }
 
         # Get classes to eval
         considered_vid_ids = [self.seq_name2seqid[vid] for vid in self.seq_list]
@@ -136,6 +121,12 @@ class TAO(_BaseDataset):
         self.tracker_data = {tracker: dict() for tracker in self.tracker_list}
 
         for tracker in self.tracker_list:
+            if self.tracker_sub_fol is None:
+                # tracker results are added per sequence with set_tracker_seq_data
+                curr_vids2tracks, curr_vids2images = self._preprocess_tracker_data([])
+                self.tracker_data[tracker]["vids_to_tracks"] = curr_vids2tracks
+                self.tracker_data[tracker]["vids_to_images"] = curr_vids2images
+                continue
             if self.tracker_sub_fol.endswith(".json"):
                 with open(os.path.join(self.tracker_sub_fol)) as f:
                     curr_data = json.load(f)
@@ -151,27 +142,210 @@ class TAO(_BaseDataset):
                 with open(os.path.join(tr_dir, tr_dir_files[0])) as f:
                     curr_data = json.load(f)
 
-            # limit detections if MAX_DETECTIONS > 0
-            if self.config["MAX_DETECTIONS"]:
-                curr_data = self._limit_dets_per_image(curr_data)
+            curr_vids2tracks, curr_vids2images = self._preprocess_tracker_data(curr_data)
+            self.tracker_data[tracker]["vids_to_tracks"] = curr_vids2tracks
+            self.tracker_data[tracker]["vids_to_images"] = curr_vids2images
 
-            # fill missing video ids
-            self._fill_video_ids_inplace(curr_data)
+    def _preprocess_tracker_data(self, curr_data):
+        """Preprocess tracker annotations, returns their video mappings."""
+        # limit detections if MAX_DETECTIONS > 0
+        if self.config["MAX_DETECTIONS"]:
+            curr_data = self._limit_dets_per_image(curr_data)
 
-            # make track ids unique over whole evaluation set
-            self._make_tk_ids_unique(curr_data)
+        # fill missing video ids
+        self._fill_video_ids_inplace(curr_data)
 
-            # merge categories marked with a merged tag in TAO dataset
-            self._merge_categories(curr_data)
+        # make track ids unique over whole evaluation set
+        self._make_tk_ids_unique(curr_data)
 
-            # get tracker sequence information
-            curr_vids2tracks, curr_vids2images = self._compute_vid_mappings(curr_data)
-            self.tracker_data[tracker]["vids_to_tracks"] = curr_vids2tracks
-            self.tracker_data[tracker]["vids_to_images"] = curr_vids2images
+        # merge categories marked with a merged tag in TAO dataset
+        self._merge_categories(curr_data)
+
+        # get tracker sequence information
+        return self._compute_vid_mappings(curr_data)
+
+    def set_tracker_seq_data(self, tracker, seq, annotations):
+        """Set the tracker annotations of a single sequence.
+
+        The annotations must all belong to the sequence, with track ids that
+        are not used by any other sequence.
+        """
+        seq_id = self.seq_name2seqid[seq]
+        curr_vids2tracks, curr_vids2images = self._preprocess_tracker_data(annotations)
+        self.tracker_data[tracker]["vids_to_tracks"][seq_id] = curr_vids2tracks[seq_id]
+        self.tracker_data[tracker]["vids_to_images"][seq_id] = curr_vids2images[seq_id]
 
     def get_display_name(self, tracker):
         return self.tracker_to_disp[tracker]
 
+    def _load_gt(self, gt_file):
+        """Load the GT in its compiled form.
+
+        The GT json is compiled once to flat numpy arrays (see _compile_gt),
+        which are cached in GT_CACHE_FOLDER, if set, under the hash of the
+        json. The compiled GT does not depend on the config. Sets gt_data
+        (videos, images and categories only), gt_arrays, seq2images2timestep
+        and seq2cls.
+        """
+        cache_file = None
+        if self.config["GT_CACHE_FOLDER"]:
+            sha1 = hashlib.sha1()
+            with open(gt_file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 24), b""):
+                    sha1.update(chunk)
+            cache_file = os.path.join(
+                self.config["GT_CACHE_FOLDER"],
+                f"tao_gt_v{GT_CACHE_VERSION}_{sha1.hexdigest()}.npz",
+            )
+
+        if cache_file is not None and os.path.exists(cache_file):
+            with np.load(cache_file, allow_pickle=False) as f:
+                arrays = dict(f)
+        else:
+            with open(gt_file) as f:
+                arrays = self._compile_gt(json.load(f))
+            if cache_file is not None:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+                with open(tmp_file, "wb") as f:
+                    np.savez(f, **arrays)
+                os.replace(tmp_file, cache_file)
+        self.gt_arrays = arrays
+
+        def ragged(name, i):
+            offsets = arrays[name + "_offsets"]
+            return arrays[name][offsets[i] : offsets[i + 1]].tolist()
+
+        video_ids = arrays["video_ids"].tolist()
+        self.gt_data = {
+            "videos": [
+                {
+                    "id": vid_id,
+                    "name": name,
+                    "neg_category_ids": ragged("video_neg_cat_ids", i),
+                    "not_exhaustive_category_ids": ragged("video_not_exh_cat_ids", i),
+                }
+                for i, (vid_id, name) in enumerate(
+                    zip(video_ids, arrays["video_names"].tolist())
+                )
+            ],
+            "images": [
+                {"id": img_id, "video_id": vid_id, "frame_index": frame_index}
+                for img_id, vid_id, frame_index in zip(
+                    arrays["image_ids"].tolist(),
+                    arrays["image_video_ids"].tolist(),
+                    arrays["image_frame_indexes"].tolist(),
+                )
+            ],
+            "categories": json.loads(str(arrays["categories"])),
+        }
+        self.video2index = {vid_id: i for i, vid_id in enumerate(video_ids)}
+
+        self.seq2images2timestep = {vid_id: dict() for vid_id in video_ids}
+        # images with GT, in order of their timestep
+        annotated = np.flatnonzero(arrays["image_timesteps"] >= 0)
+        annotated = annotated[
+            np.argsort(arrays["image_timesteps"][annotated], kind="stable")
+        ]
+        for img_id, vid_id, t in zip(
+            arrays["image_ids"][annotated].tolist(),
+            arrays["image_video_ids"][annotated].tolist(),
+            arrays["image_timesteps"][annotated].tolist(),
+        ):
+            self.seq2images2timestep[vid_id][img_id] = t
+        self.seq2cls = {
+            vid["id"]: {
+                "pos_cat_ids": ragged("video_pos_cat_ids", i),
+                "neg_cat_ids": vid["neg_category_ids"],
+                "not_exh_labeled_cat_ids": vid["not_exhaustive_category_ids"],
+            }
+            for i, vid in enumerate(self.gt_data["videos"])
+        }
+
+    def _compile_gt(self, gt_data):
+        """Compile the GT json to flat numpy arrays.
+
+        The annotations are merged and mapped to timesteps as before, then
+        stored per video ordered by timestep, so that _load_raw_file only
+        slices them.
+        """
+        self.gt_data = gt_data
+        # merge categories marked with a merged tag in TAO dataset
+        self._merge_categories(gt_data["annotations"] + gt_data["tracks"])
+        # compute mappings from videos to annotation data
+        video2gt_track, self.video2gt_image = self._compute_vid_mappings(
+            gt_data["annotations"]
+        )
+        seq2images2timestep = self._compute_image_to_timestep_mappings()
+        video2gt_image = self.video2gt_image
+        del self.video2gt_image
+
+        def ragged(lists):
+            offsets = np.cumsum([0] + [len(x) for x in lists]).astype(np.int64)
+            return np.array([x for l in lists for x in l], dtype=np.int64), offsets
+
+        arrays = {}
+        videos = gt_data["videos"]
+        arrays["video_ids"] = np.array([vid["id"] for vid in videos], dtype=np.int64)
+        arrays["video_names"] = np.array([vid["name"] for vid in videos], dtype=str)
+        for name, lists in (
+            ("video_neg_cat_ids", [vid["neg_category_ids"] for vid in videos]),
+            (
+                "video_not_exh_cat_ids",
+                [vid["not_exhaustive_category_ids"] for vid in videos],
+            ),
+            (
+                "video_pos_cat_ids",
+                [
+                    list({track["category_id"] for track in video2gt_track[vid["id"]]})
+                    for vid in videos
+                ],
+            ),
+        ):
+            arrays[name], arrays[name + "_offsets"] = ragged(lists)
+
+        images = gt_data["images"]
+        arrays["image_ids"] = np.array([img["id"] for img in images], dtype=np.int64)
+        arrays["image_video_ids"] = np.array(
+            [img["video_id"] for img in images], dtype=np.int64
+        )
+        arrays["image_frame_indexes"] = np.array(
+            [img["frame_index"] for img in images], dtype=np.int64
+        )
+        arrays["image_timesteps"] = np.array(
+            [
+                seq2images2timestep.get(img["video_id"], {}).get(img["id"], -1)
+                for img in images
+            ],
+            dtype=np.int64,
+        )
+        arrays["categories"] = np.array(json.dumps(gt_data["categories"]))
+
+        # annotations of each video ordered by timestep, the order within an
+        # image is kept
+        ann_timesteps, ann_track_ids, ann_category_ids, ann_bboxes = [], [], [], []
+        ann_offsets = [0]
+        for vid in videos:
+            img_to_timestep = seq2images2timestep[vid["id"]]
+            video_anns = [
+                (img_to_timestep[img["id"]], ann)
+                for img in video2gt_image[vid["id"]]
+                if img["id"] in img_to_timestep
+                for ann in img["annotations"]
+            ]
+            video_anns.sort(key=lambda x: x[0])
+            ann_timesteps += [t for t, _ in video_anns]
+            ann_track_ids += [ann["track_id"] for _, ann in video_anns]
+            ann_category_ids += [ann["category_id"] for _, ann in video_anns]
+            ann_bboxes += [ann["bbox"] for _, ann in video_anns]
+            ann_offsets.append(len(ann_timesteps))
+        arrays["ann_timesteps"] = np.array(ann_timesteps, dtype=np.int64)
+        arrays["ann_track_ids"] = np.array(ann_track_ids, dtype=np.int64)
+        arrays["ann_category_ids"] = np.array(ann_category_ids, dtype=np.int64)
+        arrays["ann_bboxes"] = np.array(ann_bboxes, dtype=float).reshape(-1, 4)
+        arrays["video_ann_offsets"] = np.array(ann_offsets, dtype=np.int64)
+        return arrays
+
     def _load_raw_file(self, tracker, seq, is_gt):
         """Load a file (gt or tracker) in the TAO format
 
@@ -186,18 +360,44 @@ class TAO(_BaseDataset):
         [tk_dets]: list (for each timestep) of lists of detections.
         """
         seq_id = self.seq_name2seqid[seq]
-        # file location
+        # convert data to required format
+        num_timesteps = self.seq_lengths[seq_id]
         if is_gt:
-            imgs = self.video2gt_image[seq_id]
+            raw_data = self._slice_gt(seq_id, num_timesteps)
         else:
-            imgs = self.tracker_data[tracker]["vids_to_images"][seq_id]
+            raw_data = self._load_raw_tracker_data(tracker, seq_id, num_timesteps)
 
-        # convert data to required format
-        num_timesteps = self.seq_lengths[seq_id]
+        raw_data["num_timesteps"] = num_timesteps
+        raw_data["neg_cat_ids"] = self.seq2cls[seq_id]["neg_cat_ids"]
+        raw_data["not_exh_labeled_cls"] = self.seq2cls[seq_id][
+            "not_exh_labeled_cat_ids"
+        ]
+        raw_data["seq"] = seq
+        return raw_data
+
+    def _slice_gt(self, seq_id, num_timesteps):
+        """Per timestep GT arrays of a sequence, sliced from the compiled GT."""
+        arrays = self.gt_arrays
+        i = self.video2index[seq_id]
+        start, end = arrays["video_ann_offsets"][i : i + 2]
+        bounds = np.searchsorted(
+            arrays["ann_timesteps"][start:end], np.arange(num_timesteps + 1)
+        )
+        # copied, so that the compiled GT is never modified through raw data
+        ids = arrays["ann_track_ids"][start:end].copy()
+        classes = arrays["ann_category_ids"][start:end].copy()
+        dets = arrays["ann_bboxes"][start:end].copy()
+        return {
+            "gt_ids": [ids[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+            "gt_classes": [classes[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+            "gt_dets": [dets[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+        }
+
+    def _load_raw_tracker_data(self, tracker, seq_id, num_timesteps):
+        # file location
+        imgs = self.tracker_data[tracker]["vids_to_images"][seq_id]
         img_to_timestep = self.seq2images2timestep[seq_id]
-        data_keys = ["ids", "classes", "dets"]
-        if not is_gt:
-            data_keys += ["tk_confidences"]
+        data_keys = ["ids", "classes", "dets", "tk_confidences"]
         raw_data = {key: [None] * num_timesteps for key in data_keys}
         for img in imgs:
             # some tracker data contains images without any ground truth info,
@@ -215,32 +415,20 @@ class TAO(_BaseDataset):
             raw_data["classes"][t] = np.atleast_1d(
                 [ann["category_id"] for ann in anns]
             ).astype(int)
-            if not is_gt:
-                raw_data["tk_confidences"][t] = np.atleast_1d(
-                    [ann["score"] for ann in anns]
-                ).astype(float)
+            raw_data["tk_confidences"][t] = np.atleast_1d(
+                [ann["score"] for ann in anns]
+            ).astype(float)
 
         for t, d in enumerate(raw_data["dets"]):
             if d is None:
                 raw_data["dets"][t] = np.empty((0, 4)).astype(float)
                 raw_data["ids"][t] = np.empty(0).astype(int)
                 raw_data["classes"][t] = np.empty(0).astype(int)
-                if not is_gt:
-                    raw_data["tk_confidences"][t] = np.empty(0)
+                raw_data["tk_confidences"][t] = np.empty(0)
 
-        if is_gt:
-            key_map = {"ids": "gt_ids", "classes": "gt_classes", "dets": "gt_dets"}
-        else:
-            key_map = {"ids": "tk_ids", "classes": "tk_classes", "dets": "tk_dets"}
+        key_map = {"ids": "tk_ids", "classes": "tk_classes", "dets": "tk_dets"}
         for k, v in key_map.items():
             raw_data[v] = raw_data.pop(k)
-
-        raw_data["num_timesteps"] = num_timesteps
-        raw_data["neg_cat_ids"] = self.seq2cls[seq_id]["neg_cat_ids"]
-        raw_data["not_exh_labeled_cls"] = self.seq2cls[seq_id][
-            "not_exh_labeled_cat_ids"
-        ]
-        raw_data["seq"] = seq
         return raw_data
 
     def get_preprocessed_seq_data_thr(self, raw_data, cls, assignment=None):
@@ -300,141 +488,80 @@ class TAO(_BaseDataset):
             "sim_scores",
         ]
         data = {key: [None] * raw_data["num_timesteps"] for key in data_keys}
-        unique_gt_ids = []
-        unique_tk_ids = []
-        num_gt_dets = 0
-        num_tk_cls_dets = 0
-        num_tk_overlap_dets = 0
-        overlap_ious_thr = 0.5
-        loc_and_asso_tk_ids = []
+        tables = self._seq_tables(raw_data)
+        gt_table, tk_table = tables["gt"], tables["tk"]
 
-        for t in range(raw_data["num_timesteps"]):
-            # only extract relevant dets for this class for preproc and eval
-            if cls == "all":
-                gt_class_mask = np.ones_like(raw_data["gt_classes"][t]).astype(bool)
-            else:
-                gt_class_mask = np.atleast_1d(
-                    raw_data["gt_classes"][t] == cls_id
-                ).astype(bool)
-
-            # select GT that is not in the evaluating classes
-            if assignment is not None and assignment:
-                all_gt_ids = list(assignment[t].keys())
-                gt_ids_in = raw_data["gt_ids"][t][gt_class_mask]
-                gt_ids_out = set(all_gt_ids) - set(gt_ids_in)
-                tk_ids_out = set([assignment[t][key] for key in list(gt_ids_out)])
-
-            # compute overlapped tracks and add their ids to overlap_tk_ids
-            sim_scores = raw_data["similarity_scores"]
-            overlap_ids_masks = (sim_scores[t][gt_class_mask] >= overlap_ious_thr).any(
-                axis=0
-            )
-            overlap_tk_ids_t = raw_data["tk_ids"][t][overlap_ids_masks]
-            if assignment is not None and assignment:
-                data["tk_overlap_ids"][t] = list(set(overlap_tk_ids_t) - tk_ids_out)
-            else:
-                data["tk_overlap_ids"][t] = list(set(overlap_tk_ids_t))
-
-            loc_and_asso_tk_ids += data["tk_overlap_ids"][t]
+        # only extract relevant dets for this class for preproc and eval
+        if cls == "all":
+            gt_class_mask = np.ones(len(gt_table["ids"]), dtype=bool)
+        else:
+            gt_class_mask = gt_table["classes"] == cls_id
+
+        # tracker dets that overlap with a GT of the class
+        overlap_mask = np.zeros(len(tk_table["ids"]), dtype=bool)
+        overlap_mask[tables["overlap_tk"][gt_class_mask[tables["overlap_gt"]]]] = True
+        # except those assigned to GT that is not in the evaluating classes
+        if assignment is not None and assignment:
+            assigned_gt, assigned_tk = self._assignment_indexes(tables, assignment)
+            overlap_mask[assigned_tk[~gt_class_mask[assigned_gt]]] = False
+
+        # remove all unwanted unmatched tracker detections, i.e. keep the dets
+        # of the tracks that overlap with the GTs in any timestep
+        kept_tk = np.zeros(len(tk_table["unique_ids"]), dtype=bool)
+        kept_tk[tk_table["dense_ids"][overlap_mask]] = True
+        tk_mask = kept_tk[tk_table["dense_ids"]]
+        kept_gt = np.zeros(len(gt_table["unique_ids"]), dtype=bool)
+        kept_gt[gt_table["dense_ids"][gt_class_mask]] = True
 
-            data["tk_exh_ids"][t] = []
-            data["tk_neg_ids"][t] = []
+        # re-label IDs such that there are no empty IDs
+        unique_gt_ids = gt_table["unique_ids"][kept_gt]
+        unique_tk_ids = tk_table["unique_ids"][kept_tk]
+        gt_ids = (np.cumsum(kept_gt) - 1)[gt_table["dense_ids"]]
+        tk_ids = (np.cumsum(kept_tk) - 1)[tk_table["dense_ids"]]
+        if len(unique_gt_ids) > 0:
+            data["gt_id_map"] = dict(enumerate(unique_gt_ids))
+        if len(unique_tk_ids) > 0:
+            data["tk_id_map"] = dict(enumerate(unique_tk_ids))
 
-            if cls == "all":
-                continue
+        def split(key, flat, mask):
+            """Split the masked flat array of the tables of key by timestep."""
+            offsets = np.concatenate([[0], np.cumsum(mask)])[tables[key]["offsets"]]
+            offsets = offsets.tolist()
+            flat = flat[mask]
+            return [flat[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
 
-        # remove tk_ids that has been assigned to GT belongs to other classes.
-        loc_and_asso_tk_ids = list(set(loc_and_asso_tk_ids))
+        # add gt to the data
+        if cls != "all":
+            data["gt_classes"] = [cls_id] * raw_data["num_timesteps"]
+            data["gt_class_name"] = [cls] * raw_data["num_timesteps"]
+        data["gt_ids"] = split("gt", gt_ids, gt_class_mask)
+        data["gt_dets"] = split("gt", gt_table["dets"], gt_class_mask)
+
+        # add filtered prediction to the data, with the overlap classes for
+        # computing the FP for Cls term
+        data["tk_ids"] = split("tk", tk_ids, tk_mask)
+        data["tk_dets"] = split("tk", tk_table["dets"], tk_mask)
+        data["tk_classes"] = split("tk", tk_table["classes"], tk_mask)
+        data["tk_confidences"] = split("tk", tk_table["confidences"], tk_mask)
+        data["tk_overlap_ids"] = split("tk", tk_ids, overlap_mask)
+        data["tk_overlap_classes"] = split("tk", tk_table["classes"], overlap_mask)
+        data["tk_class_eval_tk_ids"] = [
+            set(ids.tolist()) for ids in split("tk", tk_table["ids"], overlap_mask)
+        ]
+        data["tk_exh_ids"] = [[] for _ in range(raw_data["num_timesteps"])]
+        data["tk_neg_ids"] = [[] for _ in range(raw_data["num_timesteps"])]
 
-        # remove all unwanted unmatched tracker detections
+        sim_scores = raw_data["similarity_scores"]
+        gt_offsets = gt_table["offsets"].tolist()
+        tk_offsets = tk_table["offsets"].tolist()
         for t in range(raw_data["num_timesteps"]):
-            # add gt to the data
-            if cls == "all":
-                gt_class_mask = np.ones_like(raw_data["gt_classes"][t]).astype(bool)
-            else:
-                gt_class_mask = np.atleast_1d(
-                    raw_data["gt_classes"][t] == cls_id
-                ).astype(bool)
-                data["gt_classes"][t] = cls_id
-                data["gt_class_name"][t] = cls
-
-            gt_ids = raw_data["gt_ids"][t][gt_class_mask]
-            gt_dets = raw_data["gt_dets"][t][gt_class_mask]
-            data["gt_ids"][t] = gt_ids
-            data["gt_dets"][t] = gt_dets
-
-            # filter pred and only keep those that highly overlap with GTs
-            tk_mask = np.isin(
-                raw_data["tk_ids"][t], np.array(loc_and_asso_tk_ids), assume_unique=True
-            )
-            tk_overlap_mask = np.isin(
-                raw_data["tk_ids"][t],
-                np.array(data["tk_overlap_ids"][t]),
-                assume_unique=True,
-            )
-
-            tk_ids = raw_data["tk_ids"][t][tk_mask]
-            tk_dets = raw_data["tk_dets"][t][tk_mask]
-            tracker_classes = raw_data["tk_classes"][t][tk_mask]
-
-            # add overlap classes for computing the FP for Cls term
-            tracker_overlap_classes = raw_data["tk_classes"][t][tk_overlap_mask]
-            tracker_confidences = raw_data["tk_confidences"][t][tk_mask]
-            sim_scores_masked = sim_scores[t][gt_class_mask, :][:, tk_mask]
-
-            # add filtered prediction to the data
-            data["tk_classes"][t] = tracker_classes
-            data["tk_overlap_classes"][t] = tracker_overlap_classes
-            data["tk_ids"][t] = tk_ids
-            data["tk_dets"][t] = tk_dets
-            data["tk_confidences"][t] = tracker_confidences
-            data["sim_scores"][t] = sim_scores_masked
-            data["tk_class_eval_tk_ids"][t] = set(
-                list(data["tk_overlap_ids"][t])
-                + list(data["tk_neg_ids"][t])
-                + list(data["tk_exh_ids"][t])
-            )
-
-            # count total number of detections
-            unique_gt_ids += list(np.unique(data["gt_ids"][t]))
-            # the unique track ids are for association.
-            unique_tk_ids += list(np.unique(data["tk_ids"][t]))
+            data["sim_scores"][t] = sim_scores[t][
+                gt_class_mask[gt_offsets[t] : gt_offsets[t + 1]], :
+            ][:, tk_mask[tk_offsets[t] : tk_offsets[t + 1]]]
 
-            num_tk_overlap_dets += len(data["tk_overlap_ids"][t])
-            num_tk_cls_dets += len(data["tk_class_eval_tk_ids"][t])
-            num_gt_dets += len(data["gt_ids"][t])
-
-        # re-label IDs such that there are no empty IDs
-        if len(unique_gt_ids) > 0:
-            unique_gt_ids = np.unique(unique_gt_ids)
-            gt_id_map = np.nan * np.ones((np.max(unique_gt_ids) + 1))
-            gt_id_map[unique_gt_ids] = np.arange(len(unique_gt_ids))
-            data["gt_id_map"] = {}
-            for gt_id in unique_gt_ids:
-                new_gt_id = gt_id_map[gt_id].astype(int)
-                data["gt_id_map"][new_gt_id] = gt_id
-
-            for t in range(raw_data["num_timesteps"]):
-                if len(data["gt_ids"][t]) > 0:
-                    data["gt_ids"][t] = gt_id_map[data["gt_ids"][t]].astype(int)
-
-        if len(unique_tk_ids) > 0:
-            unique_tk_ids = np.unique(unique_tk_ids)
-            tk_id_map = np.nan * np.ones((np.max(unique_tk_ids) + 1))
-            tk_id_map[unique_tk_ids] = np.arange(len(unique_tk_ids))
-
-            data["tk_id_map"] = {}
-            for track_id in unique_tk_ids:
-                new_track_id = tk_id_map[track_id].astype(int)
-                data["tk_id_map"][new_track_id] = track_id
-
-            for t in range(raw_data["num_timesteps"]):
-                if len(data["tk_ids"][t]) > 0:
-                    data["tk_ids"][t] = tk_id_map[data["tk_ids"][t]].astype(int)
-                if len(data["tk_overlap_ids"][t]) > 0:
-                    data["tk_overlap_ids"][t] = tk_id_map[
-                        data["tk_overlap_ids"][t]
-                    ].astype(int)
+        num_tk_cls_dets = sum(len(ids) for ids in data["tk_class_eval_tk_ids"])
+        num_tk_overlap_dets = int(overlap_mask.sum())
+        num_gt_dets = int(gt_class_mask.sum())
 
         # record overview statistics.
         data["num_tk_cls_dets"] = num_tk_cls_dets
@@ -445,10 +572,92 @@ class TAO(_BaseDataset):
         data["num_timesteps"] = raw_data["num_timesteps"]
         data["seq"] = raw_data["seq"]
 
-        self._check_unique_ids(data)
+        # ids are only relabeled, so there are duplicates to report only if
+        # the raw data has some
+        if tables["duplicate_ids"]:
+            self._check_unique_ids(data)
 
         return data
 
+    @staticmethod
+    def _seq_tables(raw_data):
+        """Per sequence tables shared by the preprocessing of all classes.
+
+        The GT and tracker dets of all timesteps are concatenated, with the
+        offsets of each timestep, their ids are mapped to indexes into the
+        sorted unique ids of the sequence, and the GT and tracker dets that
+        overlap are paired once. Cached in raw_data.
+        """
+        if "seq_tables" in raw_data:
+            return raw_data["seq_tables"]
+
+        overlap_ious_thr = 0.5
+        tables = {"assignments": {}, "duplicate_ids": False}
+        for key in ("gt", "tk"):
+            ids = raw_data[f"{key}_ids"]
+            flat_ids = np.concatenate([np.empty(0, dtype=int)] + list(ids)).astype(int)
+            unique_ids, dense_ids = np.unique(flat_ids, return_inverse=True)
+            dense_ids = dense_ids.reshape(-1)
+            offsets = np.cumsum([0] + [len(ids_t) for ids_t in ids])
+            timesteps = np.repeat(np.arange(len(ids)), np.diff(offsets))
+            # an id appearing more than once in a timestep
+            id_timesteps = np.unique(timesteps * len(unique_ids) + dense_ids)
+            tables["duplicate_ids"] |= len(id_timesteps) != len(flat_ids)
+            tables[key] = {
+                "offsets": offsets,
+                "ids": flat_ids,
+                "unique_ids": unique_ids,
+                "dense_ids": dense_ids,
+                "classes": np.concatenate(
+                    [np.empty(0, dtype=int)] + list(raw_data[f"{key}_classes"])
+                ),
+                "dets": np.concatenate(
+                    [np.empty((0, 4))] + list(raw_data[f"{key}_dets"])
+                ),
+            }
+        tables["tk"]["confidences"] = np.concatenate(
+            [np.empty(0)] + list(raw_data["tk_confidences"])
+        )
+
+        overlap_gt, overlap_tk = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+        for t, sim_scores_t in enumerate(raw_data["similarity_scores"]):
+            rows, cols = np.nonzero(sim_scores_t >= overlap_ious_thr)
+            overlap_gt.append(rows + tables["gt"]["offsets"][t])
+            overlap_tk.append(cols + tables["tk"]["offsets"][t])
+        tables["overlap_gt"] = np.concatenate(overlap_gt)
+        tables["overlap_tk"] = np.concatenate(overlap_tk)
+
+        raw_data["seq_tables"] = tables
+        return tables
+
+    @staticmethod
+    def _assignment_indexes(tables, assignment):
+        """Indexes into the tables of _seq_tables of the GT and tracker dets
+        paired by a global assignment, cached per assignment."""
+        cache = tables["assignments"]
+        if id(assignment) not in cache:
+
+            def flat_indexes(table, t, ids):
+                start, end = table["offsets"][t : t + 2]
+                ids_t = table["ids"][start:end]
+                sorter = np.argsort(ids_t)
+                return start + sorter[np.searchsorted(ids_t, ids, sorter=sorter)]
+
+            assigned_gt, assigned_tk = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+            for t, pairs in assignment.items():
+                if pairs:
+                    assigned_gt.append(flat_indexes(tables["gt"], t, list(pairs)))
+                    assigned_tk.append(
+                        flat_indexes(tables["tk"], t, list(pairs.values()))
+                    )
+            # the assignment is kept so that its id is not reused
+            cache[id(assignment)] = (
+                assignment,
+                np.concatenate(assigned_gt),
+                np.concatenate(assigned_tk),
+            )
+        return cache[id(assignment)][1:]
+
     @_timing.time
     def get_preprocessed_seq_data(
         self, raw_data, cls, assignment=None, thresholds=[50, 75]
@@ -475,6 +684,10 @@ class TAO(_BaseDataset):
         sim_scores = self._calculate_box_ious(gt_dets_t, tk_dets_t)
         return sim_scores
 
+    def _calculate_seq_similarities(self, gt_dets, tk_dets):
+        """Compute similarity scores of all timesteps at once."""
+        return self._calculate_ragged_box_ious(gt_dets, tk_dets)
+
     def _merge_categories(self, annotations):
         """Merges categories with a merged tag.
 
@@ -1,10 +1,7 @@
-import copy
 import os
-import pickle
 import time
 import traceback
-from functools import partial
-from multiprocessing.pool import Pool
+import multiprocessing
 
 import numpy as np
 
@@ -100,16 +97,11 @@ class Evaluator:
         time_start = time.time()
         config = self.config
         if config["USE_PARALLEL"]:
-            with Pool(config["NUM_PARALLEL_CORES"]) as pool:
-                _eval_sequence = partial(
-                    eval_sequence,
-                    dataset=dataset,
-                    tracker=tracker,
-                    class_list=class_list,
-                    metrics_list=metrics_list,
-                    metric_names=metric_names,
-                )
-                results = pool.map(_eval_sequence, seq_list)
+            with _eval_worker_pool(
+                config["NUM_PARALLEL_CORES"],
+                (dataset, tracker, class_list, metrics_list, metric_names),
+            ) as pool:
+                results = pool.map(_eval_sequence_in_worker, seq_list)
                 res = dict(zip(seq_list, results))
         else:
             res = {}
@@ -118,7 +110,34 @@ class Evaluator:
                     curr_seq, dataset, tracker, class_list, metrics_list, metric_names
                 )
 
+        return self.combine_tracker_results(
+            res,
+            tracker,
+            dataset,
+            dname,
+            class_list,
+            metrics_list,
+            metric_names,
+            output_res,
+            output_msg,
+            time_start,
+        )
 
+    def combine_tracker_results(
+        self,
+        res,
+        tracker,
+        dataset,
+        dname,
+        class_list,
+        metrics_list,
+        metric_names,
+        output_res,
+        output_msg,
+        time_start,
+    ):
+        """Combine the per sequence results of a tracker and output them."""
+        config = self.config
         # collecting combined cls keys (cls averaged, det averaged, super classes)
         cls_keys = []
         res["COMBINED_SEQ"] = {}
@@ -178,58 +197,186 @@ class Evaluator:
         output_fol = dataset.get_output_fol(tracker)
         os.makedirs(output_fol, exist_ok=True)
 
-        # take a mean of each field of each thr
+        # summarize each field of each thr
         if config["OUTPUT_PER_SEQ_RES"]:
-            all_res = copy.deepcopy(res)
-            summary_keys = res.keys()
+            summary_keys = list(res.keys())
         else:
-            all_res = copy.deepcopy(res["COMBINED_SEQ"])
             summary_keys = ["COMBINED_SEQ"]
         thr_key_list = [50]
-        for s_key in summary_keys:
-            for metric, mname in zip(metrics_list, metric_names):
-                if mname != "TETA":
-                    if s_key == "COMBINED_SEQ":
-                        metric.print_table(
-                            {"COMBINED_SEQ": res["COMBINED_SEQ"][cls_keys[0]][mname]},
-                            tracker,
-                            cls_keys[0],
-                        )
-                    continue
-
-                for c_cls in res[s_key].keys():
-                    for thr in thr_key_list:
-                        all_res[s_key][c_cls][mname][thr] = metric._summary_row(
-                            res[s_key][c_cls][mname][thr]
-                        )
-                    x = (
-                        np.array(list(all_res[s_key][c_cls]["TETA"].values()))
-                        .astype("float")
-                        .mean(axis=0)
+        for metric, mname in zip(metrics_list, metric_names):
+            if mname != "TETA":
+                metric.print_table(
+                    {"COMBINED_SEQ": res["COMBINED_SEQ"][cls_keys[0]][mname]},
+                    tracker,
+                    cls_keys[0],
+                )
+                continue
+
+            summary = metric.summary_results(
+                {
+                    s_key: {
+                        c_cls: c_res[mname] for c_cls, c_res in res[s_key].items()
+                    }
+                    for s_key in summary_keys
+                },
+                thr_key_list,
+            )
+            if config["OUTPUT_SUMMARY"]:
+                for t in thr_key_list:
+                    metric.print_summary_table(
+                        metric._summary_row(res["COMBINED_SEQ"][cls_keys[0]][mname][t]),
+                        t,
+                        tracker,
+                        cls_keys[0],
                     )
-                    all_res_summary = list(x.round(decimals=2).astype("str"))
-                    all_res[s_key][c_cls][mname]["ALL"] = all_res_summary
-                if config["OUTPUT_SUMMARY"] and s_key == "COMBINED_SEQ":
-                    for t in thr_key_list:
-                        metric.print_summary_table(
-                            all_res[s_key][cls_keys[0]][mname][t],
-                            t,
-                            tracker,
-                            cls_keys[0],
-                        )
-
-        if config["OUTPUT_TEM_RAW_DATA"]:
-            out_file = os.path.join(output_fol, "teta_summary_results.pth")
-            pickle.dump(all_res, open(out_file, "wb"))
-            print("Saved the TETA summary results.")
-
-        # output
-        output_res[dname][mname] = all_res[s_key][cls_keys[0]][mname][t]
+
+            if config["OUTPUT_TEM_RAW_DATA"]:
+                out_file = os.path.join(output_fol, "teta_summary_results.npz")
+                np.savez_compressed(out_file, **summary)
+                print("Saved the TETA summary results.")
+
+            # output
+            output_res[dname][mname] = metric._summary_row(
+                res["COMBINED_SEQ"][cls_keys[0]][mname][thr_key_list[-1]]
+            )
+            output_res[dname][tracker] = summary
         output_msg[dname][tracker] = "Success"
 
         return output_res, output_msg
 
 
+class OnlineEvaluator(Evaluator):
+    """Evaluator that evaluates the sequences of a tracker as they are done.
+
+    The dataset has to be created without tracker data
+    (TRACKER_SUB_FOLDER None). Each sequence handed to ``add_sequence`` is
+    evaluated right away, in a worker pool when USE_PARALLEL is set, and
+    ``finalize`` combines all sequences the same way as ``evaluate`` does.
+    Sequences that were never added are evaluated without any tracker
+    output.
+
+    The pool is started in ``__init__``. By default its workers are forked,
+    which copies the whole process: the evaluator then has to be created
+    before CUDA (or anything else that is not fork-safe) is initialized.
+    Otherwise pass ``start_method="forkserver"`` or ``"spawn"``; the dataset
+    is then pickled to each worker once, when the pool starts.
+    """
+
+    def __init__(self, dataset, metrics_list, tracker=None, config=None, start_method=None):
+        super().__init__(config)
+        self.dataset = dataset
+        self.metrics_list = metrics_list
+        self.metric_names = utils.validate_metrics_list(metrics_list)
+        tracker_list, self.seq_list, self.class_list = dataset.get_eval_info()
+        self.tracker = tracker_list[0] if tracker is None else tracker
+        self.time_start = time.time()
+        self.results = {}
+
+        self.pool = None
+        if self.config["USE_PARALLEL"]:
+            self.pool = _eval_worker_pool(
+                self.config["NUM_PARALLEL_CORES"],
+                (dataset, self.tracker, self.class_list, metrics_list, self.metric_names),
+                start_method,
+            )
+
+    def add_sequence(self, seq, annotations):
+        """Evaluate a sequence from its tracker annotations (TAO json style)."""
+        if seq in self.results:
+            raise TrackEvalException(f"Sequence {seq} was already added.")
+        if self.pool is not None:
+            self.results[seq] = self.pool.apply_async(
+                _eval_online_sequence_in_worker, (seq, annotations)
+            )
+        else:
+            self.results[seq] = eval_online_sequence(
+                seq,
+                annotations,
+                self.dataset,
+                self.tracker,
+                self.class_list,
+                self.metrics_list,
+                self.metric_names,
+            )
+
+    def finalize(self):
+        """Wait for all sequences and combine their results."""
+        for seq in self.seq_list:
+            if seq not in self.results:
+                self.add_sequence(seq, [])
+        # same sequence order as evaluate_tracker
+        seq_list = self.seq_list if self.pool is not None else sorted(self.seq_list)
+        try:
+            res = {
+                seq: self.results[seq].get() if self.pool is not None else self.results[seq]
+                for seq in seq_list
+            }
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+        dname = self.dataset.get_name()
+        print("\nEvaluating %s\n" % self.tracker)
+        return self.combine_tracker_results(
+            res,
+            self.tracker,
+            self.dataset,
+            dname,
+            self.class_list,
+            self.metrics_list,
+            self.metric_names,
+            {dname: {}},
+            {dname: {}},
+            self.time_start,
+        )
+
+
+# Arguments of eval_sequence shared by every task of a worker process.
+_worker_args = None
+
+
+def _eval_worker_pool(num_processes, worker_args, start_method=None):
+    """Pool whose workers get the arguments of eval_sequence at start-up.
+
+    The dataset holds the whole GT and tracker json. It is handed to the
+    workers once instead of with every task: with fork they inherit it
+    without any pickling, and a task is only the name of its sequence.
+    ``start_method`` defaults to fork where it is available.
+    """
+    if start_method is not None:
+        context = multiprocessing.get_context(start_method)
+    elif "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    return context.Pool(
+        num_processes, initializer=_init_eval_worker, initargs=worker_args
+    )
+
+
+def _init_eval_worker(dataset, tracker, class_list, metrics_list, metric_names):
+    global _worker_args
+    _worker_args = (dataset, tracker, class_list, metrics_list, metric_names)
+
+
+def _eval_sequence_in_worker(seq):
+    return eval_sequence(seq, *_worker_args)
+
+
+def _eval_online_sequence_in_worker(seq, annotations):
+    return eval_online_sequence(seq, annotations, *_worker_args)
+
+
+def eval_online_sequence(
+    seq, annotations, dataset, tracker, class_list, metrics_list, metric_names
+):
+    """Evaluate a single sequence from its tracker annotations."""
+    dataset.set_tracker_seq_data(tracker, seq, annotations)
+    return eval_sequence(seq, dataset, tracker, class_list, metrics_list, metric_names)
+
+
 @_timing.time
 def eval_sequence(seq, dataset, tracker, class_list, metrics_list, metric_names):
     """Function for evaluating a single sequence."""
@@ -252,9 +399,27 @@ def eval_sequence(seq, dataset, tracker, class_list, metrics_list, metric_names)
             for key in thresholds
         }
 
+    # The tracker dets kept for a class are the ones overlapping its GT, so a
+    # class without GT in the sequence preprocesses to empty data, which only
+    # differs between such classes by class fields that are never read for an
+    # empty sequence. It is built once and only the classes present in the GT
+    # are preprocessed on their own.
+    gt_cls_ids = np.unique(np.concatenate([np.empty(0, dtype=int)] + raw_data["gt_classes"]))
+    present_classes = {
+        dataset.clsid2cls_name[cid] for cid in gt_cls_ids if cid in dataset.clsid2cls_name
+    }
+    empty_data = None
+
     for cls in class_list:
         seq_res[cls] = {}
-        data = dataset.get_preprocessed_seq_data(raw_data, cls, assignment, thresholds)
+        if cls in present_classes:
+            data = dataset.get_preprocessed_seq_data(raw_data, cls, assignment, thresholds)
+        else:
+            if empty_data is None:
+                empty_data = dataset.get_preprocessed_seq_data(
+                    raw_data, cls, assignment, thresholds
+                )
+            data = empty_data
 
         for metric, mname in zip(metrics_list, metric_names):
             if mname == "TETA":
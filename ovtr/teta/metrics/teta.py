@@ -2,11 +2,71 @@
 
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 from .. import _timing
 from ._base_metric import _BaseMetric
 
 EPS = np.finfo("float").eps  # epsilon
+# below this many dets on either side the dense solver is faster
+GATED_ASSIGNMENT_MIN_DETS = 400
+
+
+def gated_linear_sum_assignment(score_mat):
+    """Maximum score matching over the positive entries of a score matrix.
+
+    The bipartite graph of the positive entries is split into connected
+    components, which are solved independently. A component with a single
+    row or a single column is matched on its best pair directly. Unlike
+    linear_sum_assignment, the matching does not contain pairs of zero
+    score, so it may cover less than min(rows, cols) entries. Its positive
+    pairs are those of linear_sum_assignment(-score_mat), up to exact ties.
+    """
+    num_rows, num_cols = score_mat.shape
+    pos_rows, pos_cols = np.divmod(np.flatnonzero(score_mat > 0), num_cols)
+    if len(pos_rows) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    adjacency = csr_matrix(
+        (np.ones(len(pos_rows), dtype=bool), (pos_rows, pos_cols + num_rows)),
+        shape=(num_rows + num_cols, num_rows + num_cols),
+    )
+    num_labels, labels = connected_components(adjacency, directed=False)
+    rows_per_label = np.bincount(labels[:num_rows], minlength=num_labels)
+    cols_per_label = np.bincount(labels[num_rows:], minlength=num_labels)
+
+    # components with a single row or column: their best pair
+    edge_labels = labels[pos_rows]
+    star = (rows_per_label == 1) | (cols_per_label == 1)
+    star_edges = np.nonzero(star[edge_labels])[0]
+    order = np.lexsort(
+        (-score_mat[pos_rows[star_edges], pos_cols[star_edges]], edge_labels[star_edges])
+    )
+    star_edges = star_edges[order]
+    first = np.ones(len(star_edges), dtype=bool)
+    first[1:] = edge_labels[star_edges[1:]] != edge_labels[star_edges[:-1]]
+    match_rows, match_cols = [pos_rows[star_edges[first]]], [pos_cols[star_edges[first]]]
+
+    # the other components, solved on their own sub-matrices
+    multi = np.nonzero(~star & (rows_per_label > 0) & (cols_per_label > 0))[0]
+    if len(multi):
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.stack([multi, multi + 1]))
+        for start, end in zip(*bounds):
+            nodes = order[start:end]
+            rows = nodes[nodes < num_rows]
+            cols = nodes[nodes >= num_rows] - num_rows
+            sub_mat = score_mat[rows[:, None], cols[None, :]]
+            sub_rows, sub_cols = linear_sum_assignment(-sub_mat)
+            keep = sub_mat[sub_rows, sub_cols] > 0
+            match_rows.append(rows[sub_rows[keep]])
+            match_cols.append(cols[sub_cols[keep]])
+
+    match_rows = np.concatenate(match_rows)
+    match_cols = np.concatenate(match_cols)
+    order = np.argsort(match_rows)
+    return match_rows[order], match_cols[order]
 
 
 class TETA(_BaseMetric):
@@ -101,9 +161,12 @@ class TETA(_BaseMetric):
 
         # global alignment score
         ga_score, gt_id_count, tk_id_count = self.compute_global_alignment_score(data)
-        matches_counts = [np.zeros_like(ga_score) for _ in self.array_labels]
 
-        # calculate scores for each timestep
+        # collect the matches of all timesteps, the thresholds are applied
+        # to all of them at once below
+        match_gt_ids, match_tk_ids, match_sims = [], [], []
+        match_correct_cls, match_tk_cls, match_fpl = [], [], []
+        num_gt_dets, num_fpl_candidates = 0, 0
         for t, (gt_ids_t, tk_ids_t, tk_overlap_ids_t, tk_cls_ids_t) in enumerate(
             zip(
                 data["gt_ids"],
@@ -119,11 +182,12 @@ class TETA(_BaseMetric):
                 continue
 
             # get matches optimizing for TETA
-            amatch_rows, amatch_cols = self.compute_matches(
-                data, t, ga_score, gt_ids_t, tk_ids_t, list(self.array_labels)
+            match_rows, match_cols = self._hungarian_matches(
+                data, t, ga_score, gt_ids_t, tk_ids_t
             )
 
-            # map overlap_ids to original ids.
+            # overlap ids that localize a GT at this threshold, unique as
+            # tk_overlap_ids_t is.
             if len(tk_overlap_ids_t) != 0:
                 sorter = np.argsort(tk_ids_t)
                 indexes = sorter[
@@ -131,43 +195,62 @@ class TETA(_BaseMetric):
                 ]
                 sim_t = data["sim_scores"][t][:, indexes]
                 fpl_candidates = tk_overlap_ids_t[(sim_t >= (thr / 100)).any(axis=0)]
-                fpl_candidates_ori_ids_t = np.array(
-                    [data["tk_id_map"][tid] for tid in fpl_candidates]
-                )
             else:
-                fpl_candidates_ori_ids_t = []
+                fpl_candidates = np.empty(0, dtype=int)
 
             if self.exhaustive:
                 cls_fp_thr[cls] += len(tk_cls_ids_t) - len(tk_overlap_ids_t)
 
-            # calculate and accumulate basic statistics
-            for a, alpha in enumerate(self.array_labels):
-                match_row, match_col = amatch_rows[a], amatch_cols[a]
-                num_matches = len(match_row)
-                matched_ori_ids = set(
-                    [data["tk_id_map"][tid] for tid in tk_ids_t[match_col]]
-                )
-                match_tk_cls = data["tk_classes"][t][match_col]
-                wrong_tk_cls = match_tk_cls[match_tk_cls != data["gt_classes"][t]]
-
-                num_class_and_det_matches = np.sum(
-                    match_tk_cls == data["gt_classes"][t]
-                )
-
-                if alpha >= 0.5:
-                    for cid in wrong_tk_cls:
-                        if cid in cid2clsname:
-                            cname = cid2clsname[cid]
-                            cls_fp_thr[cname][a - 10] += 1
-                    res["Cls_TP"][a - 10] += num_class_and_det_matches
-                    res["Cls_FN"][a - 10] += num_matches - num_class_and_det_matches
-
-                res["Loc_TP"][a] += num_matches
-                res["Loc_FN"][a] += len(gt_ids_t) - num_matches
-                res["Loc_FP"][a] += len(set(fpl_candidates_ori_ids_t) - matched_ori_ids)
-
-                if num_matches > 0:
-                    matches_counts[a][gt_ids_t[match_row], tk_ids_t[match_col]] += 1
+            matched_tk_ids = tk_ids_t[match_cols]
+            tk_cls = data["tk_classes"][t][match_cols]
+            match_gt_ids.append(gt_ids_t[match_rows])
+            match_tk_ids.append(matched_tk_ids)
+            match_sims.append(data["sim_scores"][t][match_rows, match_cols])
+            match_correct_cls.append(tk_cls == data["gt_classes"][t])
+            match_tk_cls.append(tk_cls)
+            match_fpl.append(np.isin(matched_tk_ids, fpl_candidates))
+            num_gt_dets += len(gt_ids_t)
+            num_fpl_candidates += len(fpl_candidates)
+
+        matches_counts = np.zeros((len(self.array_labels),) + ga_score.shape)
+        if match_sims:
+            match_gt_ids = np.concatenate(match_gt_ids)
+            match_tk_ids = np.concatenate(match_tk_ids)
+            match_correct_cls = np.concatenate(match_correct_cls).astype(bool)
+            match_tk_cls = np.concatenate(match_tk_cls)
+            match_fpl = np.concatenate(match_fpl)
+
+            # matched[a, m]: match m is kept at localization threshold alpha a
+            matched = (
+                np.concatenate(match_sims)[None, :]
+                >= self.array_labels[:, None] - EPS
+            )
+            num_matches = matched.sum(axis=1)
+            res["Loc_TP"] += num_matches
+            res["Loc_FN"] += num_gt_dets - num_matches
+            # tk ids are unique per timestep, so every matched fpl candidate
+            # is one candidate less counted as FP
+            res["Loc_FP"] += num_fpl_candidates - (matched & match_fpl).sum(axis=1)
+
+            cls_alphas = np.nonzero(self.array_labels >= 0.5)[0]
+            cls_matched = matched[cls_alphas]
+            res["Cls_TP"][cls_alphas - 10] += (cls_matched & match_correct_cls).sum(axis=1)
+            res["Cls_FN"][cls_alphas - 10] += (cls_matched & ~match_correct_cls).sum(axis=1)
+            wrong_tk_cls = match_tk_cls[~match_correct_cls]
+            wrong_matched = cls_matched[:, ~match_correct_cls]
+            for cid in np.unique(wrong_tk_cls):
+                if cid in cid2clsname:
+                    cname = cid2clsname[cid]
+                    cls_fp_thr[cname][cls_alphas - 10] += wrong_matched[
+                        :, wrong_tk_cls == cid
+                    ].sum(axis=1)
+
+            alpha_idxes, match_idxes = np.nonzero(matched)
+            np.add.at(
+                matches_counts,
+                (alpha_idxes, match_gt_ids[match_idxes], match_tk_ids[match_idxes]),
+                1,
+            )
 
         # calculate AssocA, AssocRe, AssocPr
         self.compute_association_scores(res, matches_counts, gt_id_count, tk_id_count)
@@ -201,15 +284,41 @@ class TETA(_BaseMetric):
         ga_score = num_matches / (gt_id_count + tk_id_count - num_matches)
         return ga_score, gt_id_count, tk_id_count
 
-    def compute_matches(self, data, t, ga_score, gt_ids, tk_ids, alpha):
-        """Compute matches based on alignment score."""
+    def _hungarian_matches(self, data, t, ga_score, gt_ids, tk_ids, min_alpha=0.0):
+        """Match gt and tracker dets of a timestep on alignment score.
+
+        Pairs of zero score only pass a zero alpha threshold. For large
+        timesteps above it, or when the positive pairs alone already match
+        min(rows, cols) dets, the matching is solved on the non-zero
+        components of the score matrix; otherwise the zero pairs the dense
+        Hungarian algorithm adds are kept as they are.
+        """
         sim = data["sim_scores"][t]
         score_mat = ga_score[gt_ids[:, None], tk_ids[None, :]] * sim
+        full_size = min(score_mat.shape)
+        if full_size < GATED_ASSIGNMENT_MIN_DETS:
+            gated = False
+        elif min_alpha <= EPS:
+            positive = score_mat > 0
+            gated = min(positive.any(axis=1).sum(), positive.any(axis=0).sum()) == full_size
+        else:
+            gated = True
+        if gated:
+            match_rows, match_cols = gated_linear_sum_assignment(score_mat)
+            if min_alpha > EPS or len(match_rows) == full_size:
+                return match_rows, match_cols
         # Hungarian algorithm to find best matches
-        match_rows, match_cols = linear_sum_assignment(-score_mat)
+        return linear_sum_assignment(-score_mat)
 
+    def compute_matches(self, data, t, ga_score, gt_ids, tk_ids, alpha):
+        """Compute matches based on alignment score."""
+        sim = data["sim_scores"][t]
         if not isinstance(alpha, list):
             alpha = [alpha]
+        match_rows, match_cols = self._hungarian_matches(
+            data, t, ga_score, gt_ids, tk_ids, min_alpha=min(alpha)
+        )
+
         alpha_match_rows, alpha_match_cols = [], []
         for a in alpha:
             matched_mask = sim[match_rows, match_cols] >= a - EPS
@@ -386,6 +495,47 @@ class TETA(_BaseMetric):
 
         return res
 
+    def summary_results(self, res, thresholds):
+        """Summary values of results, the values of _summary_row as floats.
+
+        Args:
+            res: dict (for each sequence) of dicts (for each class) of the
+                results of each threshold.
+            thresholds: thresholds to summarize.
+        Returns:
+            dict of the arrays "seqs", "classes", "thresholds", "fields" and
+            "values", the latter indexed by (seq, class, threshold, field)
+            and NaN for a class without results in a sequence.
+        """
+        classes = list(dict.fromkeys(cls for seq_res in res.values() for cls in seq_res))
+        cls_index = {cls: i for i, cls in enumerate(classes)}
+        entries = [
+            (s, cls_index[cls], cls_res)
+            for s, seq_res in enumerate(res.values())
+            for cls, cls_res in seq_res.items()
+        ]
+        seq_idx = [s for s, _, _ in entries]
+        cls_idx = [c for _, c, _ in entries]
+
+        values = np.full(
+            (len(res), len(classes), len(thresholds), len(self.summary_fields)), np.nan
+        )
+        if entries:
+            for t, thr in enumerate(thresholds):
+                for f, field in enumerate(self.summary_fields):
+                    field_values = np.array(
+                        [cls_res[thr][field] for _, _, cls_res in entries], dtype=float
+                    ).reshape(len(entries), -1)
+                    values[seq_idx, cls_idx, t, f] = 100 * field_values.mean(axis=1)
+
+        return {
+            "seqs": np.array(list(res), dtype=str),
+            "classes": np.array(classes, dtype=str),
+            "thresholds": np.array(thresholds),
+            "fields": np.array(self.summary_fields, dtype=str),
+            "values": values,
+        }
+
     def print_summary_table(self, thr_res, thr, tracker, cls):
         """Prints summary table of results."""
         print("")
@@ -0,0 +1,148 @@
+"""Check that --accum_steps N gives the update of an N-clip batch.
+
+A small stand-in model with an ``OVFrameMatcher``-like criterion (losses
+summed over the samples of a clip, normalized by ``get_num_boxes`` unless
+``normalize=False``) is trained on CPU with ``train_one_epoch_mot``. The
+clips have different numbers of samples, so averaging per-clip normalized
+losses would not give the batch update::
+
+    python tools/check_accum.py
+
+One update over ``--accum_steps`` batches of one clip each is compared with
+one update over a single batch holding all of these clips. SGD with lr 1 is
+used, so the parameter change is the (clipped) gradient. The script exits
+with status 1 if they differ.
+"""
+
+import argparse
+import copy
+import os
+import sys
+
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import train_one_epoch_mot  # noqa: E402
+from util.events import EventStorage  # noqa: E402
+
+
+class ToyModel(nn.Module):
+    def __init__(self, dim=16):
+        super().__init__()
+        self.net = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, 4))
+
+    def forward(self, data):
+        return {
+            "pred_boxes": self.net(data["imgs"]).sigmoid(),
+            "gt_boxes": data["gt_boxes"],
+            "track_instances": None,
+        }
+
+
+class ToyCriterion(nn.Module):
+    """Sums the losses over the ground truth boxes of every clip of the
+    batch; ``num_samples`` is their number, as in ``OVFrameMatcher``."""
+
+    def __init__(self):
+        super().__init__()
+        self.weight_dict = {"loss_bbox": 5.0, "loss_norm": 1.0}
+        self.num_samples = 0
+
+    def get_num_boxes(self, num_samples):
+        return max(float(num_samples), 1.0)
+
+    def forward(self, outputs, normalize=True):
+        losses = {"loss_bbox": 0.0, "loss_norm": 0.0}
+        self.num_samples = 0
+        for pred, gt in zip(outputs["pred_boxes"], outputs["gt_boxes"]):
+            pred = pred[: len(gt)]
+            losses["loss_bbox"] = losses["loss_bbox"] + (pred - gt).abs().sum()
+            losses["loss_norm"] = losses["loss_norm"] + (pred**2).sum()
+            self.num_samples += len(gt)
+        if normalize:
+            num_boxes = self.get_num_boxes(self.num_samples)
+            losses = {k: v / num_boxes for k, v in losses.items()}
+        return losses
+
+
+def make_clips(num_clips, num_queries=10, dim=16, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    clips = []
+    for _ in range(num_clips):
+        num_gt = int(torch.randint(1, num_queries + 1, (1,), generator=g))
+        clips.append(
+            (
+                torch.randn(num_queries, dim, generator=g),
+                torch.rand(num_gt, 4, generator=g),
+            )
+        )
+    return clips
+
+
+def batch(clips, start=0):
+    return {
+        "imgs": torch.stack([imgs for imgs, _ in clips]),
+        "gt_boxes": [gt for _, gt in clips],
+        "filename": [f"{start + i}.jpg" for i in range(len(clips))],
+    }
+
+
+def update(model, loader, accum_steps, max_norm):
+    model = copy.deepcopy(model)
+    before = [p.detach().clone() for p in model.parameters()]
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    with EventStorage(0):
+        train_one_epoch_mot(
+            model,
+            ToyCriterion(),
+            loader,
+            optimizer,
+            torch.device("cpu"),
+            0,
+            max_norm=max_norm,
+            accum_steps=accum_steps,
+        )
+    return [q - p.detach() for p, q in zip(model.parameters(), before)]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Gradient accumulation check", add_help=False)
+    parser.add_argument("--accum_steps", default=4, type=int)
+    parser.add_argument("--clip_max_norm", default=0.1, type=float)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Gradient accumulation check", parents=[get_args_parser()]
+    )
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    model = ToyModel()
+    clips = make_clips(args.accum_steps, seed=args.seed)
+
+    failed = False
+    for max_norm in (0.0, args.clip_max_norm):
+        accumulated = update(
+            model,
+            [batch([clip], i) for i, clip in enumerate(clips)],
+            args.accum_steps,
+            max_norm,
+        )
+        batched = update(model, [batch(clips)], 1, max_norm)
+        max_diff = max((a - b).abs().max().item() for a, b in zip(accumulated, batched))
+        ok = all(
+            torch.allclose(a, b, rtol=1e-5, atol=1e-7)
+            for a, b in zip(accumulated, batched)
+        )
+        failed |= not ok
+        print(
+            f"accum_steps={args.accum_steps} vs batch of {args.accum_steps} clips, "
+            f"clip_max_norm={max_norm}: max gradient difference {max_diff:.3g}"
+            + ("" if ok else "  MISMATCH")
+        )
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,229 @@
+"""CPU smoke test of the mixed precision training path.
+
+The OVTR model itself needs the CUDA deformable attention op, so a small
+stand-in model and criterion with the same interface are trained with
+``train_one_epoch_mot`` instead::
+
+    python tools/check_amp.py
+
+It checks that
+
+* ``to_fp32`` casts the tensors of nested output lists, tuples and dicts,
+* a bf16 epoch (``--amp --amp_dtype bfloat16``) runs on CPU, including a
+  ``util.checkpoint`` recomputation, keeps the parameters in fp32 and
+  matches the fp32 epoch within bf16 precision,
+* under an enabled GradScaler (fp16) a non-finite loss skips the update and
+  lowers the scale instead of stopping the training. This part needs a torch
+  whose ``torch.amp.GradScaler`` supports CPU and is skipped otherwise.
+
+The script exits with status 1 on the first failed check.
+"""
+
+import argparse
+import copy
+import os
+import sys
+
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import train_one_epoch_mot  # noqa: E402
+from util.checkpoint import CheckpointFunction  # noqa: E402
+from util.events import EventStorage  # noqa: E402
+from util.misc import to_fp32  # noqa: E402
+
+
+def _fail(msg):
+    print(f"FAILED: {msg}")
+    sys.exit(1)
+
+
+class ToyTracker(nn.Module):
+    """Maps ``imgs`` to per-query logits and boxes, the middle block run
+    through ``CheckpointFunction`` like the checkpointed decoder layers."""
+
+    def __init__(self, dim=16, num_queries=8, num_classes=4):
+        super().__init__()
+        self.num_queries = num_queries
+        self.embed = nn.Linear(dim, dim * num_queries)
+        self.block = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, dim))
+        self.class_embed = nn.Linear(dim, num_classes)
+        self.bbox_embed = nn.Linear(dim, 4)
+
+    def forward(self, data):
+        x = self.embed(data["imgs"])
+        x = x.view(x.shape[0], self.num_queries, -1)
+        params = tuple(self.block.parameters())
+        x = CheckpointFunction.apply(lambda x: (self.block(x),), 1, x, *params)[0]
+        return {
+            "pred_logits": self.class_embed(x),
+            "pred_boxes": self.bbox_embed(x).sigmoid(),
+            "aux_outputs": [{"pred_logits": self.class_embed(x)}],
+            "track_instances": None,
+        }
+
+
+class ToyCriterion(nn.Module):
+    """Same call interface as ``ClipMatcher``; ``inf_steps`` make the loss of
+    those calls non-finite, as an fp16 overflow would."""
+
+    def __init__(self, targets, inf_steps=()):
+        super().__init__()
+        self.targets = targets
+        self.inf_steps = set(inf_steps)
+        self.weight_dict = {"loss_ce": 1.0, "loss_bbox": 5.0, "aux_loss_ce": 1.0}
+        self.num_samples = 0
+        self.calls = 0
+
+    def get_num_boxes(self, num_samples):
+        return max(float(num_samples), 1.0)
+
+    def forward(self, outputs, normalize=True):
+        outputs = to_fp32(outputs)
+        for v in (outputs["pred_logits"], outputs["aux_outputs"][0]["pred_logits"]):
+            if v.dtype != torch.float32:
+                _fail("to_fp32 left a low precision output")
+        labels, boxes = self.targets
+        self.num_samples = labels.numel()
+        losses = {
+            "loss_ce": nn.functional.cross_entropy(
+                outputs["pred_logits"].flatten(0, 1), labels.flatten(), reduction="sum"
+            ),
+            "loss_bbox": (outputs["pred_boxes"] - boxes).abs().sum(),
+            "aux_loss_ce": nn.functional.cross_entropy(
+                outputs["aux_outputs"][0]["pred_logits"].flatten(0, 1),
+                labels.flatten(),
+                reduction="sum",
+            ),
+        }
+        if self.calls in self.inf_steps:
+            losses["loss_bbox"] = losses["loss_bbox"] * float("inf")
+        self.calls += 1
+        if normalize:
+            num_boxes = self.get_num_boxes(self.num_samples)
+            losses = {k: v / num_boxes for k, v in losses.items()}
+        return losses
+
+
+def make_data(num_steps, batch=2, dim=16, num_queries=8, num_classes=4, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    loader = [
+        {"imgs": torch.randn(batch, dim, generator=g), "filename": [f"{i}.jpg"]}
+        for i in range(num_steps)
+    ]
+    targets = (
+        torch.randint(num_classes, (batch, num_queries), generator=g),
+        torch.rand(batch, num_queries, 4, generator=g),
+    )
+    return loader, targets
+
+
+def train(
+    model, loader, targets, amp, amp_dtype=torch.float16, scaler=None, inf_steps=()
+):
+    criterion = ToyCriterion(targets, inf_steps)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    with EventStorage(0):
+        stats = train_one_epoch_mot(
+            model,
+            criterion,
+            loader,
+            optimizer,
+            torch.device("cpu"),
+            0,
+            max_norm=0.1,
+            amp=amp,
+            scaler=scaler,
+            amp_dtype=amp_dtype,
+        )
+    return stats
+
+
+def check_to_fp32():
+    half = torch.ones(2, dtype=torch.bfloat16)
+    outputs = {
+        "a": half,
+        "b": [half, {"c": half, "d": torch.ones(2, dtype=torch.long)}],
+        "e": (half, None),
+    }
+    cast = to_fp32(outputs)
+    if not (
+        cast["a"].dtype
+        == cast["b"][0].dtype
+        == cast["b"][1]["c"].dtype
+        == torch.float32
+        and cast["e"][0].dtype == torch.float32
+        and cast["b"][1]["d"].dtype == torch.long
+        and isinstance(cast["e"], tuple)
+        and cast["e"][1] is None
+    ):
+        _fail("to_fp32 on nested outputs")
+    print("to_fp32: nested lists, tuples and dicts are cast")
+
+
+def check_bf16(args):
+    loader, targets = make_data(args.steps)
+    torch.manual_seed(0)
+    model = ToyTracker()
+    model_fp32 = copy.deepcopy(model)
+    stats = train(model, loader, targets, amp=True, amp_dtype=torch.bfloat16)
+    train(model_fp32, loader, targets, amp=False)
+    if any(p.dtype != torch.float32 for p in model.parameters()):
+        _fail("bf16 training changed the parameter dtype")
+    if not all(torch.isfinite(p).all() for p in model.parameters()):
+        _fail("bf16 training produced non-finite parameters")
+    max_diff = max(
+        (p - q).abs().max().item()
+        for p, q in zip(model.parameters(), model_fp32.parameters())
+    )
+    if max_diff > args.bf16_atol:
+        _fail(f"bf16 and fp32 parameters differ by {max_diff:.3g}")
+    print(
+        f"bf16 on CPU: {args.steps} steps, loss {stats['loss']:.4f}, "
+        f"max parameter difference to fp32 {max_diff:.3g}"
+    )
+
+
+def check_fp16_skip(args):
+    try:
+        scaler = torch.amp.GradScaler("cpu", init_scale=2.0**10)
+    except (AttributeError, TypeError, RuntimeError):
+        print("fp16 skip: torch.amp.GradScaler has no CPU support here, skipped")
+        return
+    loader, targets = make_data(3)
+    torch.manual_seed(0)
+    model = ToyTracker()
+    before = [p.detach().clone() for p in model.parameters()]
+    # the fp16 autocast of the CPU is not needed: the scaler sees the same
+    # inf gradients whatever dtype overflowed
+    train(model, loader[:1], targets, amp=False, scaler=scaler, inf_steps=(0,))
+    if any(not torch.equal(p, q) for p, q in zip(model.parameters(), before)):
+        _fail("a non-finite loss under the scaler updated the parameters")
+    if scaler.get_scale() >= 2.0**10:
+        _fail("a non-finite loss under the scaler did not lower the scale")
+    train(model, loader[1:], targets, amp=False, scaler=scaler)
+    if all(torch.equal(p, q) for p, q in zip(model.parameters(), before)):
+        _fail("the scaler skipped the finite steps after an overflow")
+    print(
+        f"fp16 skip: the non-finite step was skipped, scale lowered to "
+        f"{scaler.get_scale():g}, training continued"
+    )
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Mixed precision smoke test", add_help=False)
+    parser.add_argument("--steps", default=8, type=int)
+    parser.add_argument("--bf16_atol", default=1e-1, type=float)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Mixed precision smoke test", parents=[get_args_parser()]
+    )
+    args = parser.parse_args()
+    check_to_fp32()
+    check_bf16(args)
+    check_fp16_skip(args)
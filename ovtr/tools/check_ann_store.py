@@ -0,0 +1,267 @@
+"""Check that an AnnotationStore round-trips to the json annotation apis.
+
+Without arguments, synthetic LVIS-style and TAO-style json files are written
+to a temporary directory, compiled, and every image, annotation, category and
+video lookup the datasets use is compared between the store and the json api
+(``LVIS`` / ``CocoVID``)::
+
+    python tools/check_ann_store.py
+
+``--ann_file`` checks a real json the same way. With ``--config_file`` (and
+the usual main.py arguments) the dataset of ``--split`` is also built twice,
+from the json and from the store, and its ``data_infos`` and ``get_ann_info``
+are compared for every image::
+
+    python tools/check_ann_store.py --config_file ./config/ovtr_lite_train_val.py \
+        --dataset_file lvis_generated_img_seqs --sampler_lengths 2 3 4 5 \
+        --sampler_steps 4 7 14 --split train
+
+The script exits with status 1 on the first mismatch.
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datasets.parsers import AnnotationStore, CocoVID  # noqa: E402
+
+_ANN_FLAGS = ("iscrowd", "ignore", "clear")
+
+
+def synthetic_lvis(num_images=60, num_cats=12, seed=0):
+    rng = random.Random(seed)
+    cats = [
+        dict(id=c + 1, name=f"cat_{c}", frequency=rng.choice("rcf"))
+        for c in range(num_cats)
+    ]
+    images, anns = [], []
+    for i in range(num_images):
+        img_id = 1000 + 7 * i
+        images.append(
+            dict(
+                id=img_id,
+                width=rng.randint(200, 800),
+                height=rng.randint(200, 800),
+                coco_url=f"http://images.cocodataset.org/train2017/{img_id:012d}.jpg",
+                neg_category_ids=[],
+                not_exhaustive_category_ids=[],
+            )
+        )
+        for _ in range(rng.randint(0, 6)):
+            x, y = rng.uniform(-10, 150), rng.uniform(-10, 150)
+            w, h = rng.choice([0.5, rng.uniform(1, 200)]), rng.uniform(1, 200)
+            anns.append(
+                dict(
+                    id=len(anns) + 1,
+                    image_id=img_id,
+                    category_id=rng.randint(1, num_cats),
+                    bbox=[x, y, w, h],
+                    area=rng.choice([0, w * h]),
+                    iscrowd=rng.random() < 0.1,
+                    clear=rng.random() < 0.5,
+                    segmentation=[],
+                )
+            )
+    rng.shuffle(anns)
+    return dict(images=images, annotations=anns, categories=cats)
+
+
+def synthetic_tao(num_videos=6, num_cats=8, seed=0):
+    rng = random.Random(seed)
+    cats = [dict(id=c + 1, name=f"cat_{c}") for c in range(num_cats)]
+    videos, images, anns = [], [], []
+    for v in range(num_videos):
+        vid_id = 10 + v
+        videos.append(dict(id=vid_id, name=f"video_{v}", width=640, height=480))
+        frames = list(range(rng.randint(1, 8)))
+        rng.shuffle(frames)
+        for frame_id in frames:
+            img_id = len(images) + 1
+            images.append(
+                dict(
+                    id=img_id,
+                    video_id=vid_id,
+                    frame_id=frame_id,
+                    width=640,
+                    height=480,
+                    file_name=f"video_{v}/{frame_id:06d}.jpg",
+                )
+            )
+            for instance_id in rng.sample(range(5), rng.randint(0, 4)):
+                w, h = rng.uniform(1, 100), rng.uniform(1, 100)
+                ann = dict(
+                    id=len(anns) + 1,
+                    image_id=img_id,
+                    video_id=vid_id,
+                    category_id=rng.randint(1, num_cats),
+                    instance_id=100 * v + instance_id,
+                    bbox=[rng.uniform(0, 500), rng.uniform(0, 400), w, h],
+                    area=w * h,
+                    iscrowd=0,
+                )
+                if rng.random() < 0.2:
+                    ann["ignore"] = True
+                anns.append(ann)
+    return dict(videos=videos, images=images, annotations=anns, categories=cats)
+
+
+def _fail(msg):
+    print(f"MISMATCH: {msg}")
+    sys.exit(1)
+
+
+def check_api(store, api):
+    """Compare every lookup the datasets make on the two apis."""
+    if store.get_img_ids() != list(api.get_img_ids()):
+        _fail("get_img_ids")
+    if store.get_cat_ids() != list(api.get_cat_ids()):
+        _fail("get_cat_ids")
+    for cat_id in api.get_cat_ids():
+        if store.cat_img_map[cat_id] != sorted(set(api.cat_img_map[cat_id])):
+            _fail(f"cat_img_map[{cat_id}]")
+    if hasattr(api, "get_vid_ids"):
+        if store.get_vid_ids() != list(api.get_vid_ids()):
+            _fail("get_vid_ids")
+        for vid_id in api.get_vid_ids():
+            if store.get_img_ids_from_vid(vid_id) != api.get_img_ids_from_vid(vid_id):
+                _fail(f"get_img_ids_from_vid({vid_id})")
+
+    json_only = set()
+    cat_ids = set(store.get_cat_ids()[::2])
+    for img_id in api.get_img_ids():
+        img = api.load_imgs([img_id])[0]
+        stored = store.load_imgs([img_id])[0]
+        if {k: img[k] for k in stored} != stored:
+            _fail(f"load_imgs([{img_id}])")
+        json_only |= set(img) - set(stored)
+        for cats in (cat_ids, None):
+            kwargs = dict(img_ids=[img_id])
+            if cats is not None:
+                kwargs["cat_ids"] = cats
+            ann_ids = store.get_ann_ids(**kwargs)
+            expected = list(api.get_ann_ids(**kwargs))
+            if cats is not None and not hasattr(api, "getAnnIds"):
+                # LVIS also drops annotations without area once cat_ids is
+                # given, which the store leaves to the datasets
+                areas = {ann["id"]: ann["area"] for ann in store.load_anns(ann_ids)}
+                ann_ids = [i for i in ann_ids if areas[i] > 0]
+            if ann_ids != expected:
+                _fail(f"get_ann_ids({kwargs})")
+        for ann, stored in zip(api.load_anns(ann_ids), store.load_anns(ann_ids)):
+            for key in ("id", "image_id", "category_id", "bbox", "area"):
+                if ann[key] != stored[key]:
+                    _fail(f"load_anns([{ann['id']}])[{key!r}]")
+            if ann.get("instance_id") != stored.get("instance_id"):
+                _fail(f"load_anns([{ann['id']}])['instance_id']")
+            for key in _ANN_FLAGS:
+                if bool(ann.get(key, False)) != bool(stored[key]):
+                    _fail(f"load_anns([{ann['id']}])[{key!r}]")
+    return json_only
+
+
+def check_ann_file(ann_file, api_cls, store_dir):
+    t = time.time()
+    api = api_cls(ann_file)
+    t_json = time.time() - t
+    AnnotationStore.compile(ann_file, store_dir)
+    t = time.time()
+    store = AnnotationStore(store_dir)
+    t_store = time.time() - t
+    json_only = check_api(store, api)
+    print(
+        f"{os.path.basename(ann_file)}: {len(store.get_img_ids())} images, "
+        f"{len(store.arrays['ann_id'])} annotations match "
+        f"(json api {t_json:.2f} s, store {t_store:.2f} s to open)"
+    )
+    if json_only:
+        print(f"  image fields not kept by the store: {sorted(json_only)}")
+
+
+def _equal(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_equal(a[k], b[k]) for k in a)
+    return a == b
+
+
+def check_dataset(args):
+    from datasets import build_dataset
+    from util.slconfig import SLConfig
+
+    cfg = SLConfig.fromfile(args.config_file)
+    data_cfg = cfg.data[args.split]
+    built = []
+    for ann_store in (False, True):
+        dataset_cfg = copy.deepcopy(data_cfg)
+        dataset_cfg.ann_store = ann_store
+        image_set = "train" if args.split == "train" else "val"
+        built.append(build_dataset(image_set=image_set, args=args, cfg=dataset_cfg))
+    from_json, from_store = built
+    if len(from_json) != len(from_store) or len(from_json.data_infos) != len(
+        from_store.data_infos
+    ):
+        _fail("dataset length")
+    json_only = set()
+    for i in range(len(from_json.data_infos)):
+        info, stored = from_json.data_infos[i], from_store.data_infos[i]
+        if not _equal({k: info[k] for k in stored}, stored):
+            _fail(f"data_infos[{i}]")
+        json_only |= set(info) - set(stored)
+        if not _equal(from_json.get_ann_info(info), from_store.get_ann_info(stored)):
+            _fail(f"get_ann_info(data_infos[{i}])")
+    print(f"{args.split} dataset: {len(from_json.data_infos)} data_infos match")
+    if json_only:
+        print(f"  image fields not kept by the store: {sorted(json_only)}")
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("AnnotationStore round trip", add_help=False)
+    parser.add_argument("--ann_file", default=None, type=str)
+    parser.add_argument("--split", default="train", choices=["train", "val", "test"])
+    return parser
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if "--config_file" in argv:
+        from main import get_args_parser as get_main_args_parser
+
+        parents = [get_args_parser(), get_main_args_parser()]
+    else:
+        parents = [get_args_parser()]
+    parser = argparse.ArgumentParser(
+        "AnnotationStore round trip", parents=parents
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.ann_file is not None:
+            with open(args.ann_file) as f:
+                is_video = "videos" in json.load(f)
+            if is_video:
+                api_cls = CocoVID
+            else:
+                from lvis import LVIS as api_cls
+            check_ann_file(args.ann_file, api_cls, os.path.join(tmp_dir, "store"))
+        elif "--config_file" not in argv:
+            from lvis import LVIS
+
+            for name, dataset, api_cls in (
+                ("lvis.json", synthetic_lvis(), LVIS),
+                ("tao.json", synthetic_tao(), CocoVID),
+            ):
+                ann_file = os.path.join(tmp_dir, name)
+                with open(ann_file, "w") as f:
+                    json.dump(dataset, f)
+                check_ann_file(ann_file, api_cls, ann_file[:-5] + ".store")
+    if "--config_file" in argv:
+        check_dataset(args)
@@ -0,0 +1,176 @@
+"""Multi-process check of DDP training without find_unused_parameters.
+
+A small stand-in model is trained with ``train_one_epoch_mot`` by
+``--world_size`` CPU processes over gloo. Like OVTR it has a layer frozen for
+the first epoch (DDP is rebuilt once it is released, as in main.py) and a
+conditional branch, declared by ``conditional_parameters()``, that is skipped
+on alternating ranks and iterations, like the track query updater without
+active tracks::
+
+    python tools/check_ddp.py
+
+It checks that
+
+* the run completes and the parameters are identical on every rank,
+* they equal the parameters of the same run with find_unused_parameters=True,
+* a trainable parameter that is never used and not declared conditional
+  still raises DDP's unused-parameter error instead of being hidden.
+
+The script exits with status 1 on the first failed check.
+"""
+
+import argparse
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import train_one_epoch_mot  # noqa: E402
+from util.events import EventStorage  # noqa: E402
+
+
+class ToyModel(nn.Module):
+    def __init__(self, dim=8, unused=False):
+        super().__init__()
+        self.frozen = nn.Linear(dim, dim)
+        self.body = nn.Linear(dim, dim)
+        self.track_embed = nn.Linear(dim, dim)
+        self.head = nn.Linear(dim, 4)
+        self.unused = nn.Linear(dim, dim) if unused else None
+
+    def conditional_parameters(self):
+        return [p for p in self.track_embed.parameters() if p.requires_grad]
+
+    def forward(self, data):
+        x = self.body(self.frozen(data["imgs"]))
+        if data["active"]:
+            x = self.track_embed(x)
+        return {
+            "pred_logits": self.head(x),
+            "labels": data["labels"],
+            "track_instances": None,
+        }
+
+
+class ToyCriterion(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.weight_dict = {"loss_ce": 1.0}
+
+    def forward(self, outputs, normalize=True):
+        return {
+            "loss_ce": nn.functional.cross_entropy(
+                outputs["pred_logits"], outputs["labels"]
+            )
+        }
+
+
+def make_loader(rank, num_steps, epoch, dim=8):
+    g = torch.Generator().manual_seed(1000 * epoch + rank)
+    return [
+        {
+            "imgs": torch.randn(2, dim, generator=g),
+            "labels": torch.randint(4, (2,), generator=g),
+            "active": (step + rank) % 2 == 0,
+            "filename": [f"{rank}_{step}.jpg"],
+        }
+        for step in range(num_steps)
+    ]
+
+
+def train(rank, args, find_unused_parameters, unused=False):
+    torch.manual_seed(0)
+    model = ToyModel(unused=unused)
+    for p in model.frozen.parameters():
+        p.requires_grad_(False)
+    criterion = ToyCriterion()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    ddp_model = DistributedDataParallel(
+        model, find_unused_parameters=find_unused_parameters
+    )
+    with EventStorage(0):
+        for epoch in range(args.epochs):
+            if epoch == 1:
+                for p in model.frozen.parameters():
+                    p.requires_grad_(True)
+                del ddp_model
+                ddp_model = DistributedDataParallel(
+                    model, find_unused_parameters=find_unused_parameters
+                )
+            train_one_epoch_mot(
+                ddp_model,
+                criterion,
+                make_loader(rank, args.steps, epoch),
+                optimizer,
+                torch.device("cpu"),
+                epoch,
+            )
+    return torch.cat([p.detach().flatten() for p in model.parameters()])
+
+
+def run(rank, args, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    params = train(rank, args, find_unused_parameters=False)
+    reference = train(rank, args, find_unused_parameters=True)
+    gathered = [torch.zeros_like(params) for _ in range(args.world_size)]
+    dist.all_gather(gathered, params)
+    try:
+        train(rank, args, find_unused_parameters=False, unused=True)
+        raised = False
+    except RuntimeError as e:
+        raised = "find_unused_parameters" in str(e)
+    if rank == 0:
+        results["in_sync"] = all(torch.equal(gathered[0], p) for p in gathered)
+        results["matches_find_unused"] = torch.allclose(params, reference, atol=1e-6)
+        results["unused_raises"] = raised
+    # the failed reduction leaves the ranks out of step, do not wait for them
+    os._exit(0)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("DDP unused parameters check", add_help=False)
+    parser.add_argument("--world_size", default=2, type=int)
+    parser.add_argument("--epochs", default=2, type=int)
+    parser.add_argument("--steps", default=6, type=int)
+    parser.add_argument("--port", default=29533, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "DDP unused parameters check", parents=[get_args_parser()]
+    )
+    args = parser.parse_args()
+    results = mp.Manager().dict()
+    mp.spawn(run, args=(args, results), nprocs=args.world_size)
+    failed = [
+        msg
+        for key, msg in (
+            ("in_sync", "the parameters differ between ranks"),
+            (
+                "matches_find_unused",
+                "the parameters differ from find_unused_parameters=True",
+            ),
+            (
+                "unused_raises",
+                "an undeclared unused parameter did not raise DDP's error",
+            ),
+        )
+        if not results.get(key, False)
+    ]
+    for msg in failed:
+        print(f"FAILED: {msg}")
+    if failed:
+        sys.exit(1)
+    print(
+        f"{args.world_size} processes: parameters in sync and equal to "
+        f"find_unused_parameters=True, undeclared unused parameters still raise"
+    )
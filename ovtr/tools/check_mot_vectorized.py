@@ -0,0 +1,236 @@
+"""Check the vectorized CLEAR MOT accumulation against motmetrics.
+
+Randomized videos are accumulated by ``acc_single_video_vectorized`` and by
+``acc_single_video`` (the motmetrics accumulators)::
+
+    python tools/check_mot_vectorized.py
+
+It checks that
+
+* every class accumulator of a video has the same ``PARTIAL_METRICS`` as
+  motmetrics computes for it, and events exactly when it has some,
+* ``eval_mot(vectorized=True)``, the default, returns the same results as
+  ``eval_mot(vectorized=False)``, i.e. ``acc_single_video`` followed by
+  ``eval_single_class``, with ignore regions by class and not.
+
+The videos have objects appearing and leaving, tracker id swaps and new ids,
+false positives, wrong classes, ignored GT (id -1), ignore regions, boxes on
+a grid (exact IoU ties), and, for some, an id repeated within a frame. The
+script exits with status 1 on the first mismatch.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import motmetrics as mm
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.evaluation.mot import (  # noqa: E402
+    PARTIAL_METRICS,
+    acc_single_video,
+    acc_single_video_vectorized,
+    eval_mot,
+)
+
+
+def random_video(rng, num_classes, repeated_ids=False):
+    """Tracking results and annotations of a video, in the eval_mot format."""
+    num_frames = rng.integers(1, 40)
+    num_objects = rng.integers(0, 12)
+    on_grid = rng.random() < 0.3
+    start = rng.integers(0, num_frames, num_objects)
+    end = np.minimum(num_frames, start + rng.integers(1, num_frames + 1, num_objects))
+    labels = rng.integers(0, num_classes, num_objects)
+    pos = rng.uniform(0, 100, (num_objects, 2))
+    vel = rng.normal(0, 3, (num_objects, 2))
+    size = rng.uniform(10, 40, (num_objects, 2))
+    hyp_ids = np.arange(num_objects) + 100
+    next_hyp_id = 1000
+
+    results, gts = [], []
+    for t in range(num_frames):
+        alive = (start <= t) & (t < end)
+        if num_objects > 1 and rng.random() < 0.15:
+            a, b = rng.choice(num_objects, 2, replace=False)
+            hyp_ids[[a, b]] = hyp_ids[[b, a]]
+        if num_objects and rng.random() < 0.1:
+            hyp_ids[rng.integers(num_objects)] = next_hyp_id
+            next_hyp_id += 1
+        boxes = np.concatenate([pos + vel * t, pos + vel * t + size], 1)
+        if on_grid:
+            boxes = np.round(boxes / 5) * 5
+
+        instance_ids = np.where(
+            rng.random(num_objects) < 0.05, -1, np.arange(num_objects)
+        )[alive]
+        gt_labels = labels[alive]
+        if repeated_ids and len(instance_ids) > 1 and rng.random() < 0.3:
+            instance_ids[1], gt_labels[1] = instance_ids[0], gt_labels[0]
+        num_ignore = rng.integers(0, 3) if rng.random() < 0.4 else 0
+        ignore = rng.uniform(0, 100, (num_ignore, 2))
+        ignore = np.concatenate(
+            [ignore, ignore + rng.uniform(10, 60, (num_ignore, 2))], 1
+        )
+        gts.append(
+            dict(
+                bboxes=boxes[alive].astype(np.float32),
+                labels=gt_labels,
+                instance_ids=instance_ids,
+                bboxes_ignore=ignore.astype(np.float32),
+                labels_ignore=rng.integers(0, num_classes, num_ignore),
+            )
+        )
+
+        detected = alive & (rng.random(num_objects) < 0.8)
+        num_fp = rng.poisson(1.5)
+        fp = rng.uniform(0, 120, (num_fp, 2))
+        fp = np.concatenate([fp, fp + rng.uniform(5, 40, (num_fp, 2))], 1)
+        pred_boxes = np.concatenate(
+            [
+                boxes[detected]
+                + rng.normal(0, rng.choice([1, 4, 8]), (detected.sum(), 4)),
+                fp,
+            ]
+        )
+        if on_grid:
+            pred_boxes = np.round(pred_boxes / 5) * 5
+        pred_labels = np.concatenate(
+            [
+                np.where(
+                    rng.random(detected.sum()) < 0.05,
+                    rng.integers(0, num_classes, detected.sum()),
+                    labels[detected],
+                ),
+                rng.integers(0, num_classes, num_fp),
+            ]
+        )
+        pred_ids = np.concatenate([hyp_ids[detected], next_hyp_id + np.arange(num_fp)])
+        next_hyp_id += num_fp
+        if repeated_ids and len(pred_ids) > 1 and rng.random() < 0.3:
+            pred_ids[1], pred_labels[1] = pred_ids[0], pred_labels[0]
+        results.append(
+            [
+                np.concatenate(
+                    [
+                        pred_ids[pred_labels == c, None],
+                        pred_boxes[pred_labels == c],
+                        rng.random(((pred_labels == c).sum(), 1)),
+                    ],
+                    1,
+                ).astype(np.float32)
+                for c in range(num_classes)
+            ]
+        )
+    return results, gts
+
+
+def _fail(msg):
+    print(f"MISMATCH: {msg}")
+    sys.exit(1)
+
+
+def check_accumulators(args, rng):
+    metrics_host = mm.metrics.create()
+    num_compared = num_repeated = 0
+    for video in range(args.num_videos):
+        num_classes = rng.integers(1, 4)
+        repeated_ids = rng.random() < 0.15
+        ignore_by_classes = bool(rng.random() < 0.5)
+        iou_thr = rng.choice([0.3, 0.5, 0.7])
+        results, gts = random_video(rng, num_classes, repeated_ids)
+        video_args = (results, gts, iou_thr, 0.5, ignore_by_classes)
+        try:
+            accs = acc_single_video(*video_args)
+        except KeyError:
+            # an id repeated within a frame can make motmetrics fail, the
+            # vectorized path leaves such videos to it and fails the same way
+            try:
+                acc_single_video_vectorized(*video_args)
+            except KeyError:
+                num_repeated += 1
+                continue
+            _fail(f"video {video}: motmetrics fails, the vectorized path does not")
+        partials, active = acc_single_video_vectorized(*video_args)
+        for c, acc in enumerate(accs):
+            num_compared += 1
+            if active[c] != (len(acc._events["Type"]) > 0):
+                _fail(f"video {video}, class {c}: accumulator with events")
+            if not active[c]:
+                continue
+            summary = metrics_host.compute(
+                acc, metrics=PARTIAL_METRICS, return_dataframe=False
+            )
+            expected = np.array([summary[m] for m in PARTIAL_METRICS], dtype=float)
+            if not np.allclose(
+                expected, partials[c], rtol=1e-12, atol=1e-12, equal_nan=True
+            ):
+                diff = {
+                    m: (e, p)
+                    for m, e, p in zip(PARTIAL_METRICS, expected, partials[c])
+                    if not np.isclose(e, p, equal_nan=True)
+                }
+                _fail(f"video {video}, class {c}: {diff}")
+    print(
+        f"{num_compared} class accumulators of {args.num_videos} videos match "
+        f"motmetrics ({num_repeated} videos where motmetrics fails on repeated ids)"
+    )
+
+
+def _same(a, b):
+    return a.keys() == b.keys() and all(
+        a[k] == b[k] or (np.isnan(a[k]) and np.isnan(b[k])) for k in a
+    )
+
+
+def check_eval_mot(args, rng):
+    classes = ["a", "b", "c"]
+    times = {False: 0.0, True: 0.0}
+    for trial in range(args.num_trials):
+        videos = [random_video(rng, len(classes)) for _ in range(30)]
+        results = [v[0] for v in videos]
+        gts = [v[1] for v in videos]
+        for ignore_by_classes in (False, True):
+            outputs = {}
+            for vectorized in (False, True):
+                start = time.time()
+                outputs[vectorized] = eval_mot(
+                    results,
+                    gts,
+                    classes=classes,
+                    ignore_by_classes=ignore_by_classes,
+                    nproc=args.nproc,
+                    vectorized=vectorized,
+                )
+                times[vectorized] += time.time() - start
+            if not _same(outputs[False], outputs[True]):
+                _fail(
+                    f"eval_mot, trial {trial}, ignore_by_classes={ignore_by_classes}: "
+                    f"{outputs[False]} != {outputs[True]}"
+                )
+    print(
+        f"eval_mot: {2 * args.num_trials} evaluations of 30 videos identical "
+        f"(motmetrics {times[False]:.2f} s, vectorized {times[True]:.2f} s)"
+    )
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("CLEAR MOT vectorized check", add_help=False)
+    parser.add_argument("--num_videos", default=500, type=int)
+    parser.add_argument("--num_trials", default=5, type=int)
+    parser.add_argument("--nproc", default=4, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "CLEAR MOT vectorized check", parents=[get_args_parser()]
+    )
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    check_accumulators(args, rng)
+    check_eval_mot(args, rng)
@@ -0,0 +1,153 @@
+"""Time the padded batching with and without aspect ratio grouping.
+
+Batches of a synthetic LVIS-like size distribution (landscape and portrait
+images, multi-scale resized as the training config does, padded to a
+multiple of 32) are drawn by ``BatchSampler`` and by
+``AspectRatioGroupedBatchSampler`` over the same ``RandomSampler``::
+
+    python tools/check_padding.py
+    python tools/check_padding.py --batch_size 4 --device cuda
+
+For each sampler it reports the padding fraction of the batches, the time of
+``nested_tensor_from_tensor_list`` as it was (``torch.zeros`` / ``torch.ones``
+then copy), as it is now, and with a reusable ``PaddedBatchBuffer``. It also
+times a ResNet stem convolution on the padded batch, as a stand-in for the
+part of the step that grows with the padded area. The batches built with and
+without the buffer must be identical to the former ones. The script exits
+with status 1 otherwise.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import BatchSampler, RandomSampler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datasets.samplers as samplers  # noqa: E402
+from util.misc import (  # noqa: E402
+    NestedTensor,
+    PaddedBatchBuffer,
+    nested_tensor_from_tensor_list,
+    padding_fraction,
+)
+
+
+def zeros_nested_tensor_from_tensor_list(tensor_list):
+    """``nested_tensor_from_tensor_list`` before the reusable buffer."""
+    max_size = [max(s) for s in zip(*[img.shape for img in tensor_list])]
+    b, c, h, w = [len(tensor_list)] + max_size
+    dtype, device = tensor_list[0].dtype, tensor_list[0].device
+    tensor = torch.zeros((b, c, h, w), dtype=dtype, device=device)
+    mask = torch.ones((b, h, w), dtype=torch.bool, device=device)
+    for img, pad_img, m in zip(tensor_list, tensor, mask):
+        pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
+        m[: img.shape[1], : img.shape[2]] = False
+    return NestedTensor(tensor, mask)
+
+
+def synthetic_sizes(num_images, portrait_ratio=0.3, seed=0):
+    """(h, w) after the multi-scale resize and pad, and the aspect ratio flag."""
+    rng = np.random.RandomState(seed)
+    portrait = rng.rand(num_images) < portrait_ratio
+    aspect = rng.uniform(1.2, 1.8, num_images)
+    short = rng.choice([640, 672, 704, 736, 768, 800], num_images)
+    long = np.minimum(np.round(short * aspect), 1333)
+    short = np.round(long / aspect)
+    h = np.where(portrait, long, short)
+    w = np.where(portrait, short, long)
+    h, w = (np.ceil(h / 32) * 32).astype(int), (np.ceil(w / 32) * 32).astype(int)
+    return list(zip(h, w)), (~portrait).astype(np.int64)
+
+
+def _time(func, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = func()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def run(batch_sampler, sizes, stem, args):
+    device = torch.device(args.device)
+    buffer = PaddedBatchBuffer()
+    times = {"zeros": [], "empty": [], "buffer": [], "stem": []}
+    padding = []
+    g = torch.Generator().manual_seed(args.seed)
+    for i, batch in enumerate(batch_sampler):
+        if i == args.num_batches:
+            break
+        imgs = [
+            torch.rand((3,) + tuple(sizes[idx]), generator=g).to(device)
+            for idx in batch
+        ]
+        padding.append(padding_fraction(imgs))
+        expected, t_zeros = _time(
+            lambda: zeros_nested_tensor_from_tensor_list(imgs), device
+        )
+        empty, t_empty = _time(lambda: nested_tensor_from_tensor_list(imgs), device)
+        buffered, t_buffer = _time(
+            lambda: nested_tensor_from_tensor_list(imgs, buffer=buffer), device
+        )
+        for name, out in (("empty", empty), ("buffer", buffered)):
+            if not (
+                torch.equal(out.tensors, expected.tensors)
+                and torch.equal(out.mask, expected.mask)
+            ):
+                print(f"MISMATCH: batch {i}, nested tensor built with {name}")
+                sys.exit(1)
+        with torch.no_grad():
+            _, t_stem = _time(lambda: stem(expected.tensors), device)
+        if i > 0:  # the first batch warms up the allocator and the buffer
+            for name, t in (
+                ("zeros", t_zeros),
+                ("empty", t_empty),
+                ("buffer", t_buffer),
+                ("stem", t_stem),
+            ):
+                times[name].append(t)
+    return float(np.mean(padding)), {k: 1000 * np.mean(v) for k, v in times.items()}
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Padded batching timing", add_help=False)
+    parser.add_argument("--num_images", default=2000, type=int)
+    parser.add_argument("--num_batches", default=40, type=int)
+    parser.add_argument("--batch_size", default=2, type=int)
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Padded batching timing", parents=[get_args_parser()]
+    )
+    args = parser.parse_args()
+    sizes, group_ids = synthetic_sizes(args.num_images, seed=args.seed)
+    stem = nn.Conv2d(3, 64, 7, stride=2, padding=3, bias=False).to(args.device)
+
+    for name in ("BatchSampler", "AspectRatioGroupedBatchSampler"):
+        sampler = RandomSampler(
+            range(args.num_images), generator=torch.Generator().manual_seed(args.seed)
+        )
+        if name == "BatchSampler":
+            batch_sampler = BatchSampler(sampler, args.batch_size, drop_last=True)
+        else:
+            batch_sampler = samplers.AspectRatioGroupedBatchSampler(
+                sampler, group_ids, args.batch_size, drop_last=True
+            )
+        padding, times = run(batch_sampler, sizes, stem, args)
+        print(
+            f"{name}, batch_size={args.batch_size}: padding {100 * padding:.1f}%, "
+            f"nested tensor {times['zeros']:.2f} ms (zeros), "
+            f"{times['empty']:.2f} ms (empty), {times['buffer']:.2f} ms (buffer), "
+            f"stem conv {times['stem']:.1f} ms"
+        )
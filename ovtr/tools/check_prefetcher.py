@@ -0,0 +1,195 @@
+"""Check that mot_data_prefetcher yields the batches of a plain loop.
+
+Randomized clips in the ``mot_collate_fn`` layout (uint8 frames of varying
+sizes, ``Instances`` targets, file names) are loaded by a DataLoader whose
+dataset draws its augmentations from the python, numpy and torch RNGs. The
+reference loop applies ``data_dict_to_cuda`` and the ``ClipNormalizePad``
+batch transform to every batch, then runs a "training step" that draws from
+the same RNGs::
+
+    python tools/check_prefetcher.py
+    python tools/check_prefetcher.py --device cuda
+
+``mot_data_prefetcher`` is run with the same loader and step, without workers
+(batches fetched in the calling thread) and with ``--num_workers`` (the
+background thread on CPU, the side stream on CUDA). The batches, the values
+drawn by the steps and the RNG states at the end of the epoch must be
+identical. The script exits with status 1 on the first mismatch.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.structures import Instances  # noqa: E402
+import util.misc as utils  # noqa: E402
+from datasets.data_prefetcher import (  # noqa: E402
+    data_dict_to_cuda,
+    mot_data_prefetcher,
+)
+from datasets.pipelines.transforms import ClipNormalizePad  # noqa: E402
+
+
+class ToyClipDataset(torch.utils.data.Dataset):
+    """Clips of ``num_frames`` frames with random sizes, flips and targets."""
+
+    def __init__(self, size=24, num_frames=3, max_side=96):
+        self.size = size
+        self.num_frames = num_frames
+        self.max_side = max_side
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        h = random.randint(self.max_side // 2, self.max_side)
+        w = int(np.random.randint(self.max_side // 2, self.max_side + 1))
+        flip = torch.rand(1).item() < 0.5
+        imgs, gt_instances = [], []
+        for _ in range(self.num_frames):
+            img = torch.randint(0, 256, (3, h, w), dtype=torch.uint8)
+            imgs.append(img.flip(-1) if flip else img)
+            num_boxes = random.randint(0, 6)
+            instances = Instances((h, w))
+            instances.boxes = torch.rand(num_boxes, 4)
+            instances.labels = torch.from_numpy(np.random.randint(0, 80, num_boxes))
+            instances.obj_ids = torch.randperm(num_boxes)
+            gt_instances.append(instances)
+        return {
+            "imgs": imgs,
+            "gt_instances": gt_instances,
+            "filename": f"{idx}.jpg",
+        }
+
+
+def training_step(data_dict):
+    """Stands for the dropout / sampling draws of a step."""
+    return (
+        random.random(),
+        float(np.random.rand()),
+        torch.rand(1).item(),
+        len(data_dict["imgs"]),
+    )
+
+
+def make_loader(args, batch_size, num_workers):
+    generator = torch.Generator()
+    generator.manual_seed(args.seed)
+    return DataLoader(
+        ToyClipDataset(size=args.num_clips),
+        batch_size=batch_size,
+        shuffle=True,
+        collate_fn=utils.mot_collate_fn,
+        num_workers=num_workers,
+        generator=generator,
+    )
+
+
+def rng_state():
+    return random.getstate(), np.random.get_state(), torch.get_rng_state()
+
+
+def run(args, batch_size, num_workers, batch_transform, prefetch):
+    """The batches (on the host), step draws and final RNG states of an epoch."""
+    device = torch.device(args.device)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    loader = make_loader(args, batch_size, num_workers)
+    if prefetch:
+        batches = mot_data_prefetcher(loader, device, batch_transform=batch_transform)
+    else:
+        batches = loader
+    outputs, draws = [], []
+    start = time.time()
+    for data_dict in batches:
+        filename = data_dict.pop("filename")
+        if not prefetch:
+            # the loop of train_one_epoch_mot before the prefetcher
+            data_dict = data_dict_to_cuda(data_dict, device)
+            data_dict["imgs"] = batch_transform(data_dict["imgs"])
+        draws.append(training_step(data_dict))
+        outputs.append((filename, data_dict_to_cuda(data_dict, torch.device("cpu"))))
+    return outputs, draws, rng_state(), time.time() - start
+
+
+def _diff(a, b, path=""):
+    """Path of the first difference between a and b, None if identical."""
+    if isinstance(a, Instances) or isinstance(b, Instances):
+        if not (isinstance(a, Instances) and isinstance(b, Instances)):
+            return path
+        if a.image_size != b.image_size:
+            return f"{path}.image_size"
+        return _diff(a.get_fields(), b.get_fields(), path)
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        same = (
+            isinstance(a, torch.Tensor)
+            and isinstance(b, torch.Tensor)
+            and a.dtype == b.dtype
+            and torch.equal(a, b)
+        )
+        return None if same else path
+    if isinstance(a, dict) and isinstance(b, dict):
+        if list(a) != list(b):
+            return path
+        return next(
+            (d for d in (_diff(a[k], b[k], f"{path}/{k}") for k in a) if d), None
+        )
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        if len(a) != len(b):
+            return path
+        return next(
+            (
+                d
+                for d in (
+                    _diff(x, y, f"{path}[{i}]") for i, (x, y) in enumerate(zip(a, b))
+                )
+                if d
+            ),
+            None,
+        )
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return None if np.array_equal(a, b) else path
+    return None if a == b else path
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Prefetcher check", add_help=False)
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--num_clips", default=24, type=int)
+    parser.add_argument("--num_workers", default=2, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Prefetcher check", parents=[get_args_parser()])
+    args = parser.parse_args()
+    batch_transform = ClipNormalizePad(
+        mean=[123.675, 116.28, 103.53], std=[58.395, 57.12, 57.375], size_divisor=32
+    )
+    path = "stream" if args.device.startswith("cuda") else "thread"
+
+    for batch_size in (1, 2):
+        for num_workers in (0, args.num_workers):
+            expected = run(args, batch_size, num_workers, batch_transform, False)
+            prefetched = run(args, batch_size, num_workers, batch_transform, True)
+            mode = f"batch_size={batch_size}, num_workers={num_workers}"
+            for name, index in (("batch", 0), ("step draws", 1), ("rng states", 2)):
+                diff = _diff(expected[index], prefetched[index])
+                if diff is not None:
+                    print(f"MISMATCH: {mode}: {name} differ at {diff}")
+                    sys.exit(1)
+            print(
+                f"{mode} ({path if num_workers else 'calling thread'}): "
+                f"{len(expected[0])} batches identical "
+                f"(loop {expected[3]:.2f} s, prefetcher {prefetched[3]:.2f} s)"
+            )
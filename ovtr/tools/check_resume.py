@@ -0,0 +1,249 @@
+"""Check that a run resumed from its step checkpoints matches an uninterrupted one.
+
+The OVTR model needs CUDA, so a small stand-in model with dropout (it draws
+from the torch RNG) is trained on CPU with the same pieces as main.py: the
+epoch-seeded ``DistributedSampler``, ``ResumableBatchSampler``, the DataLoader
+generator, ``train_one_epoch_mot`` with its ``step_callback``, the
+``AsyncCheckpointer`` and the rng state helpers. The checkpoint contents and
+the resume steps follow main.py::
+
+    python tools/check_resume.py
+
+One run trains ``--epochs`` epochs without interruption. A second run is
+stopped right after the step checkpoint of step ``--stop_step`` of epoch 0,
+resumed from ``checkpoint.pth``, stopped again at the end of epoch 1 and
+resumed from the ``checkpoint.pth`` saved with that epoch. The losses of every
+step and the final parameters must be identical. The script exits with
+status 1 otherwise.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datasets.samplers as samplers  # noqa: E402
+import util.misc as utils  # noqa: E402
+from engine import train_one_epoch_mot  # noqa: E402
+from util.async_checkpoint import AsyncCheckpointer  # noqa: E402
+from util.events import EventStorage  # noqa: E402
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ToyDataset(torch.utils.data.Dataset):
+    def __init__(self, size=24, dim=16):
+        g = torch.Generator().manual_seed(0)
+        self.imgs = torch.randn(size, dim, generator=g)
+        self.labels = torch.randint(4, (size,), generator=g)
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, idx):
+        return self.imgs[idx], self.labels[idx], f"{idx}.jpg"
+
+
+def collate_fn(batch):
+    imgs, labels, filenames = zip(*batch)
+    return {
+        "imgs": torch.stack(imgs),
+        "labels": torch.stack(labels),
+        "filename": filenames,
+    }
+
+
+class ToyModel(nn.Module):
+    def __init__(self, dim=16):
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.Linear(dim, dim), nn.Dropout(0.5), nn.Linear(dim, 4)
+        )
+
+    def forward(self, data):
+        return {
+            "pred_logits": self.net(data["imgs"]),
+            "labels": data["labels"],
+            "track_instances": None,
+        }
+
+
+class ToyCriterion(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.weight_dict = {"loss_ce": 1.0}
+        self.losses = []
+
+    def forward(self, outputs, normalize=True):
+        loss = nn.functional.cross_entropy(outputs["pred_logits"], outputs["labels"])
+        self.losses.append(loss.item())
+        return {"loss_ce": loss}
+
+
+def load_checkpoint(path):
+    try:
+        # the rng states are not plain tensors
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only
+        return torch.load(path, map_location="cpu")
+
+
+def train(args, output_dir, epochs, resume=None, stop_step=None):
+    """Train until ``epochs``, or until the step checkpoint of ``stop_step``.
+
+    Returns the losses of the steps trained and the final parameters.
+    """
+    torch.manual_seed(args.seed)
+    dataset = ToyDataset()
+    model, criterion = ToyModel(), ToyCriterion()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 2)
+    sampler = samplers.DistributedSampler(dataset, num_replicas=1, rank=0)
+    batch_sampler = samplers.ResumableBatchSampler(
+        torch.utils.data.BatchSampler(sampler, args.batch_size, drop_last=True)
+    )
+    loader_generator = torch.Generator()
+    loader_generator.manual_seed(args.seed)
+    data_loader = DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=collate_fn,
+        num_workers=args.num_workers,
+        generator=loader_generator,
+    )
+
+    start_epoch = 0
+    resume_rng_state = None
+    if resume is not None:
+        checkpoint = load_checkpoint(resume)
+        assert "step" in checkpoint, "only step checkpoints continue a run"
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+        start_epoch = checkpoint["epoch"]
+        batch_sampler.start_iter = checkpoint["step"]
+        loader_generator.set_state(checkpoint["loader_generator"])
+        resume_rng_state = checkpoint["rng_states"][utils.get_rank()]
+
+    checkpointer = AsyncCheckpointer()
+    checkpoint_path = os.path.join(output_dir, "checkpoint.pth")
+
+    def save_checkpoint(epoch, **extra_state):
+        checkpointer.save(
+            {
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "lr_scheduler": lr_scheduler.state_dict(),
+                "epoch": epoch,
+                **extra_state,
+            },
+            [checkpoint_path],
+        )
+
+    try:
+        with EventStorage(0):
+            for epoch in range(start_epoch, epochs):
+                sampler.set_epoch(epoch)
+                start_step = batch_sampler.start_iter
+                loader_generator_state = loader_generator.get_state()
+                if resume_rng_state is not None:
+                    utils.set_rng_state(resume_rng_state)
+                    resume_rng_state = None
+                num_steps = len(batch_sampler.batch_sampler)
+
+                def save_step_checkpoint(
+                    step, epoch=epoch, state=loader_generator_state
+                ):
+                    if step % args.checkpoint_steps == 0 and step < num_steps:
+                        rng_states = utils.all_gather(utils.get_rng_state())
+                        checkpointer.wait()
+                        save_checkpoint(
+                            epoch,
+                            step=step,
+                            rng_states=rng_states,
+                            loader_generator=state,
+                        )
+                        if (epoch, step) == stop_step:
+                            raise Interrupted()
+
+                train_one_epoch_mot(
+                    model,
+                    criterion,
+                    data_loader,
+                    optimizer,
+                    torch.device("cpu"),
+                    epoch,
+                    start_step=start_step,
+                    step_callback=save_step_checkpoint,
+                )
+                lr_scheduler.step()
+                checkpointer.wait()
+                rng_states = utils.all_gather(utils.get_rng_state())
+                save_checkpoint(
+                    epoch + 1,
+                    step=0,
+                    rng_states=rng_states,
+                    loader_generator=loader_generator.get_state(),
+                )
+    except Interrupted:
+        pass
+    checkpointer.wait()
+    return criterion.losses, [p.detach().clone() for p in model.parameters()]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Resume check", add_help=False)
+    parser.add_argument("--epochs", default=3, type=int)
+    parser.add_argument("--batch_size", default=2, type=int)
+    parser.add_argument("--checkpoint_steps", default=2, type=int)
+    parser.add_argument("--stop_step", default=6, type=int)
+    parser.add_argument("--num_workers", default=2, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Resume check", parents=[get_args_parser()])
+    args = parser.parse_args()
+    assert args.stop_step % args.checkpoint_steps == 0
+    assert args.epochs >= 3, "the run is interrupted in epoch 0 and after epoch 1"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.makedirs(os.path.join(tmp_dir, "full"))
+        losses, params = train(args, os.path.join(tmp_dir, "full"), args.epochs)
+
+        output_dir = os.path.join(tmp_dir, "interrupted")
+        checkpoint_path = os.path.join(output_dir, "checkpoint.pth")
+        os.makedirs(output_dir)
+        resumed_losses, _ = train(
+            args, output_dir, args.epochs, stop_step=(0, args.stop_step)
+        )
+        resumed, _ = train(args, output_dir, 2, resume=checkpoint_path)
+        resumed_losses += resumed
+        resumed, resumed_params = train(
+            args, output_dir, args.epochs, resume=checkpoint_path
+        )
+        resumed_losses += resumed
+
+    if resumed_losses != losses:
+        diverged = next(
+            i for i, (a, b) in enumerate(zip(resumed_losses + [None], losses)) if a != b
+        )
+        print(f"MISMATCH: the losses diverge at step {diverged}")
+        sys.exit(1)
+    if any(not torch.equal(p, q) for p, q in zip(params, resumed_params)):
+        print("MISMATCH: the final parameters differ")
+        sys.exit(1)
+    print(
+        f"{len(losses)} steps: resuming at step {args.stop_step} of epoch 0 and after "
+        f"epoch 1 reproduces the uninterrupted run exactly"
+    )
@@ -0,0 +1,260 @@
+"""Check the vectorized TETA metric against the per-threshold loop it replaced.
+
+Randomized TAO-like sequences are preprocessed by the TAO dataset of
+``teta`` and every class-sequence is scored by ``TETA.eval_sequence`` and by
+``LoopTETA``, which keeps the former loop over the localization thresholds
+of ``eval_sequence_single_thr`` as the reference::
+
+    python tools/check_teta_metric.py
+
+The ``res`` fields and the per-class ``Cls_FP`` counts must be identical,
+with and without ``exhaustive``. The sequences have timesteps without GT or
+tracker dets, tracker dets of classes outside the class list and sequences
+without tracker dets. The script exits with status 1 on the first mismatch.
+"""
+
+import argparse
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from teta.datasets.tao import TAO  # noqa: E402
+from teta.metrics.teta import TETA  # noqa: E402
+
+
+class LoopTETA(TETA):
+    """TETA with the per-threshold loop of the original implementation."""
+
+    def eval_sequence_single_thr(self, data, cls, cid2clsname, cls_fp_thr, thr):
+        res = {}
+        class_info_list = []
+        for field in self.float_array_fields + self.integer_array_fields:
+            if field.startswith("Cls"):
+                res[field] = np.zeros(len(self.cls_array_labels), dtype=float)
+            else:
+                res[field] = np.zeros((len(self.array_labels)), dtype=float)
+
+        if data["num_tk_overlap_dets"] == 0 or data["num_gt_dets"] == 0:
+            return super().eval_sequence_single_thr(
+                data, cls, cid2clsname, cls_fp_thr, thr
+            )
+
+        ga_score, gt_id_count, tk_id_count = self.compute_global_alignment_score(data)
+        matches_counts = [np.zeros_like(ga_score) for _ in self.array_labels]
+
+        for t, (gt_ids_t, tk_ids_t, tk_overlap_ids_t, tk_cls_ids_t) in enumerate(
+            zip(
+                data["gt_ids"],
+                data["tk_ids"],
+                data["tk_overlap_ids"],
+                data["tk_class_eval_tk_ids"],
+            )
+        ):
+            if len(gt_ids_t) == 0:
+                if self.exhaustive:
+                    cls_fp_thr[cls] += len(tk_cls_ids_t)
+                continue
+
+            amatch_rows, amatch_cols = self.compute_matches(
+                data, t, ga_score, gt_ids_t, tk_ids_t, list(self.array_labels)
+            )
+
+            if len(tk_overlap_ids_t) != 0:
+                sorter = np.argsort(tk_ids_t)
+                indexes = sorter[
+                    np.searchsorted(tk_ids_t, tk_overlap_ids_t, sorter=sorter)
+                ]
+                sim_t = data["sim_scores"][t][:, indexes]
+                fpl_candidates = tk_overlap_ids_t[(sim_t >= (thr / 100)).any(axis=0)]
+                fpl_candidates_ori_ids_t = np.array(
+                    [data["tk_id_map"][tid] for tid in fpl_candidates]
+                )
+            else:
+                fpl_candidates_ori_ids_t = []
+
+            if self.exhaustive:
+                cls_fp_thr[cls] += len(tk_cls_ids_t) - len(tk_overlap_ids_t)
+
+            for a, alpha in enumerate(self.array_labels):
+                match_row, match_col = amatch_rows[a], amatch_cols[a]
+                num_matches = len(match_row)
+                matched_ori_ids = set(
+                    [data["tk_id_map"][tid] for tid in tk_ids_t[match_col]]
+                )
+                match_tk_cls = data["tk_classes"][t][match_col]
+                wrong_tk_cls = match_tk_cls[match_tk_cls != data["gt_classes"][t]]
+
+                num_class_and_det_matches = np.sum(
+                    match_tk_cls == data["gt_classes"][t]
+                )
+
+                if alpha >= 0.5:
+                    for cid in wrong_tk_cls:
+                        if cid in cid2clsname:
+                            cname = cid2clsname[cid]
+                            cls_fp_thr[cname][a - 10] += 1
+                    res["Cls_TP"][a - 10] += num_class_and_det_matches
+                    res["Cls_FN"][a - 10] += num_matches - num_class_and_det_matches
+
+                res["Loc_TP"][a] += num_matches
+                res["Loc_FN"][a] += len(gt_ids_t) - num_matches
+                res["Loc_FP"][a] += len(set(fpl_candidates_ori_ids_t) - matched_ori_ids)
+
+                if num_matches > 0:
+                    matches_counts[a][gt_ids_t[match_row], tk_ids_t[match_col]] += 1
+
+        self.compute_association_scores(res, matches_counts, gt_id_count, tk_id_count)
+        res = self._compute_final_fields(res)
+        return res, cls_fp_thr, class_info_list
+
+
+def synthetic_dataset(
+    num_seqs, num_classes=30, max_tracks=12, num_timesteps=30, seed=0
+):
+    """A TAO dataset serving randomized raw sequences, and its class list.
+
+    Each sequence has a few GT tracks of a few classes moving with noise,
+    tracker tracks that follow them with larger noise (often with a wrong
+    class, sometimes one outside the class list) plus some false tracks.
+    """
+    rng = np.random.RandomState(seed)
+    class_list = [f"cls_{c}" for c in range(num_classes)]
+    dataset = TAO.__new__(TAO)
+    dataset.cls_name2clsid = {c: i for i, c in enumerate(class_list)}
+    dataset.clsid2cls_name = {i: c for i, c in enumerate(class_list)}
+    seqs = {}
+    for seq in range(num_seqs):
+        num_tracks = rng.randint(1, max_tracks)
+        track_cls = rng.choice(
+            rng.choice(num_classes, rng.randint(1, 6), replace=False), num_tracks
+        )
+        boxes = rng.rand(num_tracks, 4) * [100, 100, 40, 40] + [0, 0, 10, 10]
+        num_false = rng.randint(0, 4)
+        false_boxes = rng.rand(num_false, 4) * [100, 100, 40, 40] + [0, 0, 10, 10]
+        no_tracker = rng.rand() < 0.1
+        raw = {
+            k: []
+            for k in (
+                "gt_ids",
+                "gt_classes",
+                "gt_dets",
+                "tk_ids",
+                "tk_classes",
+                "tk_dets",
+                "tk_confidences",
+                "similarity_scores",
+            )
+        }
+        for _ in range(num_timesteps):
+            gt_vis = rng.rand(num_tracks) < 0.75
+            tk_vis = rng.rand(num_tracks) < (0 if no_tracker else 0.75)
+            false_vis = rng.rand(num_false) < (0 if no_tracker else 0.5)
+            boxes = boxes + rng.randn(num_tracks, 4) * [2, 2, 0.5, 0.5]
+            gt_dets = boxes[gt_vis] + rng.randn(gt_vis.sum(), 4)
+            tk_dets = np.concatenate(
+                [
+                    boxes[tk_vis] + rng.randn(tk_vis.sum(), 4) * 4,
+                    false_boxes[false_vis],
+                ]
+            )
+            tk_cls = np.concatenate(
+                [track_cls[tk_vis], rng.randint(num_classes, size=false_vis.sum())]
+            )
+            wrong = rng.rand(len(tk_cls)) < 0.3
+            tk_cls[wrong] = rng.randint(num_classes + 5, size=wrong.sum())
+            raw["gt_ids"].append(np.nonzero(gt_vis)[0])
+            raw["gt_classes"].append(track_cls[gt_vis])
+            raw["gt_dets"].append(gt_dets.reshape(-1, 4))
+            raw["tk_ids"].append(
+                np.concatenate(
+                    [np.nonzero(tk_vis)[0], 100 + np.nonzero(false_vis)[0]]
+                ).astype(int)
+            )
+            raw["tk_classes"].append(tk_cls.astype(int))
+            raw["tk_dets"].append(tk_dets.reshape(-1, 4))
+            raw["tk_confidences"].append(rng.rand(len(tk_cls)))
+            raw["similarity_scores"].append(
+                dataset._calculate_box_ious(raw["gt_dets"][-1], raw["tk_dets"][-1])
+            )
+        raw.update(
+            num_timesteps=num_timesteps, seq=seq, neg_cat_ids=[], not_exh_labeled_cls=[]
+        )
+        seqs[seq] = raw
+    dataset.get_raw_seq_data = lambda tracker, seq: copy.deepcopy(seqs[seq])
+    return dataset, list(seqs), class_list
+
+
+def preprocess(dataset, seqs, class_list, thresholds=(50,)):
+    """The preprocessed data of every class-sequence with GT, as eval.py builds it."""
+    work = []
+    for seq in seqs:
+        raw = dataset.get_raw_seq_data("tracker", seq)
+        data_all = dataset.get_preprocessed_seq_data(
+            raw, "all", thresholds=list(thresholds)
+        )
+        assignment = TETA().compute_global_assignment(data_all)
+        for cid in np.unique(np.concatenate(raw["gt_classes"])):
+            cls = class_list[cid]
+            data = dataset.get_preprocessed_seq_data(
+                raw, cls, assignment, list(thresholds)
+            )
+            work.append((seq, cls, data))
+    return work
+
+
+def _equal(a, b):
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_equal(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+    return a == b
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("TETA metric check", add_help=False)
+    parser.add_argument("--num_seqs", default=40, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("TETA metric check", parents=[get_args_parser()])
+    args = parser.parse_args()
+    dataset, seqs, class_list = synthetic_dataset(args.num_seqs, seed=args.seed)
+    work = preprocess(dataset, seqs, class_list)
+
+    for exhaustive in (False, True):
+        times = {}
+        results = {}
+        for name, metric in (
+            ("loop", LoopTETA(exhaustive=exhaustive)),
+            ("vectorized", TETA(exhaustive=exhaustive)),
+        ):
+            start = time.time()
+            results[name] = []
+            for seq, cls, data in work:
+                cls_fp = {
+                    thr: {c: np.zeros(len(metric.cls_array_labels)) for c in class_list}
+                    for thr in data
+                }
+                results[name].append(
+                    metric.eval_sequence(data, cls, dataset.clsid2cls_name, cls_fp)[:2]
+                )
+            times[name] = time.time() - start
+        for (seq, cls, _), loop, vectorized in zip(
+            work, results["loop"], results["vectorized"]
+        ):
+            if not _equal(loop, vectorized):
+                print(f"MISMATCH: sequence {seq}, class {cls}, exhaustive={exhaustive}")
+                sys.exit(1)
+        print(
+            f"exhaustive={exhaustive}: {len(work)} class-sequences identical "
+            f"(loop {times['loop']:.2f} s, vectorized {times['vectorized']:.2f} s)"
+        )
@@ -0,0 +1,307 @@
+"""Check the table-based TETA preprocessing against the per-timestep loop.
+
+``TAO.get_preprocessed_seq_data_thr`` builds the data of a class from the
+per-sequence id tables of ``_seq_tables``. ``loop_preprocess_seq_data_thr``
+keeps the former per-timestep implementation as the reference. Both are run
+on every sequence, for the "all" class (as ``eval_sequence`` does to compute
+the global assignment) and for every class with GT, with that assignment.
+Without arguments the randomized sequences of ``check_teta_metric.py`` are
+used::
+
+    python tools/check_teta_preprocess.py
+
+``--gt_file`` and ``--tracker_file`` check a TAO GT json and a tracker json
+(TAO result style, as tao_track.json) instead::
+
+    python tools/check_teta_preprocess.py --gt_file data/tao/annotations/validation_ours_v1.json \
+        --tracker_file results/ovtrack_teta_results/tao_track.json
+
+The order of ``tk_overlap_ids`` followed a set in the loop implementation, so
+they are compared sorted, and the id maps and ``tk_class_eval_tk_ids`` are
+compared as plain ints. Everything else must be identical, dtypes included.
+The script exits with status 1 on the first mismatch.
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import teta  # noqa: E402
+from check_teta_metric import synthetic_dataset  # noqa: E402
+from teta.metrics.teta import TETA  # noqa: E402
+
+
+def loop_preprocess_seq_data_thr(dataset, raw_data, cls, assignment=None):
+    """The per-timestep get_preprocessed_seq_data_thr of the TAO dataset."""
+    if cls != "all":
+        cls_id = dataset.cls_name2clsid[cls]
+
+    data_keys = [
+        "gt_ids",
+        "tk_ids",
+        "gt_id_map",
+        "tk_id_map",
+        "gt_dets",
+        "gt_classes",
+        "gt_class_name",
+        "tk_overlap_classes",
+        "tk_overlap_ids",
+        "tk_neg_ids",
+        "tk_exh_ids",
+        "tk_class_eval_tk_ids",
+        "tk_dets",
+        "tk_classes",
+        "tk_confidences",
+        "sim_scores",
+    ]
+    data = {key: [None] * raw_data["num_timesteps"] for key in data_keys}
+    unique_gt_ids = []
+    unique_tk_ids = []
+    num_gt_dets = 0
+    num_tk_cls_dets = 0
+    num_tk_overlap_dets = 0
+    overlap_ious_thr = 0.5
+    loc_and_asso_tk_ids = []
+
+    for t in range(raw_data["num_timesteps"]):
+        if cls == "all":
+            gt_class_mask = np.ones_like(raw_data["gt_classes"][t]).astype(bool)
+        else:
+            gt_class_mask = np.atleast_1d(raw_data["gt_classes"][t] == cls_id).astype(
+                bool
+            )
+
+        if assignment is not None and assignment:
+            all_gt_ids = list(assignment[t].keys())
+            gt_ids_in = raw_data["gt_ids"][t][gt_class_mask]
+            gt_ids_out = set(all_gt_ids) - set(gt_ids_in)
+            tk_ids_out = set([assignment[t][key] for key in list(gt_ids_out)])
+
+        sim_scores = raw_data["similarity_scores"]
+        overlap_ids_masks = (sim_scores[t][gt_class_mask] >= overlap_ious_thr).any(
+            axis=0
+        )
+        overlap_tk_ids_t = raw_data["tk_ids"][t][overlap_ids_masks]
+        if assignment is not None and assignment:
+            data["tk_overlap_ids"][t] = list(set(overlap_tk_ids_t) - tk_ids_out)
+        else:
+            data["tk_overlap_ids"][t] = list(set(overlap_tk_ids_t))
+
+        loc_and_asso_tk_ids += data["tk_overlap_ids"][t]
+
+        data["tk_exh_ids"][t] = []
+        data["tk_neg_ids"][t] = []
+
+    loc_and_asso_tk_ids = list(set(loc_and_asso_tk_ids))
+
+    for t in range(raw_data["num_timesteps"]):
+        if cls == "all":
+            gt_class_mask = np.ones_like(raw_data["gt_classes"][t]).astype(bool)
+        else:
+            gt_class_mask = np.atleast_1d(raw_data["gt_classes"][t] == cls_id).astype(
+                bool
+            )
+            data["gt_classes"][t] = cls_id
+            data["gt_class_name"][t] = cls
+
+        data["gt_ids"][t] = raw_data["gt_ids"][t][gt_class_mask]
+        data["gt_dets"][t] = raw_data["gt_dets"][t][gt_class_mask]
+
+        tk_mask = np.isin(
+            raw_data["tk_ids"][t], np.array(loc_and_asso_tk_ids), assume_unique=True
+        )
+        tk_overlap_mask = np.isin(
+            raw_data["tk_ids"][t],
+            np.array(data["tk_overlap_ids"][t]),
+            assume_unique=True,
+        )
+
+        data["tk_classes"][t] = raw_data["tk_classes"][t][tk_mask]
+        data["tk_overlap_classes"][t] = raw_data["tk_classes"][t][tk_overlap_mask]
+        data["tk_ids"][t] = raw_data["tk_ids"][t][tk_mask]
+        data["tk_dets"][t] = raw_data["tk_dets"][t][tk_mask]
+        data["tk_confidences"][t] = raw_data["tk_confidences"][t][tk_mask]
+        data["sim_scores"][t] = sim_scores[t][gt_class_mask, :][:, tk_mask]
+        data["tk_class_eval_tk_ids"][t] = set(
+            list(data["tk_overlap_ids"][t])
+            + list(data["tk_neg_ids"][t])
+            + list(data["tk_exh_ids"][t])
+        )
+
+        unique_gt_ids += list(np.unique(data["gt_ids"][t]))
+        unique_tk_ids += list(np.unique(data["tk_ids"][t]))
+
+        num_tk_overlap_dets += len(data["tk_overlap_ids"][t])
+        num_tk_cls_dets += len(data["tk_class_eval_tk_ids"][t])
+        num_gt_dets += len(data["gt_ids"][t])
+
+    if len(unique_gt_ids) > 0:
+        unique_gt_ids = np.unique(unique_gt_ids)
+        gt_id_map = np.nan * np.ones((np.max(unique_gt_ids) + 1))
+        gt_id_map[unique_gt_ids] = np.arange(len(unique_gt_ids))
+        data["gt_id_map"] = {}
+        for gt_id in unique_gt_ids:
+            new_gt_id = gt_id_map[gt_id].astype(int)
+            data["gt_id_map"][new_gt_id] = gt_id
+
+        for t in range(raw_data["num_timesteps"]):
+            if len(data["gt_ids"][t]) > 0:
+                data["gt_ids"][t] = gt_id_map[data["gt_ids"][t]].astype(int)
+
+    if len(unique_tk_ids) > 0:
+        unique_tk_ids = np.unique(unique_tk_ids)
+        tk_id_map = np.nan * np.ones((np.max(unique_tk_ids) + 1))
+        tk_id_map[unique_tk_ids] = np.arange(len(unique_tk_ids))
+
+        data["tk_id_map"] = {}
+        for track_id in unique_tk_ids:
+            new_track_id = tk_id_map[track_id].astype(int)
+            data["tk_id_map"][new_track_id] = track_id
+
+        for t in range(raw_data["num_timesteps"]):
+            if len(data["tk_ids"][t]) > 0:
+                data["tk_ids"][t] = tk_id_map[data["tk_ids"][t]].astype(int)
+            if len(data["tk_overlap_ids"][t]) > 0:
+                data["tk_overlap_ids"][t] = tk_id_map[data["tk_overlap_ids"][t]].astype(
+                    int
+                )
+
+    data["num_tk_cls_dets"] = num_tk_cls_dets
+    data["num_tk_overlap_dets"] = num_tk_overlap_dets
+    data["num_gt_dets"] = num_gt_dets
+    data["num_tk_ids"] = len(unique_tk_ids)
+    data["num_gt_ids"] = len(unique_gt_ids)
+    data["num_timesteps"] = raw_data["num_timesteps"]
+    data["seq"] = raw_data["seq"]
+
+    dataset._check_unique_ids(data)
+
+    return data
+
+
+def _normalize(data):
+    out = dict(data)
+    out["tk_overlap_ids"] = [
+        sorted(np.asarray(ids).tolist()) for ids in data["tk_overlap_ids"]
+    ]
+    out["tk_class_eval_tk_ids"] = [
+        {int(i) for i in ids} for ids in data["tk_class_eval_tk_ids"]
+    ]
+    for key in ("gt_id_map", "tk_id_map"):
+        if isinstance(data[key], dict):
+            out[key] = {int(k): int(v) for k, v in data[key].items()}
+    return out
+
+
+def _diff(a, b, path=""):
+    """Path of the first difference between a and b, None if identical."""
+    if isinstance(a, dict) or isinstance(b, dict):
+        if not (isinstance(a, dict) and isinstance(b, dict)) or list(a) != list(b):
+            return path
+        return next(
+            (d for d in (_diff(a[k], b[k], f"{path}/{k}") for k in a) if d), None
+        )
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        same = (
+            isinstance(a, np.ndarray)
+            and isinstance(b, np.ndarray)
+            and a.dtype == b.dtype
+            and np.array_equal(a, b)
+        )
+        return None if same else path
+    if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            return path
+        return next(
+            (
+                d
+                for d in (
+                    _diff(x, y, f"{path}[{i}]") for i, (x, y) in enumerate(zip(a, b))
+                )
+                if d
+            ),
+            None,
+        )
+    return None if type(a) == type(b) and a == b else path
+
+
+def load_dataset(args, output_dir):
+    dataset_config = teta.config.get_default_dataset_config()
+    dataset_config.update(
+        GT_FOLDER=args.gt_file,
+        TRACKER_SUB_FOLDER=args.tracker_file,
+        TRACKERS_TO_EVAL=["tracker"],
+        OUTPUT_FOLDER=output_dir,
+        GT_CACHE_FOLDER=None,
+        PRINT_CONFIG=False,
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        dataset = teta.datasets.TAO(dataset_config)
+    return dataset, dataset.seq_list
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("TETA preprocessing check", add_help=False)
+    parser.add_argument("--gt_file", default=None, type=str)
+    parser.add_argument("--tracker_file", default=None, type=str)
+    parser.add_argument("--num_seqs", default=40, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "TETA preprocessing check", parents=[get_args_parser()]
+    )
+    args = parser.parse_args()
+    assert (args.gt_file is None) == (args.tracker_file is None)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.gt_file is not None:
+            dataset, seqs = load_dataset(args, tmp_dir)
+        else:
+            dataset, seqs, _ = synthetic_dataset(args.num_seqs, seed=args.seed)
+
+        metric = TETA()
+        num_calls, t_loop, t_tables = 0, 0.0, 0.0
+        for seq in seqs:
+            raw = dataset.get_raw_seq_data("tracker", seq)
+            loop_raw = copy.deepcopy(raw)
+            data_all = dataset.get_preprocessed_seq_data(raw, "all", thresholds=[50])
+            assignment = metric.compute_global_assignment(data_all)[50]
+            gt_cls_ids = np.unique(
+                np.concatenate([np.empty(0, dtype=int)] + raw["gt_classes"])
+            )
+            classes = [("all", None)] + [
+                (dataset.clsid2cls_name[cid], assignment)
+                for cid in gt_cls_ids
+                if cid in dataset.clsid2cls_name
+            ]
+            for cls, cls_assignment in classes:
+                start = time.time()
+                expected = loop_preprocess_seq_data_thr(
+                    dataset, loop_raw, cls, cls_assignment
+                )
+                t_loop += time.time() - start
+                start = time.time()
+                data = dataset.get_preprocessed_seq_data_thr(raw, cls, cls_assignment)
+                t_tables += time.time() - start
+                num_calls += 1
+                diff = _diff(_normalize(expected), _normalize(data))
+                if diff is not None:
+                    print(f"MISMATCH: sequence {seq}, class {cls}: {diff}")
+                    sys.exit(1)
+
+    print(
+        f"{len(seqs)} sequences, {num_calls} preprocessed classes identical "
+        f"(loop {t_loop:.2f} s, tables {t_tables:.2f} s)"
+    )
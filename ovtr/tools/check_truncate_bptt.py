@@ -0,0 +1,254 @@
+"""Check the truncated backprop through time of --truncate_bptt.
+
+The OVTR model needs CUDA, so a small recurrent stand-in with the same
+interface is trained on CPU with ``train_one_epoch_mot``: ``forward(data,
+frame_range, state)`` runs a window of frames, returns the detached track
+state in ``outputs['state']``, and its criterion keeps per-frame losses and
+``num_samples`` like ``OVFrameMatcher`` (``initialize`` / ``reset_losses``)::
+
+    python tools/check_truncate_bptt.py
+
+It checks that
+
+* with K >= clip length the update is bit-identical to K = 0,
+* with a smaller K the per-window backward gives the gradient of the whole
+  clip loss with the track state detached at the window boundaries, computed
+  in a single backward,
+* the peak size of the tensors saved for backward goes down with K. It is
+  measured with ``torch.autograd.graph.saved_tensors_hooks``, or with
+  ``torch.cuda.max_memory_allocated`` when ``--device cuda``.
+
+The script exits with status 1 on the first failed check.
+"""
+
+import argparse
+import copy
+import os
+import sys
+
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import clip_windows, train_one_epoch_mot  # noqa: E402
+from util.events import EventStorage  # noqa: E402
+
+
+class ToyCriterion(nn.Module):
+    def __init__(self, num_frames):
+        super().__init__()
+        self.weight_dict = {f"frame_{i}_loss_bbox": 5.0 for i in range(num_frames)}
+        self.weight_dict.update({f"frame_{i}_loss_ce": 1.0 for i in range(num_frames)})
+
+    def initialize(self, gt_instances):
+        self.gt_instances = gt_instances
+        self.num_samples = 0
+        self.losses_dict = {}
+
+    def reset_losses(self):
+        self.losses_dict = {}
+
+    def get_num_boxes(self, num_samples):
+        return max(float(num_samples), 1.0)
+
+    def match_for_single_frame(self, frame_index, pred_boxes, pred_logits):
+        gt = self.gt_instances[frame_index]
+        self.num_samples += len(gt)
+        self.losses_dict[f"frame_{frame_index}_loss_bbox"] = (
+            (pred_boxes[: len(gt)] - gt).abs().sum()
+        )
+        self.losses_dict[f"frame_{frame_index}_loss_ce"] = (
+            pred_logits[: len(gt)].logsumexp(-1).sum()
+        )
+
+    def forward(self, outputs, normalize=True):
+        losses = outputs.pop("losses_dict")
+        if not normalize:
+            return dict(losses)
+        num_boxes = self.get_num_boxes(self.num_samples)
+        return {k: v / num_boxes for k, v in losses.items()}
+
+
+class ToyTracker(nn.Module):
+    """Track queries updated frame to frame, the ``OVTR.forward`` contract."""
+
+    def __init__(self, criterion, num_queries=32, dim=64):
+        super().__init__()
+        self.criterion = criterion
+        self.query_embed = nn.Parameter(torch.randn(num_queries, dim) * 0.1)
+        self.encoder = nn.Sequential(
+            nn.Linear(dim, 4 * dim), nn.ReLU(), nn.Linear(4 * dim, dim)
+        )
+        self.track_embed = nn.Sequential(nn.Linear(dim, dim), nn.Tanh())
+        self.bbox_embed = nn.Linear(dim, 4)
+        self.class_embed = nn.Linear(dim, 8)
+
+    def forward(self, data, frame_range=None, state=None):
+        frames = data["imgs"]
+        start, end = frame_range if frame_range is not None else (0, len(frames))
+        if start == 0:
+            self.criterion.initialize(data["gt_instances"])
+        else:
+            self.criterion.reset_losses()
+        outputs = {"pred_logits": [], "pred_boxes": [], "track_instances": []}
+        track = self.query_embed if state is None else state["track_instances"]
+        for frame_index in range(start, end):
+            is_last = frame_index == len(frames) - 1
+            hs = torch.tanh(self.encoder(frames[frame_index]) + track)
+            pred_boxes, pred_logits = self.bbox_embed(hs).sigmoid(), self.class_embed(
+                hs
+            )
+            self.criterion.match_for_single_frame(frame_index, pred_boxes, pred_logits)
+            if not is_last:
+                truncate = frame_index == end - 1
+                track = self.track_embed(hs.detach() if truncate else hs)
+            outputs["pred_logits"].append(pred_logits)
+            outputs["pred_boxes"].append(pred_boxes)
+            outputs["track_instances"].append(hs)
+        outputs["losses_dict"] = self.criterion.losses_dict
+        if frame_range is not None:
+            outputs["state"] = {"track_instances": track, "extra_labels": None}
+        return outputs
+
+    def conditional_parameters(self):
+        return []
+
+
+def make_clip(num_frames, num_queries=32, dim=64, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return {
+        "imgs": [torch.randn(num_queries, dim, generator=g) for _ in range(num_frames)],
+        "gt_instances": [
+            torch.rand(
+                int(torch.randint(1, num_queries, (1,), generator=g)), 4, generator=g
+            )
+            for _ in range(num_frames)
+        ],
+        "filename": ["clip.jpg"],
+    }
+
+
+class SavedTensorMeter:
+    """Peak number of bytes of the tensors saved for backward and still alive."""
+
+    def __init__(self):
+        self.live = 0
+        self.peak = 0
+
+    def pack(self, tensor):
+        nbytes = tensor.numel() * tensor.element_size()
+        self.live += nbytes
+        self.peak = max(self.peak, self.live)
+        return _Packed(self, tensor, nbytes)
+
+    @staticmethod
+    def unpack(packed):
+        return packed.tensor
+
+
+class _Packed:
+    def __init__(self, meter, tensor, nbytes):
+        self.meter, self.tensor, self.nbytes = meter, tensor, nbytes
+
+    def __del__(self):
+        # freed with the graph node that saved it
+        self.meter.live -= self.nbytes
+
+
+def update(model, clip, truncate_bptt, device, meter=None):
+    """Parameter change of one SGD (lr 1) update, i.e. the gradient."""
+    model = copy.deepcopy(model).to(device)
+    before = [p.detach().clone() for p in model.parameters()]
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    hooks = (
+        torch.autograd.graph.saved_tensors_hooks(meter.pack, meter.unpack)
+        if meter is not None
+        else torch.autograd.graph.saved_tensors_hooks(lambda t: t, lambda t: t)
+    )
+    with EventStorage(0), hooks:
+        train_one_epoch_mot(
+            model,
+            model.criterion,
+            [clip],
+            optimizer,
+            torch.device(device),
+            0,
+            truncate_bptt=truncate_bptt,
+        )
+    return [q - p.detach() for p, q in zip(model.parameters(), before)]
+
+
+def reference_gradient(model, clip, truncate_bptt):
+    """One backward of the whole clip loss, state detached between windows."""
+    model = copy.deepcopy(model)
+    weight_dict, total, state = model.criterion.weight_dict, 0.0, None
+    for start, end in clip_windows(len(clip["imgs"]), truncate_bptt):
+        outputs = model(clip, frame_range=(start, end), state=state)
+        state = outputs.pop("state")
+        losses = model.criterion(outputs, normalize=False)
+        total = total + sum(v * weight_dict[k] for k, v in losses.items())
+    total = total / model.criterion.get_num_boxes(model.criterion.num_samples)
+    total.backward()
+    return [p.grad for p in model.parameters()]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Truncated backprop check", add_help=False)
+    parser.add_argument("--num_frames", default=8, type=int)
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+def _fail(msg):
+    print(f"FAILED: {msg}")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Truncated backprop check", parents=[get_args_parser()]
+    )
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    num_frames = args.num_frames
+    model = ToyTracker(ToyCriterion(num_frames))
+    clip = make_clip(num_frames, seed=args.seed)
+
+    full = update(model, clip, 0, "cpu")
+    for k in (num_frames, num_frames + 3):
+        if not all(
+            torch.equal(a, b) for a, b in zip(full, update(model, clip, k, "cpu"))
+        ):
+            _fail(f"truncate_bptt={k} >= clip length changed the gradient")
+    print(f"truncate_bptt >= {num_frames} frames: gradient bit-identical to 0")
+
+    for k in sorted({1, 2, num_frames // 2}):
+        truncated = update(model, clip, k, "cpu")
+        reference = reference_gradient(model, clip, k)
+        max_diff = max((a - b).abs().max().item() for a, b in zip(truncated, reference))
+        if not all(
+            torch.allclose(a, b, rtol=1e-5, atol=1e-6)
+            for a, b in zip(truncated, reference)
+        ):
+            _fail(f"truncate_bptt={k}: per-window gradient differs by {max_diff:.3g}")
+        print(
+            f"truncate_bptt={k}: per-window gradient matches the truncated graph "
+            f"(max difference {max_diff:.3g})"
+        )
+
+    peaks = {}
+    for k in sorted({0, num_frames // 2, 2, 1}):
+        if args.device.startswith("cuda"):
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            update(model, clip, k, args.device)
+            peaks[k] = torch.cuda.max_memory_allocated() - base
+        else:
+            meter = SavedTensorMeter()
+            update(model, clip, k, "cpu", meter)
+            peaks[k] = meter.peak
+        print(f"truncate_bptt={k}: peak {peaks[k] / 2**20:.2f} MiB")
+    if not peaks[1] < peaks[0]:
+        _fail("truncating every frame did not lower the peak memory")
@@ -0,0 +1,143 @@
+"""Measure the memory growth of forked DataLoader workers over an epoch.
+
+``CocoVideoDataset`` keeps ``data_infos`` as a ``SerializedList``. This script
+reads synthetic per-image dicts, shaped like the TAO / LVIS image infos, once
+from a plain list and once from a ``SerializedList``. Each dataset is run for
+one epoch through a DataLoader whose workers are forked, and every item reads
+its info as ``prepare_train_img`` does::
+
+    python tools/check_worker_memory.py
+    python tools/check_worker_memory.py --num_images 500000 --num_workers 4
+
+Each worker records its unique set size, the private pages from
+``/proc/self/smaps_rollup`` (Linux only), at its first and last batch. With
+the list, reading the dicts updates their refcounts and the garbage
+collector walks them, so each worker copies the pages of the list as the
+epoch goes on. The script prints the growth per worker and exits with
+status 1 if the ``SerializedList`` workers do not grow less.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datasets.serialization import SerializedList  # noqa: E402
+
+
+def unique_set_size():
+    """Private memory of this process in bytes."""
+    uss = 0
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                uss += int(line.split()[1]) * 1024
+    return uss
+
+
+def synthetic_data_infos(num_images, seed=0):
+    rng = np.random.RandomState(seed)
+    infos = []
+    for i in range(num_images):
+        video_id = i // 40
+        infos.append(
+            {
+                "id": i,
+                "video_id": video_id,
+                "frame_id": i % 40,
+                "file_name": f"train/LaSOT/video_{video_id:06d}/frame_{i % 40:06d}.jpg",
+                "filename": f"train/LaSOT/video_{video_id:06d}/frame_{i % 40:06d}.jpg",
+                "width": int(rng.choice([640, 1280, 1920])),
+                "height": int(rng.choice([480, 720, 1080])),
+                "neg_category_ids": rng.randint(1, 1231, rng.randint(0, 12)).tolist(),
+                "not_exhaustive_category_ids": rng.randint(
+                    1, 1231, rng.randint(0, 6)
+                ).tolist(),
+            }
+        )
+    return infos
+
+
+class InfoDataset(torch.utils.data.Dataset):
+    def __init__(self, data_infos):
+        self.data_infos = data_infos
+
+    def __len__(self):
+        return len(self.data_infos)
+
+    def __getitem__(self, idx):
+        img_info = self.data_infos[idx]
+        # the results dict the pipeline starts from
+        return len(dict(img_info=img_info, ann_info=None)["img_info"]["file_name"])
+
+
+def collate_fn(batch):
+    worker = torch.utils.data.get_worker_info()
+    return worker.id, unique_set_size()
+
+
+def epoch_growth(data_infos, args):
+    """USS growth of each worker between its first and its last batch."""
+    loader = DataLoader(
+        InfoDataset(data_infos),
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+        collate_fn=collate_fn,
+        multiprocessing_context="fork",
+        generator=torch.Generator().manual_seed(args.seed),
+    )
+    first, last = {}, {}
+    start = time.time()
+    for worker_id, uss in loader:
+        first.setdefault(worker_id, uss)
+        last[worker_id] = uss
+    elapsed = time.time() - start
+    return [last[w] - first[w] for w in sorted(first)], elapsed
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Worker memory check", add_help=False)
+    parser.add_argument("--num_images", default=200000, type=int)
+    parser.add_argument("--num_workers", default=2, type=int)
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Worker memory check", parents=[get_args_parser()])
+    args = parser.parse_args()
+    mib = 2**20
+    before = unique_set_size()
+    infos = synthetic_data_infos(args.num_images, args.seed)
+    print(f"list: about {(unique_set_size() - before) / mib:.1f} MiB of dicts")
+
+    growth = {}
+    for name in ("list", "SerializedList"):
+        if name == "list":
+            data_infos = infos
+        else:
+            data_infos = SerializedList(infos)
+            infos = None
+            gc.collect()
+            size = data_infos._buffer.nbytes + data_infos._ends.nbytes
+            print(f"SerializedList: {size / mib:.1f} MiB buffer")
+        growth[name], elapsed = epoch_growth(data_infos, args)
+        print(
+            f"{name}: worker USS growth over the epoch "
+            + ", ".join(f"{g / mib:.1f} MiB" for g in growth[name])
+            + f" ({elapsed:.1f} s)"
+        )
+        del data_infos
+
+    if not max(growth["SerializedList"]) < min(growth["list"]):
+        print("FAILED: the SerializedList workers did not grow less than the list ones")
+        sys.exit(1)
@@ -0,0 +1,101 @@
+import glob
+import json
+import os
+import threading
+import time
+
+import torch
+
+
+def state_to_cpu(state):
+    """Copy every tensor of a (nested) state dict to the cpu, so that training
+    can keep updating the originals while the copy is being written."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, state_to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+def is_complete(path):
+    """Whether ``path`` was fully written by AsyncCheckpointer."""
+    return os.path.exists(path) and os.path.exists(str(path) + '.done')
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints in a background thread.
+
+    ``save`` snapshots the state to the cpu and returns; the thread then
+    serializes it to ``<path>.tmp``, fsyncs and atomically renames it over
+    ``path`` before writing the ``<path>.done`` completion marker, so an
+    interrupted write never damages the previous checkpoint. Only one save
+    can be in flight: ``save`` raises if the previous one is still running,
+    call ``wait`` first to queue behind it.
+
+    Args:
+        keep_last (int): Number of completed checkpoints matching
+            ``rotate_pattern`` to keep in a directory, 0 keeps all of them.
+        rotate_pattern (str): Glob of the checkpoints subject to rotation.
+    """
+
+    def __init__(self, keep_last=0, rotate_pattern='checkpoint[0-9]*.pth'):
+        self.keep_last = keep_last
+        self.rotate_pattern = rotate_pattern
+        self._thread = None
+        self._error = None
+
+    def in_flight(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self):
+        """Block until the pending save is done, re-raising its error."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('background checkpoint save failed') from error
+
+    def save(self, state, paths):
+        if self.in_flight():
+            raise RuntimeError('a checkpoint save is already in flight')
+        self.wait()
+        paths = [str(p) for p in (paths if isinstance(paths, (list, tuple)) else [paths])]
+        state = state_to_cpu(state)
+        self._thread = threading.Thread(target=self._write, args=(state, paths), daemon=True)
+        self._thread.start()
+
+    def _write(self, state, paths):
+        try:
+            for path in paths:
+                self._write_one(state, path)
+            if self.keep_last > 0:
+                for directory in {os.path.dirname(p) for p in paths}:
+                    self._rotate(directory)
+        except BaseException as e:
+            self._error = e
+
+    @staticmethod
+    def _write_one(state, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        marker = {'time': time.time(), 'size': os.path.getsize(path)}
+        for key in ('epoch', 'step'):
+            if key in state:
+                marker[key] = state[key]
+        with open(tmp_path, 'w') as f:
+            json.dump(marker, f)
+        os.replace(tmp_path, path + '.done')
+
+    def _rotate(self, directory):
+        paths = sorted(p for p in glob.glob(os.path.join(directory, self.rotate_pattern))
+                       if is_complete(p))
+        for path in paths[:-self.keep_last]:
+            os.remove(path + '.done')
+            os.remove(path)
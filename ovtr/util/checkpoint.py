@@ -28,6 +28,12 @@ class CheckpointFunction(torch.autograd.Function):
         ctx.run_function = run_function
         ctx.input_tensors = list(args[:length])
         ctx.input_params = list(args[length:])
+        # the recomputation in backward must see the same autocast state as
+        # this forward, otherwise it produces tensors of different dtypes
+        ctx.gpu_autocast_kwargs = {"enabled": torch.is_autocast_enabled(),
+                                   "dtype": torch.get_autocast_gpu_dtype()}
+        ctx.cpu_autocast_kwargs = {"enabled": torch.is_autocast_cpu_enabled(),
+                                   "dtype": torch.get_autocast_cpu_dtype()}
         with torch.no_grad():
             output_tensors = ctx.run_function(*ctx.input_tensors)
         return output_tensors
@@ -38,7 +44,9 @@ class CheckpointFunction(torch.autograd.Function):
             temp = ctx.input_tensors[i]
             ctx.input_tensors[i] = temp.detach()
             ctx.input_tensors[i].requires_grad = temp.requires_grad
-        with torch.enable_grad():
+        with torch.enable_grad(), \
+                torch.autocast(device_type="cuda", **ctx.gpu_autocast_kwargs), \
+                torch.autocast(device_type="cpu", **ctx.cpu_autocast_kwargs):
             output_tensors = ctx.run_function(*ctx.input_tensors)
         to_autograd = []
         for i in range(len(ctx.input_tensors)):
@@ -17,11 +17,14 @@ Mostly copy-paste from torchvision references.
 import datetime
 import os
 import pickle
+import random
 import subprocess
 import time
 from collections import defaultdict, deque
+from contextlib import contextmanager
 from typing import List, Optional
 
+import numpy as np
 import torch
 import torch.distributed as dist
 
@@ -54,7 +57,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=get_comm_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -108,11 +111,12 @@ def all_gather(data):
     # serialized to a Tensor
     buffer = pickle.dumps(data)
     storage = torch.ByteStorage.from_buffer(buffer)
-    tensor = torch.ByteTensor(storage).to("cuda")
+    device = get_comm_device()
+    tensor = torch.ByteTensor(storage).to(device)
 
     # obtain Tensor size of each rank
-    local_size = torch.tensor([tensor.numel()], device="cuda")
-    size_list = [torch.tensor([0], device="cuda") for _ in range(world_size)]
+    local_size = torch.tensor([tensor.numel()], device=device)
+    size_list = [torch.tensor([0], device=device) for _ in range(world_size)]
     dist.all_gather(size_list, local_size)
     size_list = [int(size.item()) for size in size_list]
     max_size = max(size_list)
@@ -122,9 +126,9 @@ def all_gather(data):
     # gathering tensors of different shapes
     tensor_list = []
     for _ in size_list:
-        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device="cuda"))
+        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device=device))
     if local_size != max_size:
-        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device="cuda")
+        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device=device)
         tensor = torch.cat((tensor, padding), dim=0)
     dist.all_gather(tensor_list, tensor)
 
@@ -314,7 +318,38 @@ def _max_by_axis(the_list):
     return maxes
 
 
-def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
+class PaddedBatchBuffer(object):
+    """Reusable storage for the padded batch and mask built by
+    ``nested_tensor_from_tensor_list``.
+
+    The largest batch seen so far is kept and later batches are returned as
+    views of it, so no fresh tensor and mask are allocated per call. A call
+    overwrites the views handed out by the previous one: only use a buffer
+    where the previous batch is no longer referenced, e.g. frame-by-frame
+    inference under ``torch.no_grad()`` (in training, autograd keeps the
+    frames of a clip alive until backward).
+    """
+
+    def __init__(self):
+        self.tensor = None
+        self.mask = None
+
+    def get(self, batch_shape, dtype, device):
+        b, c, h, w = batch_shape
+        numel = b * c * h * w
+        if (self.tensor is None or self.tensor.dtype != dtype
+                or self.tensor.device != torch.device(device)
+                or self.tensor.numel() < numel):
+            self.tensor = torch.empty(numel, dtype=dtype, device=device)
+        if (self.mask is None or self.mask.device != torch.device(device)
+                or self.mask.numel() < b * h * w):
+            self.mask = torch.empty(b * h * w, dtype=torch.bool, device=device)
+        tensor = self.tensor[:numel].view(b, c, h, w)
+        mask = self.mask[: b * h * w].view(b, h, w)
+        return tensor, mask
+
+
+def nested_tensor_from_tensor_list(tensor_list: List[Tensor], buffer: Optional[PaddedBatchBuffer] = None):
     # TODO make this more general
     if tensor_list[0].ndim == 3:
         # TODO make it support different-sized images
@@ -324,15 +359,34 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
         b, c, h, w = batch_shape
         dtype = tensor_list[0].dtype
         device = tensor_list[0].device
-        tensor = torch.zeros(batch_shape, dtype=dtype, device=device)
-        mask = torch.ones((b, h, w), dtype=torch.bool, device=device)
+        if buffer is None:
+            tensor = torch.empty(batch_shape, dtype=dtype, device=device)
+            mask = torch.empty((b, h, w), dtype=torch.bool, device=device)
+        else:
+            tensor, mask = buffer.get(batch_shape, dtype, device)
+        # only the padding is cleared, the image region is overwritten anyway
         for img, pad_img, m in zip(tensor_list, tensor, mask):
-            pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
-            m[: img.shape[1], : img.shape[2]] = False
+            img_c, img_h, img_w = img.shape
+            pad_img[:img_c, :img_h, :img_w].copy_(img)
+            pad_img[img_c:].zero_()
+            pad_img[:, img_h:].zero_()
+            pad_img[:, :img_h, img_w:].zero_()
+            m[:img_h, :img_w] = False
+            m[img_h:] = True
+            m[:img_h, img_w:] = True
     else:
         raise ValueError("not supported")
     return NestedTensor(tensor, mask)
 
+
+def padding_fraction(tensor_list: List[Tensor]) -> float:
+    """Fraction of the batch built by ``nested_tensor_from_tensor_list`` that
+    would be padding."""
+    max_size = _max_by_axis([list(img.shape) for img in tensor_list])
+    padded = len(tensor_list) * max_size[-2] * max_size[-1]
+    valid = sum(img.shape[-2] * img.shape[-1] for img in tensor_list)
+    return 1.0 - valid / padded
+
 def nested_tensor_from_tensor_list_pairs(tensor_list: List[Tensor]):
     tensor = tensor_list[0].unsqueeze(0)
     mask = tensor_list[1].unsqueeze(0)
@@ -390,6 +444,14 @@ def is_dist_avail_and_initialized():
     return True
 
 
+def get_comm_device():
+    """Device of the tensors exchanged by the collectives: nccl needs them
+    on the GPU, gloo (e.g. CPU runs) on the CPU."""
+    if is_dist_avail_and_initialized() and dist.get_backend() != dist.Backend.NCCL:
+        return torch.device("cpu")
+    return torch.device("cuda")
+
+
 def get_world_size():
     if not is_dist_avail_and_initialized():
         return 1
@@ -418,6 +480,26 @@ def is_main_process():
     return get_rank() == 0
 
 
+def get_rng_state():
+    """States of all the random number generators of this process."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
@@ -505,6 +587,19 @@ def interpolate(input, size=None, scale_factor=None, mode="nearest", align_corne
         return torchvision.ops.misc.interpolate(input, size, scale_factor, mode, align_corners)
 
 
+def parameters_zero_loss(parameters):
+    """A zero that depends on every parameter in ``parameters``.
+
+    Added to the loss, it gives all of them a (zero) gradient in every
+    iteration, so DistributedDataParallel can run without
+    find_unused_parameters even when a branch (e.g. the track query updater
+    without active tracks) is skipped in some iterations. Only pass the
+    parameters of such branches: covering every parameter would also hide the
+    ones that are never used.
+    """
+    return sum(p.view(-1)[0] for p in parameters) * 0.
+
+
 def get_total_grad_norm(parameters, norm_type=2):
     parameters = list(filter(lambda p: p.grad is not None, parameters))
     norm_type = float(norm_type)
@@ -516,6 +611,26 @@ def get_total_grad_norm(parameters, norm_type=2):
     return total_norm
 
 
+@contextmanager
+def autocast_disabled():
+    """Run the enclosed region without autocast, on both CUDA and CPU."""
+    with torch.autocast(device_type='cuda', enabled=False), \
+            torch.autocast(device_type='cpu', enabled=False):
+        yield
+
+
+def to_fp32(outputs):
+    """Cast the floating point tensors of (nested lists, tuples and dicts of)
+    outputs to fp32."""
+    if isinstance(outputs, Tensor):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    if isinstance(outputs, dict):
+        return {k: to_fp32(v) for k, v in outputs.items()}
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(to_fp32(v) for v in outputs)
+    return outputs
+
+
 def inverse_sigmoid(x, eps=1e-5):
     x = x.clamp(min=0, max=1)
     x1 = x.clamp(min=eps)